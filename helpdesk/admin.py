@@ -1,4 +1,5 @@
 from django.contrib import admin
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from helpdesk import settings as helpdesk_settings
 from helpdesk.models import (
@@ -12,10 +13,12 @@ from helpdesk.models import (
     FollowUpAttachment,
     IgnoreEmail,
     KBIAttachment,
+    OutboundEmail,
     PreSetReply,
     Queue,
     Ticket,
     TicketChange,
+    WebhookDelivery,
 )
 
 
@@ -58,6 +61,9 @@ class QueueAdmin(admin.ModelAdmin):
         }),
     )
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_time_spent()
+
     def get_urls(self):
         from django.urls import path
 
@@ -137,6 +143,7 @@ class QueueAdmin(admin.ModelAdmin):
         except Exception as e:
             return JsonResponse({"ok": False, "message": str(e)})
 
+    @admin.display(description=_("Time spent"), ordering="total_time_spent")
     def time_spent(self, q):
         if q.dedicated_time:
             return "{} / {}".format(q.time_spent, q.dedicated_time)
@@ -282,6 +289,33 @@ class IgnoreEmailAdmin(admin.ModelAdmin):
     list_display = ("name", "queue_list", "email_address", "keep_in_mailbox")
 
 
+@admin.register(OutboundEmail)
+class OutboundEmailAdmin(admin.ModelAdmin):
+    list_display = (
+        "template_name",
+        "recipients",
+        "ticket",
+        "created",
+        "attempts",
+        "next_attempt",
+        "failed",
+    )
+    list_filter = ("failed",)
+    raw_id_fields = ("ticket",)
+
+
+@admin.register(WebhookDelivery)
+class WebhookDeliveryAdmin(admin.ModelAdmin):
+    list_display = ("url", "ticket", "created", "attempts", "next_attempt", "failed")
+    list_filter = ("failed",)
+    raw_id_fields = ("ticket",)
+    actions = ("replay",)
+
+    @admin.action(description=_("Send the selected deliveries again"))
+    def replay(self, request, queryset):
+        queryset.update(failed=False, attempts=0, next_attempt=timezone.now())
+
+
 @admin.register(ChecklistTemplate)
 class ChecklistTemplateAdmin(admin.ModelAdmin):
     list_display = ("name", "task_list")
@@ -10,4 +10,7 @@ class HelpdeskConfig(AppConfig):
     default_auto_field = "django.db.models.AutoField"
 
     def ready(self):
+        from . import email  # noqa: F401
+        from . import search  # noqa: F401
+        from . import user  # noqa: F401
         from . import webhooks  # noqa: F401
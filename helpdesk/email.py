@@ -7,24 +7,40 @@ See LICENSE for details.
 
 # import base64
 from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
+from django import db
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
-from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
 from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
 from django.utils import encoding, timezone
 from django.utils.translation import gettext as _
 import email
+import hashlib
 from email import policy
 from email.message import EmailMessage, MIMEPart
 from email.utils import getaddresses
 from email_reply_parser import EmailReplyParser
+from functools import lru_cache
 from helpdesk import settings as helpdesk_settings
 from helpdesk.exceptions import DeleteIgnoredTicketException, IgnoreTicketException
 from helpdesk.lib import process_attachments, safe_template_context
-from helpdesk.models import FollowUp, IgnoreEmail, Queue, Ticket
+from helpdesk.models import (
+    FollowUp,
+    IgnoreEmail,
+    IngestedEmail,
+    MessageThread,
+    Queue,
+    Ticket,
+    TicketCC,
+)
 from helpdesk.signals import new_ticket_done, update_ticket_done
+from helpdesk.templated_email import email_session
 import imaplib
 import logging
 import mimetypes
@@ -59,76 +75,161 @@ STRIPPED_SUBJECT_STRINGS = [
 HTML_EMAIL_ATTACHMENT_FILENAME = _("email_html_body.html")
 
 
-def process_email(quiet: bool = False, debug_to_stdout: bool = False):
+def process_email(
+    quiet: bool = False,
+    debug_to_stdout: bool = False,
+    workers: int = 1,
+    timeout: typing.Optional[float] = None,
+):
+    """
+    Poll the mailboxes of all queues accepting e-mail. With more than one
+    worker, up to `workers` mailboxes are polled at the same time in
+    threads, each with its own database connection. `timeout` is the number
+    of seconds to wait for a mail server (QUEUE_EMAIL_BOX_TIMEOUT by default).
+    """
     if debug_to_stdout:
         print("Extracting email into queues...")
-    q: Queue()  # Typing ahead of time for loop to make it more useful in an IDE
-    for q in Queue.objects.filter(
+    if timeout is None:
+        timeout = helpdesk_settings.QUEUE_EMAIL_BOX_TIMEOUT
+    queues = Queue.objects.filter(
         email_box_type__isnull=False, allow_email_submission=True
-    ):
-        log_msg = f"Processing queue: {q.slug} Email address: {q.email_address}..."
-        if debug_to_stdout:
-            print(log_msg)
-        logger = logging.getLogger("django.helpdesk.queue." + q.slug)
-        logging_types = {
-            "info": logging.INFO,
-            "warn": logging.WARN,
-            "error": logging.ERROR,
-            "crit": logging.CRITICAL,
-            "debug": logging.DEBUG,
-        }
-        if q.logging_type in logging_types:
-            logger.setLevel(logging_types[q.logging_type])
-        elif not q.logging_type or q.logging_type == "none":
-            # disable all handlers so messages go to nowhere
-            logger.handlers = []
-            logger.propagate = False
-        if quiet:
-            logger.propagate = (
-                False  # do not propagate to root logger that would log to console
-            )
-        # Log messages to specific file only if the queue has it configured
-        if (
-            q.logging_type in logging_types
-        ) and q.logging_dir:  # if it's enabled and the dir is set
-            log_file_handler = logging.FileHandler(
-                join(q.logging_dir, q.slug + "_get_email.log")
-            )
-            logger.addHandler(log_file_handler)
-        else:
-            log_file_handler = None
-            if not q.email_box_last_check:
-                q.email_box_last_check = timezone.now() - timedelta(minutes=30)
-        try:
-            queue_time_delta = timedelta(minutes=q.email_box_interval or 0)
-            if (q.email_box_last_check + queue_time_delta) < timezone.now():
-                process_queue(q, logger=logger)
-                q.email_box_last_check = timezone.now()
-                q.save()
-                log_msg: str = f"Queue successfully processed: {q.slug}"
+    )
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    poll_queue_in_thread, q.pk, quiet, debug_to_stdout, timeout
+                )
+                for q in queues
+            ]
+            for future in futures:
+                future.result()
+    else:
+        q: Queue()  # Typing ahead of time for loop to make it more useful in an IDE
+        for q in queues:
+            poll_queue(q, quiet, debug_to_stdout, timeout)
+    if debug_to_stdout:
+        print("Email extraction into queues completed.")
+
+
+def poll_queue_in_thread(queue_id, quiet, debug_to_stdout, timeout):
+    try:
+        q = Queue.objects.filter(pk=queue_id).first()
+        if q is not None:
+            poll_queue(q, quiet, debug_to_stdout, timeout)
+    finally:
+        # every thread opens its own database connections
+        db.connections.close_all()
+
+
+def lock_queue(q):
+    """
+    Claim the mailbox of a queue for this run. The claim is set by a single
+    UPDATE, which locks the queue row, so of two overlapping runs only one
+    polls the mailbox. Claims expire after QUEUE_EMAIL_BOX_LOCK_TIMEOUT
+    seconds in case a run never released its claim.
+    """
+    now = timezone.now()
+    return bool(
+        Queue.objects.filter(pk=q.pk)
+        .filter(
+            Q(email_box_locked_until__isnull=True) | Q(email_box_locked_until__lt=now)
+        )
+        .update(
+            email_box_locked_until=now
+            + timedelta(seconds=helpdesk_settings.QUEUE_EMAIL_BOX_LOCK_TIMEOUT)
+        )
+    )
+
+
+def unlock_queue(q):
+    q.email_box_locked_until = None
+    Queue.objects.filter(pk=q.pk).update(email_box_locked_until=None)
+
+
+def poll_queue(q, quiet=False, debug_to_stdout=False, timeout=None):
+    log_msg = f"Processing queue: {q.slug} Email address: {q.email_address}..."
+    if debug_to_stdout:
+        print(log_msg)
+    logger = logging.getLogger("django.helpdesk.queue." + q.slug)
+    logging_types = {
+        "info": logging.INFO,
+        "warn": logging.WARN,
+        "error": logging.ERROR,
+        "crit": logging.CRITICAL,
+        "debug": logging.DEBUG,
+    }
+    if q.logging_type in logging_types:
+        logger.setLevel(logging_types[q.logging_type])
+    elif not q.logging_type or q.logging_type == "none":
+        # disable all handlers so messages go to nowhere
+        logger.handlers = []
+        logger.propagate = False
+    if quiet:
+        logger.propagate = (
+            False  # do not propagate to root logger that would log to console
+        )
+    # Log messages to specific file only if the queue has it configured
+    if (
+        q.logging_type in logging_types
+    ) and q.logging_dir:  # if it's enabled and the dir is set
+        log_file_handler = logging.FileHandler(
+            join(q.logging_dir, q.slug + "_get_email.log")
+        )
+        logger.addHandler(log_file_handler)
+    else:
+        log_file_handler = None
+        if not q.email_box_last_check:
+            q.email_box_last_check = timezone.now() - timedelta(minutes=30)
+    try:
+        queue_time_delta = timedelta(minutes=q.email_box_interval or 0)
+        if (q.email_box_last_check + queue_time_delta) < timezone.now():
+            if not lock_queue(q):
+                log_msg = f"Queue is being processed by another run: {q.slug}"
                 logger.info(log_msg)
                 if debug_to_stdout:
                     print(log_msg)
-        except Exception as e:
-            logger.error(f"Queue processing failed: {q.slug} -- {e}", exc_info=True)
-            if debug_to_stdout:
-                print(f"Queue processing failed: {q.slug}")
-                print("-" * 60)
-                traceback.print_exc(file=sys.stdout)
-        finally:
-            # we must close the file handler correctly if it's created
-            try:
-                if log_file_handler:
-                    log_file_handler.close()
-            except Exception as e:
-                logging.exception(e)
+                return
             try:
-                if log_file_handler:
-                    logger.removeHandler(log_file_handler)
-            except Exception as e:
-                logging.exception(e)
-    if debug_to_stdout:
-        print("Email extraction into queues completed.")
+                process_queue(q, logger=logger, timeout=timeout)
+                q.email_box_last_check = timezone.now()
+                # an UPDATE, as saving the queue would signal a queue change
+                Queue.objects.filter(pk=q.pk).update(
+                    email_box_last_check=q.email_box_last_check
+                )
+                purge_ingested_emails(q)
+            finally:
+                unlock_queue(q)
+            log_msg: str = f"Queue successfully processed: {q.slug}"
+            logger.info(log_msg)
+            if debug_to_stdout:
+                print(log_msg)
+    except Exception as e:
+        logger.error(f"Queue processing failed: {q.slug} -- {e}", exc_info=True)
+        if debug_to_stdout:
+            print(f"Queue processing failed: {q.slug}")
+            print("-" * 60)
+            traceback.print_exc(file=sys.stdout)
+    finally:
+        # we must close the file handler correctly if it's created
+        try:
+            if log_file_handler:
+                log_file_handler.close()
+        except Exception as e:
+            logging.exception(e)
+        try:
+            if log_file_handler:
+                logger.removeHandler(log_file_handler)
+        except Exception as e:
+            logging.exception(e)
+
+
+def purge_ingested_emails(q):
+    """Forget the e-mails ingested before the retention window."""
+    retention = timedelta(days=helpdesk_settings.HELPDESK_EMAIL_INGESTION_RETENTION)
+    IngestedEmail.objects.filter(
+        queue=q, ingested_at__lt=timezone.now() - retention
+    ).delete()
 
 
 def pop3_sync(q, logger, server):
@@ -160,7 +261,7 @@ def pop3_sync(q, logger, server):
 
         raw_content = server.retr(msgNum)[1]
         if type(raw_content[0]) is bytes:
-            full_message = "\n".join([elm.decode("utf-8") for elm in raw_content])
+            full_message = b"\n".join(raw_content)
         else:
             full_message = encoding.force_str("\n".join(raw_content), errors="replace")
         try:
@@ -192,6 +293,130 @@ def pop3_sync(q, logger, server):
     server.quit()
 
 
+IMAP_FETCH_UID_RE = re.compile(rb"\bUID (\d+)")
+
+
+def imap_uid_set(uids):
+    """Write sorted UIDs as an IMAP sequence set of ranges, eg "1:3,7"."""
+    ranges = []
+    for uid in uids:
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ",".join(
+        str(first) if first == last else "%d:%d" % (first, last)
+        for first, last in ranges
+    )
+
+
+def imap_uidvalidity(server):
+    """UIDVALIDITY of the selected folder, as reported when selecting it."""
+    try:
+        data = server.response("UIDVALIDITY")[1]
+        return int(data[0])
+    except (IndexError, TypeError, ValueError):
+        return None
+
+
+def imap_fetch_messages(server, uids):
+    """
+    Fetch the messages with the given UIDs in one UID FETCH, without setting
+    their \\Seen flag. Returns (uid, raw message) pairs.
+    """
+    data = server.uid("fetch", imap_uid_set(uids), "(UID RFC822.SIZE BODY.PEEK[])")[1]
+    messages = []
+    for item in data or []:
+        # each message is a (envelope, literal) tuple followed by b")"
+        if isinstance(item, tuple):
+            match = IMAP_FETCH_UID_RE.search(item[0])
+            if match:
+                messages.append((int(match.group(1)), item[1]))
+    return messages
+
+
+def imap_sync_messages(q, logger, server):
+    """
+    Process the messages that arrived in the selected IMAP folder since the
+    last sync of the queue. The UID of the last message processed is kept
+    on the queue with the UIDVALIDITY of the folder, so only newer messages
+    are searched for; all of them again if the folder's UIDs were reset.
+
+    Messages are fetched QUEUE_EMAIL_BOX_IMAP_BATCH_SIZE at a time, and the
+    ones processed are flagged as deleted and expunged once per batch. The
+    last UID only advances over messages processed without a gap, so the
+    messages left on the server after an error are searched for again.
+    """
+    uidvalidity = imap_uidvalidity(server)
+    last_uid = q.email_box_imap_last_uid or 0
+    if uidvalidity is None or uidvalidity != q.email_box_imap_uidvalidity:
+        last_uid = 0
+
+    new_uids = "%d:*" % (last_uid + 1)
+    data = server.uid("search", None, "UID", new_uids, "NOT", "DELETED")[1]
+    # "n:*" also matches the highest UID of the folder when it is below n
+    uids = sorted(
+        uid for uid in (int(uid) for uid in (data[0] or b"").split()) if uid > last_uid
+    )
+    logger.info("Received %d new messages from IMAP server" % len(uids))
+
+    batch_size = helpdesk_settings.QUEUE_EMAIL_BOX_IMAP_BATCH_SIZE
+    contiguous = True
+    for offset in range(0, len(uids), batch_size):
+        batch = uids[offset : offset + batch_size]
+        processed = []
+        try:
+            for uid, raw_message in imap_fetch_messages(server, batch):
+                logger.info("Processing message %s" % uid)
+                try:
+                    ticket = extract_email_metadata(
+                        message=raw_message, queue=q, logger=logger
+                    )
+                except IgnoreTicketException:
+                    logger.warning(
+                        "Message %s was ignored and will be left on IMAP server" % uid
+                    )
+                except DeleteIgnoredTicketException:
+                    processed.append(uid)
+                    logger.warning(
+                        "Message %s was ignored and deleted from IMAP server" % uid
+                    )
+                except TypeError as te:
+                    # Log the error with stacktrace to help identify what went wrong
+                    logger.error(
+                        f"Unexpected error processing message: {te}", exc_info=True
+                    )
+                else:
+                    if ticket:
+                        processed.append(uid)
+                        logger.info(
+                            "Successfully processed message %s, deleted from IMAP server"
+                            % uid
+                        )
+                    else:
+                        logger.warning(
+                            "Message %s was not successfully processed, and will be left on IMAP server"
+                            % uid
+                        )
+        finally:
+            # also when processing failed half way, so processed messages are
+            # neither left on the server nor processed again by the next run
+            if processed:
+                server.uid("store", imap_uid_set(processed), "+FLAGS", "\\Deleted")
+                server.expunge()
+            for uid in batch:
+                if not contiguous or uid not in processed:
+                    contiguous = False
+                    break
+                last_uid = uid
+            q.email_box_imap_uidvalidity = uidvalidity
+            q.email_box_imap_last_uid = last_uid
+            Queue.objects.filter(pk=q.pk).update(
+                email_box_imap_uidvalidity=uidvalidity,
+                email_box_imap_last_uid=last_uid,
+            )
+
+
 def imap_sync(q, logger, server):
     try:
         try:
@@ -221,44 +446,7 @@ def imap_sync(q, logger, server):
         sys.exit()
 
     try:
-        data = server.search(None, "NOT", "DELETED")[1]
-        if data:
-            msgnums = data[0].split()
-            logger.info("Received %d messages from IMAP server" % len(msgnums))
-            for num in msgnums:
-                logger.info("Processing message %s" % num)
-                data = server.fetch(num, "(RFC822)")[1]
-                full_message = encoding.force_str(data[0][1], errors="replace")
-                try:
-                    ticket = extract_email_metadata(
-                        message=full_message, queue=q, logger=logger
-                    )
-                except IgnoreTicketException:
-                    logger.warning(
-                        "Message %s was ignored and will be left on IMAP server" % num
-                    )
-                except DeleteIgnoredTicketException:
-                    server.store(num, "+FLAGS", "\\Deleted")
-                    logger.warning(
-                        "Message %s was ignored and deleted from IMAP server" % num
-                    )
-                except TypeError as te:
-                    # Log the error with stacktrace to help identify what went wrong
-                    logger.error(
-                        f"Unexpected error processing message: {te}", exc_info=True
-                    )
-                else:
-                    if ticket:
-                        server.store(num, "+FLAGS", "\\Deleted")
-                        logger.info(
-                            "Successfully processed message %s, deleted from IMAP server"
-                            % num
-                        )
-                    else:
-                        logger.warning(
-                            "Message %s was not successfully processed, and will be left on IMAP server"
-                            % num
-                        )
+        imap_sync_messages(q, logger, server)
     except imaplib.IMAP4.error:
         logger.error(
             "IMAP retrieve failed. Is the folder '%s' spelled correctly, and does it exist on the server?",
@@ -318,49 +506,7 @@ def imap_oauth_sync(q, logger, server):
         sys.exit()
 
     try:
-        data = server.search(None, "NOT", "DELETED")[1]
-        if data:
-            msgnums = data[0].split()
-            logger.info(f"Found {len(msgnums)} message(s) on IMAP server")
-            for num in msgnums:
-                logger.info(f"Processing message {num}")
-                data = server.fetch(num, "(RFC822)")[1]
-                full_message = encoding.force_str(data[0][1], errors="replace")
-
-                try:
-                    ticket = extract_email_metadata(
-                        message=full_message, queue=q, logger=logger
-                    )
-
-                except IgnoreTicketException as itex:
-                    logger.warning(f"Message {num} was ignored. {itex}")
-
-                except DeleteIgnoredTicketException:
-                    server.store(num, "+FLAGS", "\\Deleted")
-                    server.expunge()
-                    logger.warning(
-                        "Message %s was ignored and deleted from IMAP server" % num
-                    )
-
-                except TypeError as te:
-                    # Log the error with stacktrace to help identify what went wrong
-                    logger.error(
-                        f"Unexpected error processing message: {te}", exc_info=True
-                    )
-
-                else:
-                    if ticket:
-                        server.store(num, "+FLAGS", "\\Deleted")
-                        server.expunge()
-                        logger.info(
-                            "Successfully processed message %s, deleted from IMAP server"
-                            % num
-                        )
-                    else:
-                        logger.warning(
-                            "Message %s was not successfully processed, and will be left on IMAP server"
-                            % num
-                        )
+        imap_sync_messages(q, logger, server)
 
     except imaplib.IMAP4.error:
         logger.error(
@@ -373,7 +519,7 @@ def imap_oauth_sync(q, logger, server):
     server.logout()
 
 
-def process_queue(q, logger):
+def process_queue(q, logger, timeout=None):
     logger.info(
         f"***** {ctime()}: Begin processing mail for django-helpdesk queue: {q.title}"
     )
@@ -447,6 +593,7 @@ def process_queue(q, logger):
         server = mail_defaults[email_box_type][encryption]["init"](
             q.email_box_host or helpdesk_settings.QUEUE_EMAIL_BOX_HOST,
             int(q.email_box_port),
+            timeout=timeout,
         )
         logger.info("Attempting %s server login" % email_box_type.upper())
         mail_defaults[email_box_type]["sync"](q, logger, server)
@@ -461,8 +608,8 @@ def process_queue(q, logger):
         logger.info("Found %d messages in local mailbox directory" % len(mail))
         for i, m in enumerate(mail, 1):
             logger.info("Processing message %d" % i)
-            with open(m, "r") as f:
-                full_message = encoding.force_str(f.read(), errors="replace")
+            with open(m, "rb") as f:
+                full_message = f.read()
                 try:
                     ticket = extract_email_metadata(
                         message=full_message, queue=q, logger=logger
@@ -537,54 +684,72 @@ def is_autoreply(message):
 
 
 def create_ticket_cc(ticket, cc_list, logger):
+    """
+    Subscribe the To and Cc addresses of an e-mail to the updates of the
+    ticket, linking each to its user when exactly one active user has that
+    address. Runs a fixed number of queries however many addresses there
+    are, and returns the TicketCC of each address.
+    """
     if not cc_list:
         return []
-    # Local import to deal with non-defined / circular reference problem
-
-    new_ticket_ccs = []
-    from helpdesk.views.staff import subscribe_to_ticket_updates, User
 
+    emails = []
     for __, cced_email in cc_list:
         cced_email = cced_email.strip()
-        if cced_email == ticket.queue.email_address:
-            continue
+        if cced_email != ticket.queue.email_address and cced_email not in emails:
+            emails.append(cced_email)
+    if not emails:
+        return []
 
-        user_id = None
+    user_ids = {}
+    duplicated_emails = set()
+    for user_id, user_email in User.objects.filter(
+        email__in=emails, is_active=True
+    ).values_list("id", "email"):
+        if user_email in user_ids:
+            duplicated_emails.add(user_email)
+        user_ids[user_email] = user_id
+
+    existing_ccs = {
+        (ticket_cc.user_id, ticket_cc.email): ticket_cc
+        for ticket_cc in TicketCC.objects.filter(ticket=ticket, email__in=emails)
+    }
 
-        user_list = User.objects.filter(email=cced_email, is_active=True).values_list(
-            "id", flat=True
-        )
-        count = user_list.count()
-        if count == 0:
-            if getattr(
-                helpdesk_settings, "LOG_WARN_WHEN_CC_EMAIL_NOT_LINKED_TO_A_USER", False
-            ):
-                logger.warning(
-                    f"CC email address is not linked to an active user: {cced_email}"
-                )
-        elif count > 1:
+    ticket_ccs = []
+    new_ticket_ccs = []
+    for cced_email in emails:
+        user_id = None
+        if cced_email in duplicated_emails:
             if getattr(
                 helpdesk_settings,
                 "LOG_WARN_WHEN_CC_EMAIL_LINKED_TO_MORE_THAN_1_USER",
                 True,
             ):
                 logger.warning(f"{MULTIPLE_USERS_SAME_EMAIL_MSG}: {cced_email}")
-        else:
-            user_id = user_list[0]
+        elif cced_email in user_ids:
+            user_id = user_ids[cced_email]
+        elif getattr(
+            helpdesk_settings, "LOG_WARN_WHEN_CC_EMAIL_NOT_LINKED_TO_A_USER", False
+        ):
+            logger.warning(
+                f"CC email address is not linked to an active user: {cced_email}"
+            )
 
-        try:
-            ticket_cc = subscribe_to_ticket_updates(
-                ticket=ticket, user_id=user_id, email=cced_email
+        if (user_id, cced_email) in existing_ccs:
+            # Don't create duplicate entries for subscribers
+            ticket_ccs.append(existing_ccs[(user_id, cced_email)])
+        elif user_id is not None or len(cced_email) >= 5:
+            ticket_cc = TicketCC(
+                ticket=ticket, user_id=user_id, email=cced_email, can_view=True
             )
+            ticket_ccs.append(ticket_cc)
             new_ticket_ccs.append(ticket_cc)
-        except ValidationError:
-            pass
-
-    return new_ticket_ccs
+    TicketCC.objects.bulk_create(new_ticket_ccs)
+    return ticket_ccs
 
 
 def create_object_from_email_message(message, ticket_id, payload, files, logger):
-    ticket, previous_followup, new = None, None, False
+    new = False
     now = timezone.now()
 
     queue = payload["queue"]
@@ -594,35 +759,30 @@ def create_object_from_email_message(message, ticket_id, payload, files, logger)
     cc_list = getaddresses(message.get_all("Cc", []))
 
     message_id = message.get("Message-Id")
-    in_reply_to = message.get("In-Reply-To")
 
     if message_id:
         message_id = message_id.strip()
 
-    if in_reply_to:
-        in_reply_to = in_reply_to.strip()
-
-    if in_reply_to is not None:
-        try:
-            queryset = FollowUp.objects.filter(message_id=in_reply_to).order_by("-date")
-            if queryset.count() > 0:
-                previous_followup = queryset.first()
-                ticket = previous_followup.ticket
-        except FollowUp.DoesNotExist:
-            pass  # play along. The header may be wrong
-
-    if previous_followup is None and ticket_id is not None:
+    # The message ids this e-mail replies to, the most relevant first
+    parent_ids = MessageThread.parse_message_ids(message.get("In-Reply-To"))
+    references = MessageThread.parse_message_ids(message.get("References"))
+    reply_to_ids = list(parent_ids)
+    reply_to_ids += reversed(references[-MessageThread.MAX_REFERENCES :])
+
+    # The thread comes first, the tracking ID of the subject is the fallback
+    ticket = MessageThread.find_ticket(reply_to_ids)
+    if ticket is not None:
+        logger.info("Matched reply to ticket %s" % ticket.ticket)
+    elif ticket_id is not None:
         try:
             ticket = Ticket.objects.get(id=ticket_id)
         except Ticket.DoesNotExist:
             ticket = None
-        else:
-            new = False
-            # Check if the ticket has been merged to another ticket
-            if ticket.merged_to:
-                logger.info("Ticket has been merged to %s" % ticket.merged_to.ticket)
-                # Use the ticket in which it was merged to for next operations
-                ticket = ticket.merged_to
+    # Check if the ticket has been merged to another ticket
+    if ticket is not None and ticket.merged_to:
+        logger.info("Ticket has been merged to %s" % ticket.merged_to.ticket)
+        # Use the ticket in which it was merged to for next operations
+        ticket = ticket.merged_to
     # New issue, create a new <Ticket> instance
     if ticket is None:
         if not getattr(settings, "QUEUE_EMAIL_BOX_UPDATE_ONLY", False):
@@ -669,6 +829,17 @@ def create_object_from_email_message(message, ticket_id, payload, files, logger)
     f.save()
     logger.debug("Created new FollowUp for Ticket")
 
+    # replies to this e-mail go to this ticket, and so do the replies to the
+    # e-mail it answered, if that was about the ticket too
+    MessageThread.record(ticket, MessageThread.parse_message_ids(message_id), f)
+    if not new:
+        MessageThread.record(ticket, parent_ids)
+
+    ingested_email = payload.get("ingested_email")
+    if ingested_email is not None:
+        ingested_email.ticket = ticket
+        ingested_email.save()
+
     logger.info(
         "[%s-%s] %s"
         % (
@@ -724,70 +895,210 @@ def send_info_email(
         "X-Auto-Response-Suppress": "All",
         "Precedence": "auto_reply",
     }
-    if new:
-        ticket.send(
-            {
-                "submitter": ("newticket_submitter", context),
-                "new_ticket_cc": ("newticket_cc", context),
-                "ticket_cc": ("newticket_cc", context),
-            },
-            fail_silently=True,
-            extra_headers=extra_headers,
-        )
-    else:
-        context.update(comment=f.comment)
-        ticket.send(
-            {
-                "submitter": ("updated_submitter", context),
-                "assigned_to": ("updated_owner", context),
-            },
-            fail_silently=True,
-            extra_headers=extra_headers,
-        )
-        if queue.enable_notifications_on_email_events:
+    with email_session():
+        if new:
             ticket.send(
-                {"ticket_cc": ("updated_cc", context)},
+                {
+                    "submitter": ("newticket_submitter", context),
+                    "new_ticket_cc": ("newticket_cc", context),
+                    "ticket_cc": ("newticket_cc", context),
+                },
                 fail_silently=True,
                 extra_headers=extra_headers,
             )
+        else:
+            context.update(comment=f.comment)
+            ticket.send(
+                {
+                    "submitter": ("updated_submitter", context),
+                    "assigned_to": ("updated_owner", context),
+                },
+                fail_silently=True,
+                extra_headers=extra_headers,
+            )
+            if queue.enable_notifications_on_email_events:
+                ticket.send(
+                    {"ticket_cc": ("updated_cc", context)},
+                    fail_silently=True,
+                    extra_headers=extra_headers,
+                )
+
+
+TRACKING_ID_CACHE_KEY = "helpdesk_email_tracking_id_queues"
 
 
-def get_ticket_id_from_subject_slug(
-    queue_slug: str, subject: str, logger: logging.Logger
-) -> typing.Optional[int]:
-    """Get a ticket id from the subject string
+@lru_cache(maxsize=8)
+def compile_tracking_id_pattern(slugs: typing.Tuple[str, ...]) -> re.Pattern:
+    # longest slugs first, so that "[it-support-1]" is not matched as "it"
+    alternation = "|".join(
+        re.escape(slug) for slug in sorted(slugs, key=len, reverse=True)
+    )
+    return re.compile(r"\[(?P<slug>%s)-(?P<id>\d+)\]" % alternation)
+
 
-    Performs a match on the subject using the queue_slug as reference,
-    returning the ticket id if a match is found.
+def get_tracking_id_queues() -> dict:
     """
-    matchobj = re.match(r".*\[" + queue_slug + r"-(?P<id>\d+)\]", subject)
-    ticket_id = None
-    if matchobj:
-        # This is a reply or forward.
-        ticket_id = matchobj.group("id")
-        logger.info("Matched tracking ID %s-%s" % (queue_slug, ticket_id))
-    else:
-        logger.info("No tracking ID matched.")
-    return ticket_id
+    Map the slug of every queue to whether it has a mailbox, cached until a
+    queue is saved or deleted.
+    """
+    queues = cache.get(TRACKING_ID_CACHE_KEY)
+    if queues is None:
+        queues = {
+            slug: email_box_type is not None
+            for slug, email_box_type in Queue.objects.values_list(
+                "slug", "email_box_type"
+            )
+        }
+        cache.set(TRACKING_ID_CACHE_KEY, queues, None)
+    return queues
+
+
+# listeners are loaded via app.py HelpdeskConfig.ready()
+@receiver(post_save, sender=Queue)
+@receiver(post_delete, sender=Queue)
+def clear_tracking_id_queues(sender, **kwargs):
+    cache.delete(TRACKING_ID_CACHE_KEY)
 
 
-def add_file_if_always_save_incoming_email_message(files_, message: str) -> None:
+IGNORE_EMAIL_CACHE_KEY = "helpdesk_email_ignore_rules"
+
+
+def get_ignore_rules() -> dict:
+    """
+    Index the IgnoreEmail rules by queue id (None for the rules of all
+    queues), then by (local part, domain) pattern, keeping the id and
+    keep_in_mailbox flag of the first rule of each pattern. Cached until a
+    rule is changed.
+    """
+    rules = cache.get(IGNORE_EMAIL_CACHE_KEY)
+    if rules is None:
+        rules = {}
+        for ignore in IgnoreEmail.objects.order_by("pk").prefetch_related("queues"):
+            key = ignore.get_match_key()
+            for queue_id in [q.pk for q in ignore.queues.all()] or [None]:
+                rules.setdefault(queue_id, {}).setdefault(
+                    key, (ignore.pk, ignore.keep_in_mailbox)
+                )
+        cache.set(IGNORE_EMAIL_CACHE_KEY, rules, None)
+    return rules
+
+
+def get_ignore_rule(queue: Queue, email_address: str) -> typing.Optional[tuple]:
+    """
+    Return the (id, keep_in_mailbox) of the first IgnoreEmail rule of the
+    queue matching the address, or None. Only looks up the few patterns
+    that can match the address, however many rules there are.
+    """
+    rules = get_ignore_rules()
+    tables = [rules[scope] for scope in (None, queue.pk) if scope in rules]
+    if not tables:
+        return None
+    matches = [
+        table[key]
+        for key in IgnoreEmail.get_lookup_keys(email_address)
+        for table in tables
+        if key in table
+    ]
+    return min(matches) if matches else None
+
+
+@receiver(post_save, sender=IgnoreEmail)
+@receiver(post_delete, sender=IgnoreEmail)
+@receiver(m2m_changed, sender=IgnoreEmail.queues.through)
+def clear_ignore_rules(sender, **kwargs):
+    cache.delete(IGNORE_EMAIL_CACHE_KEY)
+
+
+def get_ticket_id_from_subject(
+    queue: Queue, subject: str, logger: logging.Logger
+) -> typing.Tuple[Queue, typing.Optional[int]]:
+    """
+    Find the tracking ID ("[slug-id]") of a ticket in the subject.
+
+    All the queue slugs are matched at once in a single scan of the subject.
+    A tracking ID of the given queue wins over the ones of other queues,
+    which are only considered if they have a mailbox. Returns the queue of
+    the tracking ID (the given queue if none matched) and the ticket id.
+    """
+    queues = get_tracking_id_queues()
+    pattern = compile_tracking_id_pattern(tuple(sorted(set(queues) | {queue.slug})))
+    matches = {}
+    for match in pattern.finditer(subject):
+        # the last tracking ID of each queue, as replies pile up prefixes
+        matches[match.group("slug")] = int(match.group("id"))
+
+    if queue.slug in matches:
+        ticket_id = matches[queue.slug]
+        logger.info("Matched tracking ID %s-%s" % (queue.slug, ticket_id))
+        return queue, ticket_id
+    other_slugs = [slug for slug in matches if slug != queue.slug and queues[slug]]
+    if other_slugs:
+        other_queue = (
+            Queue.objects.filter(slug__in=other_slugs).order_by("title").first()
+        )
+        if other_queue is not None:
+            ticket_id = matches[other_queue.slug]
+            logger.info(
+                "Matched tracking ID %s-%s instead of current queue %s"
+                % (other_queue.slug, ticket_id, queue.slug)
+            )
+            return other_queue, ticket_id
+    logger.info("No tracking ID matched.")
+    return queue, None
+
+
+def add_file_if_always_save_incoming_email_message(
+    files_, message: typing.Union[str, bytes]
+) -> None:
     """When `settings.HELPDESK_ALWAYS_SAVE_INCOMING_EMAIL_MESSAGE` is `True`
     add a file to the files_ list"""
     if getattr(settings, "HELPDESK_ALWAYS_SAVE_INCOMING_EMAIL_MESSAGE", False):
         # save message as attachment in case of some complex markup renders
         # wrong
         files_.append(
-            SimpleUploadedFile(
+            get_email_attachment_file(
                 _("original_message.eml").replace(
                     ".eml", timezone.localtime().strftime("_%d-%m-%Y_%H:%M") + ".eml"
                 ),
-                str(message).encode("utf-8"),
+                message if isinstance(message, bytes) else str(message).encode("utf-8"),
                 "text/plain",
             )
         )
 
 
+def get_email_attachment_file(name: str, content: bytes, content_type: str):
+    """
+    Wrap the content of an email attachment as an uploaded file. Content
+    larger than settings.FILE_UPLOAD_MAX_MEMORY_SIZE is spooled to a
+    temporary file, as Django does for uploads, instead of being kept in
+    memory until the attachment is saved.
+    """
+    if len(content) <= settings.FILE_UPLOAD_MAX_MEMORY_SIZE:
+        return SimpleUploadedFile(name, content, content_type)
+    upload = TemporaryUploadedFile(name, content_type, len(content), None)
+    upload.write(content)
+    upload.seek(0)
+    return upload
+
+
+def get_min_payload_size(part: MIMEPart) -> int:
+    """
+    Lower bound of the decoded size of a (non multipart) MIME part, computed
+    from its transfer encoded payload so that it needs not be decoded.
+    """
+    payload = part.get_payload()
+    if not isinstance(payload, str):
+        return 0
+    transfer_encoding = part.get("Content-Transfer-Encoding", "").strip().lower()
+    if transfer_encoding == "base64":
+        # 4 characters per 3 bytes, leaving out the CRLF line breaks
+        return max(len(payload) - 2 * payload.count("\n"), 0) * 3 // 4
+    if transfer_encoding == "quoted-printable":
+        # at most 3 characters per byte
+        return len(payload) // 3
+    return len(payload)
+
+
 def get_encoded_body(body: str) -> str:
     try:
         return body.encode("ascii").decode("unicode_escape")
@@ -840,6 +1151,13 @@ def mime_content_to_string(
         charset == "utf-8" or charset is None
     ):
         charset = "unicode_escape"
+        if content_bytes and not content_bytes.isascii():
+            # Parsed from bytes, the payload holds the original UTF-8 bytes
+            # (parsed from a str, non ASCII characters come back escaped)
+            try:
+                return content_bytes.decode("utf-8")
+            except UnicodeDecodeError:
+                pass
     content = decodeUnknown(charset, content_bytes)
     return content
 
@@ -898,7 +1216,7 @@ def extract_email_message_content(
             formatted_body = f'<html><head><meta charset="utf-8" /></head>\
                                {mime_content if formatted_body is None else formatted_body}</html>'
         files.append(
-            SimpleUploadedFile(
+            get_email_attachment_file(
                 HTML_EMAIL_ATTACHMENT_FILENAME,
                 (mime_content if formatted_body is None else formatted_body).encode(
                     "utf-8"
@@ -950,11 +1268,26 @@ def process_as_attachment(
     else:
         ext = mimetypes.guess_extension(part.get_content_type())
         name = f"part-{counter}{ext}"
+    max_size = helpdesk_settings.HELPDESK_MAX_ATTACHMENT_SIZE
+    # Check the size before decoding the payload, big attachments are not
+    # worth the memory.
+    if not part.is_multipart() and get_min_payload_size(part) > max_size:
+        logger.warning(
+            "Attachment %s is larger than %s bytes and was not saved", name, max_size
+        )
+        return
     # Extract payload accounting for attached multiparts
     payload_bytes = (
         part.as_bytes() if part.is_multipart() else part.get_payload(decode=True)
     )
-    files.append(SimpleUploadedFile(name, payload_bytes, mimetypes.guess_type(name)[0]))
+    if payload_bytes is not None and len(payload_bytes) > max_size:
+        logger.warning(
+            "Attachment %s is larger than %s bytes and was not saved", name, max_size
+        )
+        return
+    files.append(
+        get_email_attachment_file(name, payload_bytes, mimetypes.guess_type(name)[0])
+    )
     if logger.isEnabledFor(logging.DEBUG):
         logger.debug("Processed MIME as attachment: %s", name)
     return
@@ -1039,8 +1372,57 @@ def extract_attachments(
     return (counter, content_parts_excluded)
 
 
+HEADER_END_RE = re.compile(rb"\r?\n\r?\n")
+
+
+def get_ingested_email(
+    message: typing.Union[str, bytes], message_obj: EmailMessage, queue: Queue
+) -> typing.Optional[IngestedEmail]:
+    """
+    Return the IngestedEmail ledger entry of an e-mail read from the mailbox
+    of the queue, identified by its Message-ID and the SHA-256 of its body:
+    the saved one if the e-mail was already processed, a new unsaved one
+    otherwise. E-mails without a Message-ID cannot be told apart from
+    identical ones and are not recorded.
+    """
+    message_ids = MessageThread.parse_message_ids(message_obj.get("Message-Id"))
+    if not message_ids:
+        return None
+    raw = message if isinstance(message, bytes) else message.encode("utf-8")
+    header_end = HEADER_END_RE.search(raw)
+    if header_end:
+        raw = raw[header_end.end() :]
+    ingested_email = IngestedEmail(
+        queue=queue,
+        message_id=message_ids[0],
+        content_hash=hashlib.sha256(raw).hexdigest(),
+    )
+    return (
+        IngestedEmail.objects.filter(
+            queue=queue,
+            message_id=ingested_email.message_id,
+            content_hash=ingested_email.content_hash,
+        )
+        .select_related("ticket")
+        .first()
+        or ingested_email
+    )
+
+
+def parse_email_message(message: typing.Union[str, bytes]) -> EmailMessage:
+    """
+    Parse an RFC822 message. Messages read from a mailbox should be given as
+    bytes: they are then parsed as is, each MIME part being decoded only
+    when needed according to its own charset and transfer encoding.
+    """
+    # NBot sure why but policy explicitly set to default is required for any messages with attachments in them
+    if isinstance(message, (bytes, bytearray)):
+        return email.message_from_bytes(message, EmailMessage, policy=policy.default)
+    return email.message_from_string(message, EmailMessage, policy=policy.default)
+
+
 def extract_email_metadata(
-    message: str, queue: Queue, logger: logging.Logger
+    message: typing.Union[str, bytes], queue: Queue, logger: logging.Logger
 ) -> Ticket:
     """
     Extracts the text/plain  mime part if there is one as the ticket description and
@@ -1061,15 +1443,12 @@ def extract_email_metadata(
     There may be a case for trying to exclude repeated signature images by checking if an
     attachment of the same name already exists as an attachment on the ticket but that is
     not implemented.
-    :param message: the raw email message received
+    :param message: the raw email message received, preferably as bytes
     :param queue: the queue that the message is assigned to
     :param logger: the logger to be used
     """
     # 'message' must be an RFC822 formatted message to correctly parse.
-    # NBot sure why but policy explicitly set to default is required for any messages with attachments in them
-    message_obj: EmailMessage = email.message_from_string(
-        message, EmailMessage, policy=policy.default
-    )
+    message_obj: EmailMessage = parse_email_message(message)
 
     subject = extract_email_subject(message_obj)
 
@@ -1082,46 +1461,25 @@ def extract_email_metadata(
         # Since the spec requires that all email addresses are ASCII, they will not be encoded
         sender_email = email.utils.parseaddr(sender_hdr)[1]
 
-    for ignore in IgnoreEmail.objects.filter(Q(queues=queue) | Q(queues__isnull=True)):
-        if ignore.test(sender_email):
-            raise (
-                IgnoreTicketException()
-                if ignore.keep_in_mailbox
-                else DeleteIgnoredTicketException()
-            )
-
-    # First try to get ticket ID from the current queue's slug
-    ticket_id: typing.Optional[int] = get_ticket_id_from_subject_slug(
-        queue.slug, subject, logger
-    )
-
-    # If no ticket ID found in the current queue, check all other queues
-    original_queue = queue  # Store the original queue in case we need to revert
-    if ticket_id is None:
-        # Get all enabled queues except the current one, regardless of allow_email_submission
-        other_queues = Queue.objects.exclude(id=queue.id).filter(
-            email_box_type__isnull=False
+    ignore_rule = get_ignore_rule(queue, sender_email)
+    if ignore_rule is not None:
+        keep_in_mailbox = ignore_rule[1]
+        raise (
+            IgnoreTicketException()
+            if keep_in_mailbox
+            else DeleteIgnoredTicketException()
         )
 
-        for other_queue in other_queues:
-            ticket_id = get_ticket_id_from_subject_slug(
-                other_queue.slug, subject, logger
-            )
-            if ticket_id is not None:
-                # Found a matching ticket in another queue, use that queue instead
-                logger.info(
-                    f"Found ticket {ticket_id} matching subject in queue {other_queue.slug} "
-                    f"instead of current queue {queue.slug}"
-                )
-                queue = other_queue
-                break
+    ingested_email = get_ingested_email(message, message_obj, queue)
+    if ingested_email is not None and ingested_email.pk:
+        # Left in the mailbox by a run that failed after creating the ticket
+        logger.info("Message %s was already processed" % ingested_email.message_id)
+        if ingested_email.ticket is None:
+            raise DeleteIgnoredTicketException()
+        return ingested_email.ticket
 
-        # If no ticket ID was found in any queue, revert to the original queue for new ticket
-        if ticket_id is None:
-            queue = original_queue
-            logger.info(
-                f"No existing ticket found, reverting to original queue {queue.slug}"
-            )
+    # The tracking ID may belong to another queue, the ticket then stays there
+    queue, ticket_id = get_ticket_id_from_subject(queue, subject, logger)
 
     files = []
     # first message in thread, we save full body to avoid losing forwards and things like that
@@ -1171,8 +1529,14 @@ def extract_email_metadata(
         "sender_email": sender_email,
         "priority": priority,
         "files": files,
+        "ingested_email": ingested_email,
     }
 
-    return create_object_from_email_message(
-        message_obj, ticket_id, payload, files, logger=logger
-    )
+    try:
+        return create_object_from_email_message(
+            message_obj, ticket_id, payload, files, logger=logger
+        )
+    finally:
+        # removes the attachments spooled to temporary files
+        for file in files:
+            file.close()
@@ -11,14 +11,13 @@ from datetime import datetime
 from django import forms
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from django.core.exceptions import ValidationError
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django.contrib.auth.forms import SetPasswordForm
 from django.contrib.auth.forms import UserCreationForm
 from helpdesk import settings as helpdesk_settings
 from helpdesk.lib import (
-    convert_value,
     process_attachments,
     safe_template_context,
     get_assignable_users,
@@ -322,32 +321,33 @@ class EditTicketForm(CustomFieldMixin, forms.ModelForm):
             "This ticket is merged into the selected ticket."
         )
 
-        for field in CustomField.objects.all():
-            initial_value = None
+        current_values = dict(
+            TicketCustomFieldValue.objects.filter(ticket=self.instance).values_list(
+                "field_id", "value"
+            )
+        )
+        for field in CustomField.objects.get_cached():
+            initial_value = current_values.get(field.id)
             try:
-                current_value = TicketCustomFieldValue.objects.get(
-                    ticket=self.instance, field=field
-                )
-                initial_value = current_value.value
                 # Attempt to convert from fixed format string to date/time data
                 # type
-                if "datetime" == current_value.field.data_type:
+                if "datetime" == field.data_type:
                     initial_value = datetime.strptime(
                         initial_value, CUSTOMFIELD_DATETIME_FORMAT
                     )
-                elif "date" == current_value.field.data_type:
+                elif "date" == field.data_type:
                     initial_value = datetime.strptime(
                         initial_value, CUSTOMFIELD_DATE_FORMAT
                     )
-                elif "time" == current_value.field.data_type:
+                elif "time" == field.data_type:
                     initial_value = datetime.strptime(
                         initial_value, CUSTOMFIELD_TIME_FORMAT
                     )
                 # If it is boolean field, transform the value to a real boolean
                 # instead of a string
-                elif "boolean" == current_value.field.data_type:
+                elif "boolean" == field.data_type and field.id in current_values:
                     initial_value = "True" == initial_value
-            except (TicketCustomFieldValue.DoesNotExist, ValueError, TypeError):
+            except (ValueError, TypeError):
                 # ValueError error if parsing fails, using initial_value = current_value.value
                 # TypeError if parsing None type
                 pass
@@ -361,21 +361,7 @@ class EditTicketForm(CustomFieldMixin, forms.ModelForm):
             self.customfield_to_field(field, instanceargs)
 
     def save(self, *args, **kwargs):
-        for field, value in self.cleaned_data.items():
-            if field.startswith("custom_"):
-                field_name = field.replace("custom_", "", 1)
-                customfield = CustomField.objects.get(name=field_name)
-                try:
-                    cfv = TicketCustomFieldValue.objects.get(
-                        ticket=self.instance, field=customfield
-                    )
-                except ObjectDoesNotExist:
-                    cfv = TicketCustomFieldValue(
-                        ticket=self.instance, field=customfield
-                    )
-
-                cfv.value = convert_value(value)
-                cfv.save()
+        self.instance.save_custom_field_values(self.cleaned_data)
 
         return super(EditTicketForm, self).save(*args, **kwargs)
 
@@ -525,12 +511,11 @@ class AbstractTicketForm(CustomFieldMixin, forms.Form):
                 )
 
     def _add_form_custom_fields(self, staff_only_filter=None):
-        if staff_only_filter is None:
-            queryset = CustomField.objects.all()
-        else:
-            queryset = CustomField.objects.filter(staff_only=staff_only_filter)
+        fields = CustomField.objects.get_cached()
+        if staff_only_filter is not None:
+            fields = [f for f in fields if f.staff_only == staff_only_filter]
 
-        for field in queryset:
+        for field in fields:
             instanceargs = {
                 "label": field.label,
                 "help_text": field.help_text,
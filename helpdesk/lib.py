@@ -6,12 +6,14 @@ django-helpdesk - A Django powered ticket tracker for small enterprise.
 lib.py - Common functions (eg multipart e-mail)
 """
 
+import json
 import logging
 import mimetypes
 from datetime import date, datetime, time
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ValidationError, ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db.models.query import QuerySet
 from django.utils.encoding import smart_str
 from helpdesk import settings as helpdesk_settings
@@ -93,6 +95,47 @@ def safe_template_context(ticket):
     return context
 
 
+# Tags of the values restored by TemplateContextDecoder
+TEMPLATE_CONTEXT_TYPES = {
+    "__datetime__": datetime,
+    "__date__": date,
+    "__time__": time,
+}
+
+
+class TemplateContextEncoder(DjangoJSONEncoder):
+    """
+    Store a template context (see safe_template_context) as JSON, eg for
+    e-mails sent later on. Dates and times are tagged so that they are
+    restored by TemplateContextDecoder and can still be formatted by the
+    templates; any other object is stored as its text.
+    """
+
+    def default(self, o):
+        # datetime before date, as it is a subclass of it
+        for tag, value_type in TEMPLATE_CONTEXT_TYPES.items():
+            if isinstance(o, value_type):
+                return {tag: o.isoformat()}
+        try:
+            return super().default(o)
+        except TypeError:
+            return str(o)
+
+
+def decode_template_context_value(obj):
+    if len(obj) == 1:
+        tag, value = next(iter(obj.items()))
+        if tag in TEMPLATE_CONTEXT_TYPES and isinstance(value, str):
+            return TEMPLATE_CONTEXT_TYPES[tag].fromisoformat(value)
+    return obj
+
+
+class TemplateContextDecoder(json.JSONDecoder):
+    def __init__(self, *args, **kwargs):
+        kwargs["object_hook"] = decode_template_context_value
+        super().__init__(*args, **kwargs)
+
+
 def text_is_spam(text, request):
     # Based on a blog post by 'sciyoshi':
     # http://sciyoshi.com/blog/2008/aug/27/using-akismet-djangos-new-comments-framework/
@@ -15,6 +15,7 @@ from django.utils import timezone
 from django.utils.translation import gettext as _
 from helpdesk.lib import safe_template_context
 from helpdesk.models import EscalationExclusion, Queue, Ticket
+from helpdesk.templated_email import email_session
 
 
 class Command(BaseCommand):
@@ -56,59 +57,63 @@ class Command(BaseCommand):
         if verbose:
             self.stdout.write(f"Processing: {queues}")
 
-        for queue in queues:
-            last = date.today() - timedelta(days=queue.escalate_days)
-            today = date.today()
-            workdate = last
-
-            days = 0
-
-            while workdate < today:
-                if not EscalationExclusion.objects.filter(date=workdate).exists():
-                    days += 1
-                workdate = workdate + timedelta(days=1)
-
-            req_last_escl_date = timezone.now() - timedelta(days=days)
-
-            for ticket in (
-                queue.ticket_set.filter(status__in=Ticket.OPEN_STATUSES)
-                .exclude(priority=1)
-                .filter(Q(on_hold__isnull=True) | Q(on_hold=False))
-                .filter(
-                    Q(last_escalation__lte=req_last_escl_date)
-                    | Q(last_escalation__isnull=True, created__lte=req_last_escl_date)
-                )
-            ):
-                ticket.last_escalation = timezone.now()
-                ticket.priority -= 1
-                ticket.save()
-
-                context = safe_template_context(ticket)
-
-                ticket.send(
-                    {
-                        "submitter": ("escalated_submitter", context),
-                        "ticket_cc": ("escalated_cc", context),
-                        "assigned_to": ("escalated_owner", context),
-                    },
-                    fail_silently=True,
-                )
-
-                if verbose:
-                    self.stdout.write(
-                        f"  - Esclating {ticket.ticket} from {ticket.priority + 1}>{ticket.priority}"
+        with email_session():
+            for queue in queues:
+                last = date.today() - timedelta(days=queue.escalate_days)
+                today = date.today()
+                workdate = last
+
+                days = 0
+
+                while workdate < today:
+                    if not EscalationExclusion.objects.filter(date=workdate).exists():
+                        days += 1
+                    workdate = workdate + timedelta(days=1)
+
+                req_last_escl_date = timezone.now() - timedelta(days=days)
+
+                for ticket in (
+                    queue.ticket_set.filter(status__in=Ticket.OPEN_STATUSES)
+                    .exclude(priority=1)
+                    .filter(Q(on_hold__isnull=True) | Q(on_hold=False))
+                    .filter(
+                        Q(last_escalation__lte=req_last_escl_date)
+                        | Q(
+                            last_escalation__isnull=True,
+                            created__lte=req_last_escl_date,
+                        )
                     )
-
-                if not notify_only:
-                    followup = ticket.followup_set.create(
-                        title=_("Ticket Escalated"),
-                        public=True,
-                        comment=_("Ticket escalated after %(nb)s days")
-                        % {"nb": queue.escalate_days},
+                ):
+                    ticket.last_escalation = timezone.now()
+                    ticket.priority -= 1
+                    ticket.save()
+
+                    context = safe_template_context(ticket)
+
+                    ticket.send(
+                        {
+                            "submitter": ("escalated_submitter", context),
+                            "ticket_cc": ("escalated_cc", context),
+                            "assigned_to": ("escalated_owner", context),
+                        },
+                        fail_silently=True,
                     )
 
-                    followup.ticketchange_set.create(
-                        field=_("Priority"),
-                        old_value=ticket.priority + 1,
-                        new_value=ticket.priority,
-                    )
+                    if verbose:
+                        self.stdout.write(
+                            f"  - Esclating {ticket.ticket} from {ticket.priority + 1}>{ticket.priority}"
+                        )
+
+                    if not notify_only:
+                        followup = ticket.followup_set.create(
+                            title=_("Ticket Escalated"),
+                            public=True,
+                            comment=_("Ticket escalated after %(nb)s days")
+                            % {"nb": queue.escalate_days},
+                        )
+
+                        followup.ticketchange_set.create(
+                            field=_("Priority"),
+                            old_value=ticket.priority + 1,
+                            new_value=ticket.priority,
+                        )
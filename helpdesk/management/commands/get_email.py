@@ -36,11 +36,28 @@ class Command(BaseCommand):
             default=False,
             help="Log additional messaging to stdout.",
         )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of mailboxes polled at the same time (default: 1)",
+        )
+        parser.add_argument(
+            "--timeout",
+            type=float,
+            default=None,
+            help="Seconds to wait for a mail server before giving up on a queue",
+        )
 
     def handle(self, *args, **options):
         quiet = options.get("quiet")
         debug_to_stdout = options.get("debug_to_stdout")
-        process_email(quiet=quiet, debug_to_stdout=debug_to_stdout)
+        process_email(
+            quiet=quiet,
+            debug_to_stdout=debug_to_stdout,
+            workers=options.get("workers") or 1,
+            timeout=options.get("timeout"),
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,36 @@
+#!/usr/bin/python
+"""
+django-helpdesk - A Django powered ticket tracker for small enterprise.
+
+See LICENSE for details.
+
+rebuild_search_index.py - Re-index all tickets for the search engine set in
+                          settings.HELPDESK_SEARCH_BACKEND, eg after
+                          upgrading or switching engines.
+"""
+
+from django.core.management.base import BaseCommand
+from helpdesk.models import Ticket
+from helpdesk.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the ticket search index used by the configured "
+        "django-helpdesk search backend."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-q",
+            "--queues",
+            nargs="*",
+            help="Only re-index tickets in these queues. Enter the queues slug as space separated list.",
+        )
+
+    def handle(self, *args, **options):
+        tickets = Ticket.objects.all()
+        if options["queues"]:
+            tickets = tickets.filter(queue__slug__in=options["queues"])
+        count = get_search_backend().rebuild(tickets)
+        self.stdout.write(f"Re-indexed {count} tickets")
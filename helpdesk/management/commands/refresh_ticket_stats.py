@@ -0,0 +1,32 @@
+#!/usr/bin/python
+"""
+django-helpdesk - A Django powered ticket tracker for small enterprise.
+
+See LICENSE for details.
+
+refresh_ticket_stats.py - Update the daily ticket statistics used by the
+                          reports and the dashboard. Designed to be run
+                          from cron regularly, eg every 15 minutes.
+"""
+
+from django.core.management.base import BaseCommand
+from helpdesk.stats import refresh_ticket_stats
+
+
+class Command(BaseCommand):
+    help = (
+        "Update the daily ticket statistics with the tickets changed since "
+        "the last refresh."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            default=False,
+            help="Recompute the statistics of all tickets",
+        )
+
+    def handle(self, *args, **options):
+        nbr_dates = refresh_ticket_stats(full=options["full"])
+        self.stdout.write(f"Refreshed the statistics of {nbr_dates} days")
@@ -0,0 +1,29 @@
+#!/usr/bin/python
+"""
+django-helpdesk - A Django powered ticket tracker for small enterprise.
+
+See LICENSE for details.
+
+send_outbound_emails.py - Send the e-mail notifications waiting in the
+                          outbox (see HELPDESK_EMAIL_OUTBOX). Designed to
+                          be run from cron regularly, eg every minute.
+"""
+
+from django.core.management.base import BaseCommand
+from helpdesk.outbox import send_outbound_emails
+
+
+class Command(BaseCommand):
+    help = "Send the due e-mail notifications of the outbox."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--limit",
+            type=int,
+            default=None,
+            help="Maximum number of e-mails to send",
+        )
+
+    def handle(self, *args, **options):
+        nbr_sent = send_outbound_emails(limit=options["limit"])
+        self.stdout.write(f"Sent {nbr_sent} e-mails")
@@ -0,0 +1,38 @@
+#!/usr/bin/python
+"""
+django-helpdesk - A Django powered ticket tracker for small enterprise.
+
+See LICENSE for details.
+
+send_webhooks.py - Send the queued webhook deliveries and retry the failed
+                   ones (see HELPDESK_WEBHOOK_QUEUE). Designed to be run
+                   from cron regularly, eg every minute.
+"""
+
+from django.core.management.base import BaseCommand
+from helpdesk.webhooks import replay_failed_webhooks, send_webhooks
+
+
+class Command(BaseCommand):
+    help = "Send the due webhook deliveries."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--limit",
+            type=int,
+            default=None,
+            help="Maximum number of deliveries to send",
+        )
+        parser.add_argument(
+            "--replay",
+            action="store_true",
+            default=False,
+            help="Send the deliveries that failed all attempts again",
+        )
+
+    def handle(self, *args, **options):
+        if options["replay"]:
+            nbr_replayed = replay_failed_webhooks()
+            self.stdout.write(f"Replaying {nbr_replayed} failed deliveries")
+        nbr_sent = send_webhooks(limit=options["limit"])
+        self.stdout.write(f"Sent {nbr_sent} webhook deliveries")
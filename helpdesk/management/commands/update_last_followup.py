@@ -0,0 +1,42 @@
+#!/usr/bin/python
+"""
+django-helpdesk - A Django powered ticket tracker for small enterprise.
+
+See LICENSE for details.
+
+update_last_followup.py - Fill in the date of the most recent follow-up of
+                          each ticket, eg after upgrading to a version
+                          storing it on the ticket.
+"""
+
+from django.core.management.base import BaseCommand
+from django.db.models import OuterRef, Subquery
+from helpdesk.models import FollowUp, Ticket
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the last follow-up date stored on each ticket from its follow-ups."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-b",
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of tickets updated per query (default: 1000)",
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        last_followup = Subquery(
+            FollowUp.objects.filter(ticket=OuterRef("pk"))
+            .order_by("-date")
+            .values("date")[:1]
+        )
+        ids = list(Ticket.objects.order_by("id").values_list("id", flat=True))
+        for offset in range(0, len(ids), batch_size):
+            batch = ids[offset : offset + batch_size]
+            Ticket.objects.filter(id__in=batch).update(last_followup_at=last_followup)
+        self.stdout.write(f"Updated {len(ids)} tickets")
@@ -0,0 +1,53 @@
+# Generated by Django 4.2.30 on 2026-10-18 02:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("helpdesk", "0042_kbitem_allow_ticket_creation_alter_ticket_priority"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TicketSearchToken",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("token", models.CharField(max_length=64, verbose_name="Token")),
+                (
+                    "weight",
+                    models.PositiveIntegerField(default=1, verbose_name="Weight"),
+                ),
+                (
+                    "ticket",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="search_tokens",
+                        to="helpdesk.ticket",
+                        verbose_name="Ticket",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Ticket search token",
+                "verbose_name_plural": "Ticket search tokens",
+                "indexes": [
+                    models.Index(
+                        fields=["token", "ticket"],
+                        name="helpdesk_search_token_idx",
+                        opclasses=["varchar_pattern_ops", "int4_ops"],
+                    )
+                ],
+                "unique_together": {("ticket", "token")},
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.30 on 2026-10-18 03:04
+
+from django.db import migrations, models
+
+
+def fill_last_followup_at(apps, schema_editor):
+    """Store the date of the latest follow-up of the existing tickets."""
+    Ticket = apps.get_model("helpdesk", "Ticket")
+    FollowUp = apps.get_model("helpdesk", "FollowUp")
+    Ticket.objects.update(
+        last_followup_at=models.Subquery(
+            FollowUp.objects.filter(ticket=models.OuterRef("pk"))
+            .order_by("-date")
+            .values("date")[:1]
+        )
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("helpdesk", "0043_ticketsearchtoken"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="ticket",
+            name="last_followup_at",
+            field=models.DateTimeField(
+                blank=True,
+                db_index=True,
+                editable=False,
+                help_text="Date of the most recent follow-up - updated automatically when follow-ups are added, moved or deleted.",
+                null=True,
+                verbose_name="Last follow-up",
+            ),
+        ),
+        migrations.RunPython(fill_last_followup_at, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,141 @@
+# Generated by Django 4.2.30 on 2026-10-18 03:13
+
+import datetime
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("helpdesk", "0044_ticket_last_followup_at"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TicketStatsRefresh",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("refreshed_at", models.DateTimeField(verbose_name="Refreshed at")),
+                (
+                    "ticket_modified",
+                    models.DateTimeField(
+                        blank=True, null=True, verbose_name="Last ticket modification"
+                    ),
+                ),
+                (
+                    "followup_date",
+                    models.DateTimeField(
+                        blank=True, null=True, verbose_name="Last follow-up date"
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Ticket statistics refresh",
+                "verbose_name_plural": "Ticket statistics refreshes",
+            },
+        ),
+        migrations.CreateModel(
+            name="TicketDailyStat",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "date",
+                    models.DateField(
+                        help_text="Day the tickets were created on (UTC)",
+                        verbose_name="Date",
+                    ),
+                ),
+                (
+                    "status",
+                    models.IntegerField(
+                        choices=[
+                            (1, "Open"),
+                            (2, "Reopened"),
+                            (3, "Resolved"),
+                            (4, "Closed"),
+                            (5, "Duplicate"),
+                        ],
+                        verbose_name="Status",
+                    ),
+                ),
+                (
+                    "priority",
+                    models.IntegerField(
+                        choices=[
+                            (1, "1. Critical"),
+                            (2, "2. High"),
+                            (3, "3. Normal"),
+                            (4, "4. Low"),
+                        ],
+                        verbose_name="Priority",
+                    ),
+                ),
+                (
+                    "ticket_count",
+                    models.PositiveIntegerField(
+                        default=0, verbose_name="Number of tickets"
+                    ),
+                ),
+                (
+                    "days_open",
+                    models.IntegerField(
+                        default=0,
+                        help_text="Sum of the whole days between the creation and the last modification of each ticket.",
+                        verbose_name="Days open",
+                    ),
+                ),
+                (
+                    "time_spent",
+                    models.DurationField(
+                        default=datetime.timedelta(0),
+                        help_text="Sum of the time spent on the follow-ups of the tickets.",
+                        verbose_name="Time spent",
+                    ),
+                ),
+                (
+                    "assigned_to",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to=settings.AUTH_USER_MODEL,
+                        verbose_name="Assigned to",
+                    ),
+                ),
+                (
+                    "queue",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="helpdesk.queue",
+                        verbose_name="Queue",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Ticket daily statistic",
+                "verbose_name_plural": "Ticket daily statistics",
+                "unique_together": {
+                    ("date", "queue", "assigned_to", "status", "priority")
+                },
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-18 03:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("helpdesk", "0045_ticketdailystat_ticketstatsrefresh"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="queue",
+            name="email_box_locked_until",
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
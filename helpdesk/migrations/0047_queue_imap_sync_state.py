@@ -0,0 +1,22 @@
+# Generated by Django 4.2.30 on 2026-10-18 03:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("helpdesk", "0046_queue_email_box_locked_until"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="queue",
+            name="email_box_imap_last_uid",
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="queue",
+            name="email_box_imap_uidvalidity",
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,94 @@
+# Generated by Django 4.2.30 on 2026-10-18 03:35
+
+from django.db import migrations, models
+import django.db.models.deletion
+import re
+
+
+def index_followup_message_ids(apps, schema_editor):
+    """Index the Message-IDs of the e-mails received so far."""
+    FollowUp = apps.get_model("helpdesk", "FollowUp")
+    MessageThread = apps.get_model("helpdesk", "MessageThread")
+    followups = (
+        FollowUp.objects.exclude(message_id__isnull=True)
+        .exclude(message_id="")
+        .order_by("-date")
+        .values_list("id", "ticket_id", "message_id")
+    )
+    threads = []
+    # the latest follow-up of a message id wins, as it did before the index
+    for followup_id, ticket_id, message_id in followups.iterator():
+        message_ids = re.findall(r"<[^<>\s]+>", message_id) or [
+            "<%s>" % message_id.strip().strip("<>")
+        ]
+        threads.append(
+            MessageThread(
+                message_id=message_ids[0][:256],
+                ticket_id=ticket_id,
+                followup_id=followup_id,
+            )
+        )
+        if len(threads) >= 1000:
+            MessageThread.objects.bulk_create(threads, ignore_conflicts=True)
+            threads = []
+    MessageThread.objects.bulk_create(threads, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("helpdesk", "0047_queue_imap_sync_state"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MessageThread",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "message_id",
+                    models.CharField(
+                        max_length=256, unique=True, verbose_name="Message ID"
+                    ),
+                ),
+                (
+                    "outbound",
+                    models.BooleanField(
+                        default=False, verbose_name="Sent by the helpdesk?"
+                    ),
+                ),
+                (
+                    "followup",
+                    models.ForeignKey(
+                        blank=True,
+                        help_text="The follow-up created from the e-mail, if it was received.",
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        to="helpdesk.followup",
+                        verbose_name="Follow-up",
+                    ),
+                ),
+                (
+                    "ticket",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="message_threads",
+                        to="helpdesk.ticket",
+                        verbose_name="Ticket",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Message thread",
+                "verbose_name_plural": "Message threads",
+            },
+        ),
+        migrations.RunPython(index_followup_message_ids, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,74 @@
+# Generated by Django 4.2.30 on 2026-10-18 03:38
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("helpdesk", "0048_messagethread"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="IngestedEmail",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "message_id",
+                    models.CharField(
+                        blank=True, max_length=256, verbose_name="Message ID"
+                    ),
+                ),
+                (
+                    "content_hash",
+                    models.CharField(
+                        help_text="SHA-256 of the e-mail body, after its headers. E-mails without a Message-ID are not recorded.",
+                        max_length=64,
+                        verbose_name="Content hash",
+                    ),
+                ),
+                (
+                    "ingested_at",
+                    models.DateTimeField(
+                        db_index=True,
+                        default=django.utils.timezone.now,
+                        verbose_name="Ingested at",
+                    ),
+                ),
+                (
+                    "queue",
+                    models.ForeignKey(
+                        help_text="The queue whose mailbox the e-mail was read from.",
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="helpdesk.queue",
+                        verbose_name="Queue",
+                    ),
+                ),
+                (
+                    "ticket",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        to="helpdesk.ticket",
+                        verbose_name="Ticket",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Ingested e-mail",
+                "verbose_name_plural": "Ingested e-mails",
+                "unique_together": {("queue", "message_id", "content_hash")},
+            },
+        ),
+    ]
@@ -0,0 +1,103 @@
+# Generated by Django 4.2.30 on 2026-10-18 03:46
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import helpdesk.lib
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("helpdesk", "0049_ingestedemail"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="OutboundEmail",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "template_name",
+                    models.CharField(max_length=100, verbose_name="Template Name"),
+                ),
+                (
+                    "context",
+                    models.JSONField(
+                        decoder=helpdesk.lib.TemplateContextDecoder,
+                        encoder=helpdesk.lib.TemplateContextEncoder,
+                        verbose_name="Context",
+                    ),
+                ),
+                ("recipients", models.JSONField(verbose_name="Recipients")),
+                (
+                    "sender",
+                    models.CharField(blank=True, max_length=200, verbose_name="Sender"),
+                ),
+                ("bcc", models.JSONField(blank=True, null=True, verbose_name="BCC")),
+                (
+                    "extra_headers",
+                    models.JSONField(
+                        blank=True, default=dict, verbose_name="Extra headers"
+                    ),
+                ),
+                (
+                    "files",
+                    models.JSONField(
+                        blank=True,
+                        default=list,
+                        help_text="File names and storage paths of the attachments.",
+                        verbose_name="Files",
+                    ),
+                ),
+                (
+                    "created",
+                    models.DateTimeField(
+                        default=django.utils.timezone.now, verbose_name="Created"
+                    ),
+                ),
+                (
+                    "next_attempt",
+                    models.DateTimeField(
+                        db_index=True,
+                        default=django.utils.timezone.now,
+                        verbose_name="Next attempt",
+                    ),
+                ),
+                (
+                    "attempts",
+                    models.PositiveIntegerField(default=0, verbose_name="Attempts"),
+                ),
+                (
+                    "failed",
+                    models.BooleanField(
+                        default=False,
+                        help_text="Set once all attempts to send the e-mail failed.",
+                        verbose_name="Failed",
+                    ),
+                ),
+                ("last_error", models.TextField(blank=True, verbose_name="Last error")),
+                (
+                    "ticket",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        to="helpdesk.ticket",
+                        verbose_name="Ticket",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Outbound e-mail",
+                "verbose_name_plural": "Outbound e-mails",
+            },
+        ),
+    ]
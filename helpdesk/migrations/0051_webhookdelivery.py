@@ -0,0 +1,78 @@
+# Generated by Django 4.2.30 on 2026-10-18 03:57
+
+import django.core.serializers.json
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("helpdesk", "0050_outboundemail"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="WebhookDelivery",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("url", models.CharField(max_length=1000, verbose_name="URL")),
+                (
+                    "payload",
+                    models.JSONField(
+                        encoder=django.core.serializers.json.DjangoJSONEncoder,
+                        verbose_name="Payload",
+                    ),
+                ),
+                (
+                    "created",
+                    models.DateTimeField(
+                        default=django.utils.timezone.now, verbose_name="Created"
+                    ),
+                ),
+                (
+                    "next_attempt",
+                    models.DateTimeField(
+                        db_index=True,
+                        default=django.utils.timezone.now,
+                        verbose_name="Next attempt",
+                    ),
+                ),
+                (
+                    "attempts",
+                    models.PositiveIntegerField(default=0, verbose_name="Attempts"),
+                ),
+                (
+                    "failed",
+                    models.BooleanField(
+                        default=False,
+                        help_text="Set once all attempts to deliver the webhook failed.",
+                        verbose_name="Failed",
+                    ),
+                ),
+                ("last_error", models.TextField(blank=True, verbose_name="Last error")),
+                (
+                    "ticket",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        to="helpdesk.ticket",
+                        verbose_name="Ticket",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Webhook delivery",
+                "verbose_name_plural": "Webhook deliveries",
+            },
+        ),
+    ]
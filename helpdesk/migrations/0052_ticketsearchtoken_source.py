@@ -0,0 +1,101 @@
+# Generated by Django 4.2.30 on 2026-10-18 04:30
+
+from collections import defaultdict
+from django.conf import settings
+from django.db import migrations, models
+import re
+
+
+TOKEN_RE = re.compile(r"\w+")
+
+
+def index_tickets(apps, schema_editor):
+    """
+    Fill the search index of the existing tickets, as the
+    'rebuild_search_index' command does.
+    """
+    backend = getattr(
+        settings,
+        "HELPDESK_SEARCH_BACKEND",
+        "helpdesk.search.InvertedIndexSearchBackend",
+    )
+    if backend != "helpdesk.search.InvertedIndexSearchBackend":
+        return
+    Ticket = apps.get_model("helpdesk", "Ticket")
+    FollowUp = apps.get_model("helpdesk", "FollowUp")
+    TicketCustomFieldValue = apps.get_model("helpdesk", "TicketCustomFieldValue")
+    TicketSearchToken = apps.get_model("helpdesk", "TicketSearchToken")
+
+    def tokens(ticket_id, source, document):
+        weights = defaultdict(int)
+        for text, weight in document:
+            for token in TOKEN_RE.findall(str(text or "").lower()):
+                weights[token[:64]] += weight
+        return [
+            TicketSearchToken(
+                ticket_id=ticket_id, source=source, token=token, weight=weight
+            )
+            for token, weight in weights.items()
+        ]
+
+    TicketSearchToken.objects.all().delete()
+    rows = []
+    for ticket in Ticket.objects.select_related("assigned_to").iterator():
+        document = [
+            (ticket.title, 10),
+            (ticket.submitter_email, 5),
+            (ticket.description, 2),
+            (ticket.resolution, 2),
+        ]
+        if ticket.assigned_to_id:
+            document.append((ticket.assigned_to.email, 5))
+        rows += tokens(ticket.pk, "", document)
+        if len(rows) >= 1000:
+            TicketSearchToken.objects.bulk_create(rows)
+            rows = []
+    for followup_id, ticket_id, title, comment in FollowUp.objects.values_list(
+        "id", "ticket_id", "title", "comment"
+    ).iterator():
+        rows += tokens(
+            ticket_id, "followup:%s" % followup_id, [(title, 1), (comment, 1)]
+        )
+        if len(rows) >= 1000:
+            TicketSearchToken.objects.bulk_create(rows)
+            rows = []
+    for ticket_id, field_id, value in TicketCustomFieldValue.objects.values_list(
+        "ticket_id", "field_id", "value"
+    ).iterator():
+        rows += tokens(ticket_id, "customfield:%s" % field_id, [(value, 3)])
+        if len(rows) >= 1000:
+            TicketSearchToken.objects.bulk_create(rows)
+            rows = []
+    TicketSearchToken.objects.bulk_create(rows)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("helpdesk", "0051_webhookdelivery"),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name="ticketsearchtoken",
+            unique_together=set(),
+        ),
+        migrations.AddField(
+            model_name="ticketsearchtoken",
+            name="source",
+            field=models.CharField(
+                blank=True,
+                default="",
+                help_text="Empty for the fields of the ticket itself, 'followup:<id>' or 'customfield:<field id>' otherwise.",
+                max_length=32,
+                verbose_name="Source",
+            ),
+        ),
+        migrations.AlterUniqueTogether(
+            name="ticketsearchtoken",
+            unique_together={("ticket", "source", "token")},
+        ),
+        migrations.RunPython(index_tickets, migrations.RunPython.noop),
+    ]
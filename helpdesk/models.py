@@ -7,16 +7,24 @@ models.py - Model (and hence database) definitions. This is the core of the
             helpdesk structure.
 """
 
-from .lib import format_time_spent, convert_value, daily_time_spent_calculation
-from .templated_email import send_templated_mail
+from .lib import (
+    format_time_spent,
+    convert_value,
+    daily_time_spent_calculation,
+    TemplateContextDecoder,
+    TemplateContextEncoder,
+)
+from .templated_email import email_session, send_templated_mail
 from .validators import validate_file_extension
 import datetime
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Permission
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
-from django.db import models
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, models, transaction
 from django.utils import timezone
 from django.utils.safestring import mark_safe
 from django.utils.translation import gettext, gettext_lazy as _
@@ -103,6 +111,22 @@ def get_markdown(text):
     )
 
 
+class QueueQuerySet(models.QuerySet):
+    def with_time_spent(self):
+        """Annotate each queue with the time spent on the follow-ups of its
+        tickets, as returned by Queue.time_spent, in the same query."""
+        return self.annotate(
+            total_time_spent=models.Subquery(
+                FollowUp.objects.filter(ticket__queue=models.OuterRef("pk"))
+                .order_by()
+                .values("ticket__queue")
+                .annotate(total=models.Sum("time_spent"))
+                .values("total"),
+                output_field=models.DurationField(),
+            )
+        )
+
+
 class Queue(models.Model):
     """
     A queue is a collection of tickets into what would generally be business
@@ -322,7 +346,28 @@ class Queue(models.Model):
         blank=True,
         null=True,
         editable=False,
-        # This is updated by management/commands/get_mail.py.
+        # This is updated by management/commands/get_email.py.
+    )
+
+    email_box_locked_until = models.DateTimeField(
+        blank=True,
+        null=True,
+        editable=False,
+        # Set by management/commands/get_email.py while the mailbox is polled.
+    )
+
+    email_box_imap_uidvalidity = models.BigIntegerField(
+        blank=True,
+        null=True,
+        editable=False,
+        # UIDVALIDITY of the IMAP folder when email_box_imap_last_uid was seen
+    )
+
+    email_box_imap_last_uid = models.BigIntegerField(
+        blank=True,
+        null=True,
+        editable=False,
+        # UID of the last IMAP message processed by get_email
     )
 
     socks_proxy_type = models.CharField(
@@ -395,6 +440,8 @@ class Queue(models.Model):
         help_text=_("Time to be spent on this Queue in total"), blank=True, null=True
     )
 
+    objects = QueueQuerySet.as_manager()
+
     def __str__(self):
         return "%s" % self.title
 
@@ -429,8 +476,11 @@ class Queue(models.Model):
     @property
     def time_spent(self):
         """Return back total time spent on the ticket. This is calculated value
-        based on total sum from all FollowUps
+        based on total sum from all FollowUps, unless it was already annotated
+        by QueueQuerySet.with_time_spent().
         """
+        if hasattr(self, "total_time_spent"):
+            return self.total_time_spent
         res = FollowUp.objects.filter(ticket__queue=self).aggregate(
             models.Sum("time_spent")
         )
@@ -649,6 +699,18 @@ class Ticket(models.Model):
         blank=True,
     )
 
+    last_followup_at = models.DateTimeField(
+        _("Last follow-up"),
+        blank=True,
+        null=True,
+        editable=False,
+        db_index=True,
+        help_text=_(
+            "Date of the most recent follow-up - updated automatically "
+            "when follow-ups are added, moved or deleted."
+        ),
+    )
+
     @property
     def time_spent(self):
         """Return back total time spent on the ticket. This is calculated value
@@ -684,6 +746,10 @@ class Ticket(models.Model):
 
         **kwargs are passed to send_templated_mail defined in templated_email.py
 
+        The notifications are sent over a single connection (see
+        email_session in templated_email.py). With HELPDESK_EMAIL_OUTBOX, they
+        are added to the outbox (see OutboundEmail) instead.
+
         returns the set of email addresses the notification was delivered to.
 
         """
@@ -697,26 +763,35 @@ class Ticket(models.Model):
         def should_receive(email):
             return email and email not in recipients
 
+        # With the outbox, the notifications are only stored here and
+        # rendered and sent in the background.
+        outbox = [] if helpdesk_settings.HELPDESK_EMAIL_OUTBOX else None
+
         def send(role, recipient):
             if recipient and recipient not in recipients and role in roles:
                 template, context = roles[role]
-                send_templated_mail(
-                    template,
-                    context,
-                    recipient,
-                    sender=self.queue.from_address,
-                    **kwargs,
-                )
+                mail_kwargs = dict(kwargs, sender=self.queue.from_address, ticket=self)
+                if outbox is None:
+                    send_templated_mail(template, context, recipient, **mail_kwargs)
+                else:
+                    outbox.append(
+                        OutboundEmail.from_template(
+                            template, context, recipient, **mail_kwargs
+                        )
+                    )
                 recipients.add(recipient)
 
-        send("submitter", self.submitter_email)
-        send("ticket_cc", self.queue.updated_ticket_cc)
-        send("new_ticket_cc", self.queue.new_ticket_cc)
-        if self.assigned_to:
-            send("assigned_to", self.assigned_to.email)
-        if self.queue.enable_notifications_on_email_events:
-            for cc in self.ticketcc_set.all():
-                send("ticket_cc", cc.email_address)
+        with email_session():
+            send("submitter", self.submitter_email)
+            send("ticket_cc", self.queue.updated_ticket_cc)
+            send("new_ticket_cc", self.queue.new_ticket_cc)
+            if self.assigned_to:
+                send("assigned_to", self.assigned_to.email)
+            if self.queue.enable_notifications_on_email_events:
+                for cc in self.ticketcc_set.all():
+                    send("ticket_cc", cc.email_address)
+        if outbox:
+            OutboundEmail.enqueue(outbox)
         return recipients
 
     def _get_assigned_to(self):
@@ -898,6 +973,24 @@ class Ticket(models.Model):
 
         super(Ticket, self).save(*args, **kwargs)
 
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        if update_fields is None:
+            # last_followup_at is written by the follow-ups only, so that an
+            # instance loaded before a new follow-up cannot put back an
+            # older date. A ticket whose row is gone is still inserted whole.
+            values = [value for value in values if value[0].name != "last_followup_at"]
+        return super()._do_update(
+            base_qs, using, pk_val, values, update_fields, forced_update
+        )
+
+    def update_last_followup_at(self):
+        """Recompute last_followup_at from the follow-ups stored in the database,
+        eg after follow-ups have been moved or deleted in bulk."""
+        self.last_followup_at = self.followup_set.aggregate(models.Max("date"))[
+            "date__max"
+        ]
+        Ticket.objects.filter(pk=self.pk).update(last_followup_at=self.last_followup_at)
+
     @staticmethod
     def queue_and_id_from_query(query):
         # Apply the opposite logic here compared to self._get_ticket_for_url
@@ -955,25 +1048,78 @@ class Ticket(models.Model):
                 ticketcc = self.ticketcc_set.create(email=email)
             return ticketcc
 
+    @staticmethod
+    def load_custom_field_values(tickets):
+        """
+        Set the custom_<name> attribute of each given ticket, reading the
+        values of all of them in a single query.
+        """
+        fields = CustomField.objects.get_cached()
+        if not fields or not tickets:
+            values = {}
+        else:
+            values = {
+                (ticket_id, field_id): value
+                for ticket_id, field_id, value in TicketCustomFieldValue.objects.filter(
+                    ticket__in=[ticket.pk for ticket in tickets]
+                ).values_list("ticket_id", "field_id", "value")
+            }
+        for ticket in tickets:
+            for field in fields:
+                setattr(
+                    ticket, "custom_%s" % field.name, values.get((ticket.pk, field.id))
+                )
+
     def set_custom_field_values(self):
-        for field in CustomField.objects.all():
-            try:
-                value = self.ticketcustomfieldvalue_set.get(field=field).value
-            except TicketCustomFieldValue.DoesNotExist:
-                value = None
-            setattr(self, "custom_%s" % field.name, value)
+        Ticket.load_custom_field_values([self])
 
     def save_custom_field_values(self, data):
+        """
+        Save the custom_<name> values found in `data`, reading the current
+        values of the ticket in one query and writing the new and changed
+        ones in bulk.
+        """
+        values = {}
         for field, value in data.items():
             if field.startswith("custom_"):
                 field_name = field.replace("custom_", "", 1)
-                customfield = CustomField.objects.get(name=field_name)
-                cfv, created = self.ticketcustomfieldvalue_set.get_or_create(
-                    field=customfield, defaults={"value": convert_value(value)}
+                customfield = CustomField.objects.get_cached_by_name(field_name)
+                values[customfield.id] = convert_value(value)
+        if not values:
+            return
+
+        current_values = {
+            cfv.field_id: cfv
+            for cfv in self.ticketcustomfieldvalue_set.filter(field_id__in=values)
+        }
+        new_values = []
+        changed_values = []
+        for field_id, value in values.items():
+            cfv = current_values.get(field_id)
+            if cfv is None:
+                new_values.append(
+                    TicketCustomFieldValue(ticket=self, field_id=field_id, value=value)
                 )
-                if not created:
-                    cfv.value = convert_value(value)
-                    cfv.save()
+            elif cfv.value != value:
+                cfv.value = value
+                changed_values.append(cfv)
+        if not new_values and not changed_values:
+            return
+        features = connection.features
+        upsert = {}
+        if features.supports_update_conflicts:
+            # A value added meanwhile by another request is overwritten.
+            upsert = {"update_conflicts": True, "update_fields": ["value"]}
+            if features.supports_update_conflicts_with_target:
+                # MySQL and MariaDB update on any unique conflict instead
+                upsert["unique_fields"] = ["ticket", "field"]
+        TicketCustomFieldValue.objects.bulk_create(new_values, **upsert)
+        TicketCustomFieldValue.objects.bulk_update(changed_values, ["value"])
+
+        # The bulk writes send no post_save signal.
+        from .search import get_search_backend
+
+        get_search_backend().index_related(self, new_values + changed_values)
 
 
 class FollowUpManager(models.Manager):
@@ -1071,6 +1217,7 @@ class FollowUp(models.Model):
         return "%s#followup%s" % (self.ticket.get_absolute_url(), self.id)
 
     def save(self, *args, **kwargs):
+        adding = self._state.adding
         self.ticket.modified = timezone.now()
         self.ticket.save()
 
@@ -1079,6 +1226,21 @@ class FollowUp(models.Model):
 
         super(FollowUp, self).save(*args, **kwargs)
 
+        if adding:
+            updated = (
+                Ticket.objects.filter(pk=self.ticket_id)
+                .filter(
+                    models.Q(last_followup_at__isnull=True)
+                    | models.Q(last_followup_at__lt=self.date)
+                )
+                .update(last_followup_at=self.date)
+            )
+            if updated:
+                self.ticket.last_followup_at = self.date
+        else:
+            # the date of an existing follow-up may have been changed
+            self.ticket.update_last_followup_at()
+
     def get_markdown(self):
         return get_markdown(self.comment)
 
@@ -1174,6 +1336,387 @@ class FollowUp(models.Model):
         return datetime.timedelta(seconds=time_spent_seconds)
 
 
+def update_ticket_last_followup_at(sender, instance, **kwargs):
+    """
+    Keep Ticket.last_followup_at current once one of its follow-ups has been
+    deleted.
+    """
+    Ticket.objects.filter(pk=instance.ticket_id).update(
+        last_followup_at=models.Subquery(
+            FollowUp.objects.filter(ticket=models.OuterRef("pk"))
+            .order_by("-date")
+            .values("date")[:1]
+        )
+    )
+
+
+models.signals.post_delete.connect(update_ticket_last_followup_at, sender=FollowUp)
+
+
+class MessageThread(models.Model):
+    """
+    Index of the Message-IDs of the e-mails about a ticket: the ones
+    received, the ones replies to the ticket answered and the ones sent by
+    the helpdesk. A reply is matched to its ticket through its In-Reply-To
+    and References headers, before the tracking ID in its subject.
+    """
+
+    message_id = models.CharField(
+        _("Message ID"),
+        max_length=256,
+        unique=True,
+    )
+
+    ticket = models.ForeignKey(
+        Ticket,
+        on_delete=models.CASCADE,
+        verbose_name=_("Ticket"),
+        related_name="message_threads",
+    )
+
+    followup = models.ForeignKey(
+        FollowUp,
+        on_delete=models.SET_NULL,
+        verbose_name=_("Follow-up"),
+        blank=True,
+        null=True,
+        help_text=_("The follow-up created from the e-mail, if it was received."),
+    )
+
+    outbound = models.BooleanField(
+        _("Sent by the helpdesk?"),
+        default=False,
+    )
+
+    # Message ids found in a header, eg "<a@example.com> <b@example.com>"
+    MESSAGE_ID_RE = re.compile(r"<[^<>\s]+>")
+
+    # Most recent References looked up to match a reply
+    MAX_REFERENCES = 50
+
+    def __str__(self):
+        return "%s / %s" % (self.ticket_id, self.message_id)
+
+    class Meta:
+        verbose_name = _("Message thread")
+        verbose_name_plural = _("Message threads")
+
+    @classmethod
+    def parse_message_ids(cls, header):
+        """
+        Return the message ids of an In-Reply-To or References header, in
+        the order they appear, as "<id>" strings.
+        """
+        if not header:
+            return []
+        header = str(header)
+        message_ids = cls.MESSAGE_ID_RE.findall(header)
+        if not message_ids and header.strip():
+            # some clients leave out the angle brackets
+            message_ids = ["<%s>" % header.strip().strip("<>")]
+        max_length = cls._meta.get_field("message_id").max_length
+        return [
+            message_id for message_id in message_ids if len(message_id) <= max_length
+        ]
+
+    @classmethod
+    def record(cls, ticket, message_ids, followup=None, outbound=False):
+        """
+        Map the given message ids to the ticket, keeping the ticket of the
+        ones already known.
+        """
+        cls.objects.bulk_create(
+            [
+                cls(
+                    message_id=message_id,
+                    ticket=ticket,
+                    followup=followup,
+                    outbound=outbound,
+                )
+                for message_id in dict.fromkeys(message_ids)
+            ],
+            ignore_conflicts=True,
+        )
+
+    @classmethod
+    def find_ticket(cls, message_ids):
+        """
+        Return the ticket of the first of the given message ids that is
+        known, in one query.
+        """
+        if not message_ids:
+            return None
+        threads = {
+            thread.message_id: thread
+            for thread in cls.objects.filter(message_id__in=message_ids)
+            .select_related("ticket")
+        }
+        for message_id in message_ids:
+            if message_id in threads:
+                return threads[message_id].ticket
+        return None
+
+
+class IngestedEmail(models.Model):
+    """
+    Ledger of the e-mails turned into tickets or follow-ups, per mailbox
+    queue. When a message could not be deleted from the mailbox (eg the
+    connection dropped after the ticket was created), polling it again
+    finds it here instead of creating a duplicate ticket.
+
+    Entries are removed by get_email once they are older than
+    HELPDESK_EMAIL_INGESTION_RETENTION days.
+    """
+
+    queue = models.ForeignKey(
+        Queue,
+        on_delete=models.CASCADE,
+        verbose_name=_("Queue"),
+        help_text=_("The queue whose mailbox the e-mail was read from."),
+    )
+
+    message_id = models.CharField(
+        _("Message ID"),
+        max_length=256,
+        blank=True,
+    )
+
+    content_hash = models.CharField(
+        _("Content hash"),
+        max_length=64,
+        help_text=_(
+            "SHA-256 of the e-mail body, after its headers. E-mails without a "
+            "Message-ID are not recorded."
+        ),
+    )
+
+    ticket = models.ForeignKey(
+        Ticket,
+        on_delete=models.SET_NULL,
+        verbose_name=_("Ticket"),
+        blank=True,
+        null=True,
+    )
+
+    ingested_at = models.DateTimeField(
+        _("Ingested at"),
+        default=timezone.now,
+        db_index=True,
+    )
+
+    def __str__(self):
+        return "%s / %s" % (self.queue_id, self.message_id or self.content_hash)
+
+    class Meta:
+        unique_together = (("queue", "message_id", "content_hash"),)
+        verbose_name = _("Ingested e-mail")
+        verbose_name_plural = _("Ingested e-mails")
+
+
+class OutboundEmail(models.Model):
+    """
+    A notification waiting in the outbox (see HELPDESK_EMAIL_OUTBOX). It
+    holds the arguments of send_templated_mail(), which is called once the
+    e-mail is due by the 'send_outbound_emails' command or Celery task.
+    E-mails are deleted once sent; those that could not be sent after
+    HELPDESK_EMAIL_OUTBOX_MAX_ATTEMPTS attempts are kept, marked as failed.
+    """
+
+    ticket = models.ForeignKey(
+        Ticket,
+        on_delete=models.SET_NULL,
+        verbose_name=_("Ticket"),
+        blank=True,
+        null=True,
+    )
+
+    template_name = models.CharField(
+        _("Template Name"),
+        max_length=100,
+    )
+
+    context = models.JSONField(
+        _("Context"),
+        encoder=TemplateContextEncoder,
+        decoder=TemplateContextDecoder,
+    )
+
+    recipients = models.JSONField(
+        _("Recipients"),
+    )
+
+    sender = models.CharField(
+        _("Sender"),
+        max_length=200,
+        blank=True,
+    )
+
+    bcc = models.JSONField(
+        _("BCC"),
+        blank=True,
+        null=True,
+    )
+
+    extra_headers = models.JSONField(
+        _("Extra headers"),
+        blank=True,
+        default=dict,
+    )
+
+    files = models.JSONField(
+        _("Files"),
+        blank=True,
+        default=list,
+        help_text=_("File names and storage paths of the attachments."),
+    )
+
+    created = models.DateTimeField(
+        _("Created"),
+        default=timezone.now,
+    )
+
+    next_attempt = models.DateTimeField(
+        _("Next attempt"),
+        default=timezone.now,
+        db_index=True,
+    )
+
+    attempts = models.PositiveIntegerField(
+        _("Attempts"),
+        default=0,
+    )
+
+    failed = models.BooleanField(
+        _("Failed"),
+        default=False,
+        help_text=_("Set once all attempts to send the e-mail failed."),
+    )
+
+    last_error = models.TextField(
+        _("Last error"),
+        blank=True,
+    )
+
+    def __str__(self):
+        return "%s to %s" % (self.template_name, self.recipients)
+
+    @classmethod
+    def from_template(
+        cls,
+        template_name,
+        context,
+        recipients,
+        sender=None,
+        bcc=None,
+        fail_silently=False,
+        files=None,
+        extra_headers=None,
+        ticket=None,
+    ):
+        """
+        Return an unsaved e-mail taking the arguments of
+        send_templated_mail(). fail_silently is ignored: failures are
+        retried and logged, never raised to the caller.
+        """
+        return cls(
+            ticket=ticket,
+            template_name=template_name,
+            context=context,
+            recipients=recipients,
+            sender=sender or "",
+            bcc=bcc,
+            extra_headers=extra_headers or {},
+            files=[[filename, filefield.name] for filename, filefield in files or ()],
+        )
+
+    @classmethod
+    def enqueue(cls, emails):
+        """
+        Save the given e-mails to the outbox. With
+        HELPDESK_EMAIL_OUTBOX_USE_CELERY, the Celery task sending them is
+        started once the current transaction is committed.
+        """
+        cls.objects.bulk_create(emails)
+        if helpdesk_settings.HELPDESK_EMAIL_OUTBOX_USE_CELERY:
+            from helpdesk.tasks import helpdesk_send_outbound_emails
+
+            transaction.on_commit(helpdesk_send_outbound_emails.delay)
+
+    def get_files(self):
+        """Return the attachments as (filename, FieldFile) pairs."""
+        field = FollowUpAttachment._meta.get_field("file")
+        return [
+            (filename, field.attr_class(None, field, name))
+            for filename, name in self.files
+        ]
+
+    class Meta:
+        verbose_name = _("Outbound e-mail")
+        verbose_name_plural = _("Outbound e-mails")
+
+
+class WebhookDelivery(models.Model):
+    """
+    A webhook request that could not be sent yet, either because it is
+    queued (see HELPDESK_WEBHOOK_QUEUE) or because an earlier attempt
+    failed. Deliveries are deleted once sent; those that failed
+    HELPDESK_WEBHOOK_MAX_ATTEMPTS times are kept as dead letters, marked as
+    failed, until they are replayed.
+    """
+
+    ticket = models.ForeignKey(
+        Ticket,
+        on_delete=models.SET_NULL,
+        verbose_name=_("Ticket"),
+        blank=True,
+        null=True,
+    )
+
+    url = models.CharField(
+        _("URL"),
+        max_length=1000,
+    )
+
+    payload = models.JSONField(
+        _("Payload"),
+        encoder=DjangoJSONEncoder,
+    )
+
+    created = models.DateTimeField(
+        _("Created"),
+        default=timezone.now,
+    )
+
+    next_attempt = models.DateTimeField(
+        _("Next attempt"),
+        default=timezone.now,
+        db_index=True,
+    )
+
+    attempts = models.PositiveIntegerField(
+        _("Attempts"),
+        default=0,
+    )
+
+    failed = models.BooleanField(
+        _("Failed"),
+        default=False,
+        help_text=_("Set once all attempts to deliver the webhook failed."),
+    )
+
+    last_error = models.TextField(
+        _("Last error"),
+        blank=True,
+    )
+
+    def __str__(self):
+        return "%s (ticket %s)" % (self.url, self.ticket_id)
+
+    class Meta:
+        verbose_name = _("Webhook delivery")
+        verbose_name_plural = _("Webhook deliveries")
+
+
 class TicketChange(models.Model):
     """
     For each FollowUp, any changes to the parent ticket (eg Title, Priority,
@@ -1899,6 +2442,34 @@ class IgnoreEmail(models.Model):
         else:
             return ", ".join([str(q) for q in queues])
 
+    def get_match_key(self):
+        """
+        The (local part, domain) pattern of this address, where each may be
+        a "*" wildcard and the domain may be "*.example.com" to match its
+        sub-domains. Domains are compared case insensitively.
+        """
+        local_part, at, domain = self.email_address.partition("@")
+        if not at:
+            return (self.email_address, None)
+        return (local_part, domain.lower())
+
+    @staticmethod
+    def get_lookup_keys(email):
+        """
+        All the (local part, domain) patterns matching an address, eg for
+        jo@mail.example.com: ("jo", "mail.example.com"), ("jo", "*.example.com"),
+        ("jo", "*.com"), ("jo", "*") and the same with a "*" local part.
+        """
+        local_part, at, domain = email.partition("@")
+        if not at:
+            return [(email, None), ("*", "*")]
+        domain = domain.lower()
+        domains = [domain]
+        labels = domain.split(".")
+        domains.extend("*." + ".".join(labels[i:]) for i in range(1, len(labels)))
+        domains.append("*")
+        return [(local, domain) for local in (local_part, "*") for domain in domains]
+
     def test(self, email):
         """
         Possible situations:
@@ -1908,24 +2479,10 @@ class IgnoreEmail(models.Model):
             4. username & domain are both wildcards
             5. Other (no match)
 
-            1-4 return True, 5 returns False.
+            1-4 return True, 5 returns False. A domain of "*.example.com"
+            matches all the sub-domains of example.com.
         """
-
-        own_parts = self.email_address.split("@")
-        email_parts = email.split("@")
-
-        if (
-            self.email_address == email
-            or own_parts[0] == "*"
-            and own_parts[1] == email_parts[1]
-            or own_parts[1] == "*"
-            and own_parts[0] == email_parts[0]
-            or own_parts[0] == "*"
-            and own_parts[1] == "*"
-        ):
-            return True
-        else:
-            return False
+        return self.get_match_key() in self.get_lookup_keys(email)
 
 
 class TicketCC(models.Model):
@@ -1998,10 +2555,62 @@ class TicketCC(models.Model):
             raise ValidationError("User has no email address")
 
 
+CUSTOM_FIELDS_VERSION_KEY = "helpdesk_custom_fields_version"
+CUSTOM_FIELDS_CACHE_KEY = "helpdesk_custom_fields_%s"
+
+
 class CustomFieldManager(models.Manager):
+    # (version, definitions) last read by this process
+    _cached = (None, ())
+
     def get_queryset(self):
         return super(CustomFieldManager, self).get_queryset().order_by("ordering")
 
+    def get_cached(self):
+        """
+        Return the custom field definitions, in their order, without a query.
+
+        They are kept in Django's cache under a version key which is changed
+        whenever a custom field is saved or deleted, and in each process for
+        as long as that version holds. Both expire after
+        HELPDESK_CUSTOM_FIELDS_CACHE_TIMEOUT seconds. The returned instances
+        are shared, they must not be modified.
+        """
+        timeout = helpdesk_settings.HELPDESK_CUSTOM_FIELDS_CACHE_TIMEOUT
+        version = cache.get(CUSTOM_FIELDS_VERSION_KEY)
+        if version is None:
+            cache.add(CUSTOM_FIELDS_VERSION_KEY, uuid.uuid4().hex, timeout)
+            version = cache.get(CUSTOM_FIELDS_VERSION_KEY)
+            if version is None:
+                # the cache keeps nothing, eg Django's dummy cache
+                return list(self.get_queryset())
+        cached_version, fields = CustomFieldManager._cached
+        if cached_version != version:
+            fields = cache.get(CUSTOM_FIELDS_CACHE_KEY % version)
+            if fields is None:
+                fields = tuple(self.get_queryset())
+                for field in fields:
+                    field._parsed_choices = field.get_choices()
+                cache.set(CUSTOM_FIELDS_CACHE_KEY % version, fields, timeout)
+            CustomFieldManager._cached = (version, fields)
+        return list(fields)
+
+    def get_cached_by_name(self, name):
+        for field in self.get_cached():
+            if field.name == name:
+                return field
+        raise CustomField.DoesNotExist("CustomField matching query does not exist.")
+
+    def clear_cache(self):
+        version = cache.get(CUSTOM_FIELDS_VERSION_KEY)
+        if version is not None:
+            cache.delete(CUSTOM_FIELDS_CACHE_KEY % version)
+        cache.set(
+            CUSTOM_FIELDS_VERSION_KEY,
+            uuid.uuid4().hex,
+            helpdesk_settings.HELPDESK_CUSTOM_FIELDS_CACHE_TIMEOUT,
+        )
+
 
 class CustomField(models.Model):
     """
@@ -2126,6 +2735,9 @@ class CustomField(models.Model):
     def get_choices(self):
         if not self.data_type == "list":
             return None
+        if hasattr(self, "_parsed_choices"):
+            # parsed once for the definitions of CustomField.objects.get_cached()
+            return list(self._parsed_choices)
         choices = self.choices_as_array
         if self.empty_selection_list:
             choices.insert(0, ("", "---------"))
@@ -2170,6 +2782,20 @@ class CustomField(models.Model):
             raise NameError("Unrecognized data_type %s" % self.data_type)
 
 
+def clear_custom_fields_cache(sender, **kwargs):
+    """
+    Drop the cached custom field definitions once one of them changed. This
+    is done again on commit, in case another process cached the definitions
+    before the change was committed.
+    """
+    CustomField.objects.clear_cache()
+    transaction.on_commit(CustomField.objects.clear_cache)
+
+
+models.signals.post_save.connect(clear_custom_fields_cache, sender=CustomField)
+models.signals.post_delete.connect(clear_custom_fields_cache, sender=CustomField)
+
+
 class TicketCustomFieldValue(models.Model):
     ticket = models.ForeignKey(
         Ticket,
@@ -2198,6 +2824,162 @@ class TicketCustomFieldValue(models.Model):
         verbose_name_plural = _("Ticket custom field values")
 
 
+class TicketSearchToken(models.Model):
+    """
+    One row of the inverted index used by the default search backend: a
+    normalised word found in a ticket (or one of its follow-ups, custom
+    field values, ...) together with a relevance weight. The source tells
+    which part of the ticket the word was found in, so that saving a
+    follow-up only re-indexes that follow-up.
+
+    The rows are maintained by helpdesk.search and can be rebuilt at any
+    time with the 'rebuild_search_index' management command.
+    """
+
+    ticket = models.ForeignKey(
+        Ticket,
+        on_delete=models.CASCADE,
+        verbose_name=_("Ticket"),
+        related_name="search_tokens",
+    )
+
+    token = models.CharField(
+        _("Token"),
+        max_length=64,
+    )
+
+    weight = models.PositiveIntegerField(
+        _("Weight"),
+        default=1,
+    )
+
+    source = models.CharField(
+        _("Source"),
+        max_length=32,
+        blank=True,
+        default="",
+        help_text=_(
+            "Empty for the fields of the ticket itself, 'followup:<id>' or "
+            "'customfield:<field id>' otherwise."
+        ),
+    )
+
+    def __str__(self):
+        return "%s / %s" % (self.ticket_id, self.token)
+
+    class Meta:
+        unique_together = (("ticket", "source", "token"),)
+        indexes = [
+            models.Index(
+                fields=["token", "ticket"],
+                name="helpdesk_search_token_idx",
+                opclasses=["varchar_pattern_ops", "int4_ops"],
+            ),
+        ]
+        verbose_name = _("Ticket search token")
+        verbose_name_plural = _("Ticket search tokens")
+
+
+class TicketDailyStat(models.Model):
+    """
+    Rollup of the tickets created on one day (in UTC) that are currently in
+    the same queue, assigned to the same user and have the same status and
+    priority, as used by the reports and the dashboard.
+
+    The rows are maintained by helpdesk.stats, see the
+    'refresh_ticket_stats' management command.
+    """
+
+    date = models.DateField(
+        _("Date"),
+        help_text=_("Day the tickets were created on (UTC)"),
+    )
+
+    queue = models.ForeignKey(
+        Queue,
+        on_delete=models.CASCADE,
+        verbose_name=_("Queue"),
+    )
+
+    assigned_to = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        blank=True,
+        null=True,
+        verbose_name=_("Assigned to"),
+        related_name="+",
+    )
+
+    status = models.IntegerField(
+        _("Status"),
+        choices=Ticket.STATUS_CHOICES,
+    )
+
+    priority = models.IntegerField(
+        _("Priority"),
+        choices=Ticket.PRIORITY_CHOICES,
+    )
+
+    ticket_count = models.PositiveIntegerField(
+        _("Number of tickets"),
+        default=0,
+    )
+
+    days_open = models.IntegerField(
+        _("Days open"),
+        default=0,
+        help_text=_(
+            "Sum of the whole days between the creation and the last "
+            "modification of each ticket."
+        ),
+    )
+
+    time_spent = models.DurationField(
+        _("Time spent"),
+        default=datetime.timedelta(0),
+        help_text=_("Sum of the time spent on the follow-ups of the tickets."),
+    )
+
+    def __str__(self):
+        return "%s / %s" % (self.date, self.queue_id)
+
+    class Meta:
+        unique_together = (("date", "queue", "assigned_to", "status", "priority"),)
+        verbose_name = _("Ticket daily statistic")
+        verbose_name_plural = _("Ticket daily statistics")
+
+
+class TicketStatsRefresh(models.Model):
+    """
+    High-water marks of the last refresh of the TicketDailyStat rollup:
+    tickets modified and follow-ups dated later than these have not been
+    counted yet.
+    """
+
+    refreshed_at = models.DateTimeField(
+        _("Refreshed at"),
+    )
+
+    ticket_modified = models.DateTimeField(
+        _("Last ticket modification"),
+        blank=True,
+        null=True,
+    )
+
+    followup_date = models.DateTimeField(
+        _("Last follow-up date"),
+        blank=True,
+        null=True,
+    )
+
+    def __str__(self):
+        return "%s" % self.refreshed_at
+
+    class Meta:
+        verbose_name = _("Ticket statistics refresh")
+        verbose_name_plural = _("Ticket statistics refreshes")
+
+
 class TicketDependency(models.Model):
     """
     The ticket identified by `ticket` cannot be resolved until the ticket in `depends_on` has been resolved.
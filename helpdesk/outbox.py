@@ -0,0 +1,158 @@
+"""
+django-helpdesk - A Django powered ticket tracker for small enterprise.
+
+(c) Copyright 2008 Jutda. All Rights Reserved. See LICENSE for details.
+
+outbox.py - Background delivery of the e-mail notifications.
+
+With HELPDESK_EMAIL_OUTBOX set, Ticket.send() stores its notifications as
+OutboundEmail rows instead of rendering and sending them while the request
+or the incoming e-mail is handled. send_outbound_emails() sends the due
+ones over one SMTP connection per batch; it is run by the
+'send_outbound_emails' management command or the
+helpdesk_send_outbound_emails Celery task.
+
+An e-mail that could not be sent is retried after
+HELPDESK_EMAIL_OUTBOX_RETRY_DELAY seconds, a delay doubled for each further
+attempt, and marked as failed after HELPDESK_EMAIL_OUTBOX_MAX_ATTEMPTS.
+"""
+
+from datetime import timedelta
+from django.core.mail import get_connection
+from django.utils import timezone
+from helpdesk import settings as helpdesk_settings
+from helpdesk.models import OutboundEmail
+from helpdesk.templated_email import email_session, send_templated_mail
+import logging
+
+
+logger = logging.getLogger("helpdesk")
+
+# Number of e-mails claimed and sent over one connection at a time
+BATCH_SIZE = 100
+
+# Number of seconds after which the e-mails claimed by a run that did not
+# finish (eg because it crashed) are due again
+CLAIM_TIMEOUT = 600
+
+
+def claim_due_emails(limit):
+    """
+    Claim up to `limit` due e-mails for this run. Their next attempt is
+    moved CLAIM_TIMEOUT seconds ahead by a single UPDATE, so that two
+    overlapping runs never send the same e-mail.
+    """
+    now = timezone.now()
+    ids = list(
+        OutboundEmail.objects.filter(failed=False, next_attempt__lte=now)
+        .order_by("next_attempt", "pk")
+        .values_list("pk", flat=True)[:limit]
+    )
+    if not ids:
+        return []
+    claimed_until = now + timedelta(seconds=CLAIM_TIMEOUT)
+    OutboundEmail.objects.filter(pk__in=ids, next_attempt__lte=now).update(
+        next_attempt=claimed_until
+    )
+    return list(
+        OutboundEmail.objects.filter(pk__in=ids, next_attempt=claimed_until)
+        .select_related("ticket")
+        .order_by("pk")
+    )
+
+
+def retry_later(email, error):
+    """Schedule the next attempt to send an e-mail, or give up on it."""
+    email.attempts += 1
+    email.last_error = str(error) or error.__class__.__name__
+    if email.attempts >= helpdesk_settings.HELPDESK_EMAIL_OUTBOX_MAX_ATTEMPTS:
+        email.failed = True
+        logger.error(
+            "Giving up sending %s (#%s) after %s attempts: %s",
+            email,
+            email.pk,
+            email.attempts,
+            email.last_error,
+        )
+    else:
+        delay = helpdesk_settings.HELPDESK_EMAIL_OUTBOX_RETRY_DELAY * 2 ** (
+            email.attempts - 1
+        )
+        email.next_attempt = timezone.now() + timedelta(seconds=delay)
+        logger.warning(
+            "Could not send %s (#%s), retrying in %s seconds: %s",
+            email,
+            email.pk,
+            delay,
+            email.last_error,
+        )
+    email.save(update_fields=["attempts", "last_error", "failed", "next_attempt"])
+
+
+def send_emails(emails):
+    """
+    Render and send the given e-mails over a single connection. Returns the
+    number of e-mails sent.
+    """
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception as e:  # eg the SMTP server cannot be reached
+        for email in emails:
+            retry_later(email, e)
+        return 0
+
+    done = []
+    nbr_sent = 0
+    try:
+        # The session shares the attachments read from the storage, while
+        # each e-mail is sent over the connection directly to be retried
+        # on its own.
+        with email_session():
+            for email in emails:
+                try:
+                    sent = send_templated_mail(
+                        email.template_name,
+                        email.context,
+                        email.recipients,
+                        sender=email.sender or None,
+                        bcc=email.bcc,
+                        files=email.get_files(),
+                        extra_headers=email.extra_headers,
+                        ticket=email.ticket,
+                        connection=connection,
+                    )
+                except Exception as e:
+                    retry_later(email, e)
+                    # the next e-mail opens a new connection, in case this one
+                    # was dropped
+                    connection.close()
+                    continue
+                # Without a matching template nothing is sent, as when sending
+                # right away; that is not worth retrying.
+                done.append(email.pk)
+                if sent:
+                    nbr_sent += 1
+    finally:
+        connection.close()
+    OutboundEmail.objects.filter(pk__in=done).delete()
+    return nbr_sent
+
+
+def send_outbound_emails(limit=None):
+    """
+    Send the due e-mails of the outbox, at most `limit` of them. Returns the
+    number of e-mails sent.
+    """
+    nbr_claimed = 0
+    nbr_sent = 0
+    while limit is None or nbr_claimed < limit:
+        batch_size = BATCH_SIZE
+        if limit is not None:
+            batch_size = min(batch_size, limit - nbr_claimed)
+        emails = claim_due_emails(batch_size)
+        if not emails:
+            break
+        nbr_claimed += len(emails)
+        nbr_sent += send_emails(emails)
+    return nbr_sent
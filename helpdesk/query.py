@@ -1,11 +1,18 @@
 from base64 import b64decode, b64encode
-from django.db.models import Q, Max
-from django.db.models import F, Window, Subquery, OuterRef
-from .models import FollowUp
+import binascii
+from datetime import datetime
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.db.models import F, Q
+from .models import Ticket
 from django.urls import reverse
 from django.utils.html import escape
 from django.utils.translation import gettext as _
+from helpdesk import settings as helpdesk_settings
+from helpdesk.search import get_search_backend, get_search_filter_args
 from helpdesk.serializers import DatatablesTicketSerializer
+import hashlib
 import json
 from model_utils import Choices
 
@@ -28,33 +35,6 @@ def query_from_base64(b64data):
     return query
 
 
-def get_search_filter_args(search):
-    if not search:
-        return Q()
-    if search.startswith("queue:"):
-        return Q(queue__title__icontains=search[len("queue:") :])
-    if search.startswith("priority:"):
-        return Q(priority__icontains=search[len("priority:") :])
-    my_filter = Q()
-    for subsearch in search.split("OR"):
-        subsearch = subsearch.strip()
-        if not subsearch:
-            continue
-        my_filter |= (
-            Q(id__icontains=subsearch)
-            | Q(title__icontains=subsearch)
-            | Q(description__icontains=subsearch)
-            | Q(priority__icontains=subsearch)
-            | Q(resolution__icontains=subsearch)
-            | Q(submitter_email__icontains=subsearch)
-            | Q(assigned_to__email__icontains=subsearch)
-            | Q(ticketcustomfieldvalue__value__icontains=subsearch)
-            | Q(created__icontains=subsearch)
-            | Q(due_date__icontains=subsearch)
-        )
-    return my_filter
-
-
 DATATABLES_ORDER_COLUMN_CHOICES = Choices(
     ("0", "id"),
     ("1", "title"),
@@ -73,6 +53,118 @@ DATATABLES_ORDER_COLUMN_CHOICES = Choices(
 
 DATATABLES_COLUMN_NUM_LOOKUP = {v: k for k, v in DATATABLES_ORDER_COLUMN_CHOICES}
 
+# Columns the ticket list can be paged through with a cursor. The other
+# columns sort on related models and always use offset pagination.
+KEYSET_PAGINATION_FIELDS = {
+    "id": Ticket._meta.get_field("id"),
+    "title": Ticket._meta.get_field("title"),
+    "priority": Ticket._meta.get_field("priority"),
+    "status": Ticket._meta.get_field("status"),
+    "created": Ticket._meta.get_field("created"),
+    "due_date": Ticket._meta.get_field("due_date"),
+    "submitter_email": Ticket._meta.get_field("submitter_email"),
+    "last_followup": Ticket._meta.get_field("last_followup_at"),
+}
+
+
+def cursor_to_base64(column, descending, obj):
+    """
+    Build the opaque pagination token pointing after obj, for a ticket list
+    sorted on column.
+    """
+    value = getattr(obj, column)
+    if isinstance(value, datetime):
+        # keep the microseconds, or the seek would match obj again
+        value = value.isoformat()
+    cursor = {
+        "column": column,
+        "desc": descending,
+        "value": value,
+        "id": obj.id,
+    }
+    return b64encode(json.dumps(cursor).encode("UTF-8")).decode("ascii")
+
+
+def cursor_from_base64(b64data, column, descending):
+    """
+    Decode a pagination token, returns a (value, id) tuple or None if the
+    token is invalid or was built for another sort order.
+    """
+    try:
+        cursor = json.loads(b64decode(b64data).decode("utf-8"))
+        if cursor["column"] != column or cursor["desc"] != descending:
+            return None
+        value = cursor["value"]
+        if value is not None:
+            value = KEYSET_PAGINATION_FIELDS[column].to_python(value)
+        return value, int(cursor["id"])
+    except (
+        binascii.Error,
+        UnicodeDecodeError,
+        ValueError,
+        TypeError,
+        KeyError,
+        ValidationError,
+    ):
+        return None
+
+
+def keyset_filter_args(column, descending, value, last_id):
+    """
+    Return the filter selecting the tickets listed after (value, last_id)
+    in a list ordered by column (NULLs last), then id.
+    """
+    if value is None:
+        return Q(**{"%s__isnull" % column: True}) & Q(
+            **{"id__lt" if descending else "id__gt": last_id}
+        )
+    after = "lt" if descending else "gt"
+    return (
+        Q(**{"%s__%s" % (column, after): value})
+        | Q(**{column: value, "id__%s" % after: last_id})
+        | Q(**{"%s__isnull" % column: True})
+    )
+
+
+def estimate_count(queryset):
+    """
+    Return a cheap row count for queryset. On PostgreSQL the planner
+    estimate is used for large results, elsewhere the exact count is cached
+    for settings.HELPDESK_DATATABLES_COUNT_CACHE_TTL seconds.
+    """
+    if connection.vendor == "postgresql":
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        estimate = plan[0]["Plan"]["Plan Rows"]
+        # estimates are too rough to be shown for small results
+        if estimate >= helpdesk_settings.HELPDESK_DATATABLES_COUNT_ESTIMATE_THRESHOLD:
+            return estimate
+    return cached_count(queryset)
+
+
+def cached_count(queryset):
+    key = "helpdesk_datatables_count_%s" % (
+        hashlib.sha1(str(queryset.query).encode("utf-8")).hexdigest()
+    )
+    return cache.get_or_set(
+        key,
+        queryset.count,
+        helpdesk_settings.HELPDESK_DATATABLES_COUNT_CACHE_TTL,
+    )
+
+
+def count_tickets(queryset):
+    mode = helpdesk_settings.HELPDESK_DATATABLES_COUNT_MODE
+    if mode == "estimate":
+        return estimate_count(queryset)
+    if mode == "cached":
+        return cached_count(queryset)
+    return queryset.count()
+
 
 def get_query_class():
     from django.conf import settings
@@ -105,7 +197,8 @@ class __Query__:
            filtering: A dict of Django ORM value_filters, eg:
             {'user__id__in': [1, 3, 103], 'title__contains': 'foo'}
 
-        search_string: A freetext search string
+        search_string: A freetext search string, handled by the search
+            engine configured in settings.HELPDESK_SEARCH_BACKEND
 
         sorting: The name of the column to sort by
         """
@@ -139,20 +232,29 @@ class __Query__:
                     del null_filters[null_key]
         queryset = queryset.filter(
             *q_args,
-            (Q(**value_filters) & Q(**null_filters)) & self.get_search_filter_args(),
+            Q(**value_filters) & Q(**null_filters),
         )
+        search = self.params.get("search_string", "")
+        queryset = get_search_backend().search(queryset, search)
         sorting = self.params.get("sorting", None)
         if sorting:
             sortreverse = self.params.get("sortreverse", None)
             if sortreverse:
                 sorting = "-%s" % sorting
             queryset = queryset.order_by(sorting)
+        elif "search_rank" in queryset.query.annotations:
+            # no explicit sorting, list the best search matches first
+            queryset = queryset.order_by("-search_rank", "id")
         # https://stackoverflow.com/questions/30487056/django-queryset-contains-duplicate-entries
         return queryset.distinct()
 
     def get(self):
         # Prefilter the allowed tickets
-        tickets = self.huser.get_tickets_in_queues().select_related()
+        tickets = (
+            self.huser.get_tickets_in_queues()
+            .select_related()
+            .annotate(last_followup=F("last_followup_at"))
+        )
         return self.__run__(tickets)
 
     def get_datatables_context(self, *, column_lookup=None, **kwargs):
@@ -165,12 +267,18 @@ class __Query__:
         to a Serializer called DatatablesTicketSerializer in serializers.py.
         Optionally, one can pass a dictionary in to override the default column
         mapping for sorting
+
+        Passing a `cursor` parameter (empty for the first page) turns on
+        keyset pagination: the response then contains a `next_cursor` token,
+        and passing it back fetches the following page with an indexed
+        WHERE instead of an OFFSET.
         """
         objects = self.get()
         draw = int(kwargs.get("draw", [0])[0])
         length = int(kwargs.get("length", [25])[0])
         start = int(kwargs.get("start", [0])[0])
         search_value = kwargs.get("search[value]", [""])[0]
+        cursor = kwargs.get("cursor", [None])[0]
         if column_lookup is None:
             column_lookup = DATATABLES_ORDER_COLUMN_CHOICES
             num_lookup = DATATABLES_COLUMN_NUM_LOOKUP
@@ -186,41 +294,57 @@ class __Query__:
         order = kwargs.get("order[0][dir]", [default_order])[0]
 
         order_column = column_lookup[order_column]
-        # django orm '-' -> desc
-        if order == "desc":
-            order_column = "-" + order_column
-
-        queryset = objects.annotate(
-            last_followup=Subquery(
-                FollowUp.objects.order_by()
-                .annotate(
-                    last_followup=Window(
-                        expression=Max("date"),
-                        partition_by=[
-                            F("ticket_id"),
-                        ],
-                        order_by="-date",
-                    )
-                )
-                .filter(ticket_id=OuterRef("id"))
-                .values("last_followup")
-                .distinct()
-            )
+        descending = order == "desc"
+        keyset_column = (
+            order_column if order_column in KEYSET_PAGINATION_FIELDS else None
         )
+        # django orm '-' -> desc
+        if keyset_column:
+            # a unique and stable ordering is needed to page with a cursor
+            if descending:
+                ordering = (F(order_column).desc(nulls_last=True), "-id")
+            else:
+                ordering = (F(order_column).asc(nulls_last=True), "id")
+        elif descending:
+            ordering = ("-" + order_column,)
+        else:
+            ordering = (order_column,)
 
-        total = queryset.count()
+        total = count_tickets(objects)
 
+        queryset = objects
         if search_value:  # Dead code currently
-            queryset = queryset.filter(get_search_filter_args(search_value))
+            queryset = get_search_backend().search(queryset, search_value)
+            count = count_tickets(queryset)
+        else:
+            count = total
+
+        queryset = queryset.order_by(*ordering)
+        seek = None
+        if cursor and keyset_column:
+            seek = cursor_from_base64(cursor, keyset_column, descending)
+        if seek:
+            page = list(
+                queryset.filter(keyset_filter_args(keyset_column, descending, *seek))[
+                    :length
+                ]
+            )
+        else:
+            page = list(queryset[start : start + length])
 
-        count = queryset.count()
-        queryset = queryset.order_by(order_column)[start : start + length]
-        return {
-            "data": DatatablesTicketSerializer(queryset, many=True).data,
+        context = {
+            "data": DatatablesTicketSerializer(page, many=True).data,
             "recordsFiltered": count,
             "recordsTotal": total,
             "draw": draw,
         }
+        if cursor is not None:
+            context["next_cursor"] = (
+                cursor_to_base64(keyset_column, descending, page[-1])
+                if keyset_column and page and len(page) == length
+                else ""
+            )
+        return context
 
     def get_timeline_context(self):
         events = []
@@ -0,0 +1,439 @@
+"""
+django-helpdesk - A Django powered ticket tracker for small enterprise.
+
+(c) Copyright 2008 Jutda. All Rights Reserved. See LICENSE for details.
+
+search.py - Pluggable engines for the free text ticket search.
+
+The engine is selected with settings.HELPDESK_SEARCH_BACKEND. Every engine
+takes a Ticket queryset and a search string and returns the matching
+tickets; engines that can rank their results annotate each ticket with a
+`search_rank` value (higher is better).
+
+Available engines:
+
+  - InvertedIndexSearchBackend (default) keeps tokenized ticket and
+    follow-up text in the TicketSearchToken table, updated on save.
+  - DatabaseSearchBackend runs plain LIKE (icontains) lookups, which was
+    the behaviour of django-helpdesk before search engines existed.
+  - PostgresSearchBackend uses PostgreSQL full text search (tsvector).
+  - SQLiteFTS5SearchBackend keeps an SQLite FTS5 virtual table.
+"""
+
+from collections import defaultdict
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, transaction
+from django.db.models import OuterRef, Q, Subquery, Sum, Value
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from helpdesk import settings as helpdesk_settings
+from helpdesk.models import (
+    FollowUp,
+    Ticket,
+    TicketCustomFieldValue,
+    TicketSearchToken,
+)
+import re
+
+
+TOKEN_RE = re.compile(r"\w+")
+MAX_TOKEN_LENGTH = TicketSearchToken._meta.get_field("token").max_length
+
+# Relevance of a match, depending on where the word was found.
+TITLE_WEIGHT = 10
+ADDRESS_WEIGHT = 5
+CUSTOM_FIELD_WEIGHT = 3
+BODY_WEIGHT = 2
+FOLLOWUP_WEIGHT = 1
+
+
+def tokenize(text):
+    """Split a text into lower cased words, as stored in the search index."""
+    if not text:
+        return []
+    return [token[:MAX_TOKEN_LENGTH] for token in TOKEN_RE.findall(str(text).lower())]
+
+
+def get_search_filter_args(search):
+    if not search:
+        return Q()
+    if search.startswith("queue:"):
+        return Q(queue__title__icontains=search[len("queue:") :])
+    if search.startswith("priority:"):
+        return Q(priority__icontains=search[len("priority:") :])
+    my_filter = Q()
+    for subsearch in search.split("OR"):
+        subsearch = subsearch.strip()
+        if not subsearch:
+            continue
+        my_filter |= (
+            Q(id__icontains=subsearch)
+            | Q(title__icontains=subsearch)
+            | Q(description__icontains=subsearch)
+            | Q(priority__icontains=subsearch)
+            | Q(resolution__icontains=subsearch)
+            | Q(submitter_email__icontains=subsearch)
+            | Q(assigned_to__email__icontains=subsearch)
+            | Q(ticketcustomfieldvalue__value__icontains=subsearch)
+            | Q(created__icontains=subsearch)
+            | Q(due_date__icontains=subsearch)
+        )
+    return my_filter
+
+
+def ticket_fields_document(ticket):
+    """
+    Return the searchable text of the fields of a ticket itself as a list of
+    (text, weight) pairs.
+    """
+    document = [
+        (ticket.title, TITLE_WEIGHT),
+        (ticket.submitter_email, ADDRESS_WEIGHT),
+        (ticket.description, BODY_WEIGHT),
+        (ticket.resolution, BODY_WEIGHT),
+    ]
+    if ticket.assigned_to_id:
+        document.append((ticket.assigned_to.email, ADDRESS_WEIGHT))
+    return document
+
+
+def related_source(instance):
+    """
+    Return the source under which the text of a follow-up or a custom field
+    value is indexed.
+    """
+    if isinstance(instance, FollowUp):
+        return "followup:%s" % instance.pk
+    return "customfield:%s" % instance.field_id
+
+
+def related_document(instance):
+    if isinstance(instance, FollowUp):
+        return [(instance.title, FOLLOWUP_WEIGHT), (instance.comment, FOLLOWUP_WEIGHT)]
+    return [(instance.value, CUSTOM_FIELD_WEIGHT)]
+
+
+def ticket_documents(ticket):
+    """
+    Return the searchable text of a ticket as a dict of (text, weight) pair
+    lists by source.
+    """
+    documents = {"": ticket_fields_document(ticket)}
+    for instance in TicketCustomFieldValue.objects.filter(ticket=ticket):
+        documents[related_source(instance)] = related_document(instance)
+    for instance in FollowUp.objects.filter(ticket=ticket):
+        documents[related_source(instance)] = related_document(instance)
+    return documents
+
+
+def ticket_document(ticket):
+    """
+    Return the searchable text of a ticket as a list of (text, weight) pairs.
+    """
+    return [pair for document in ticket_documents(ticket).values() for pair in document]
+
+
+def document_weights(document):
+    """Return the summed weight of each token of a document."""
+    weights = defaultdict(int)
+    for text, weight in document:
+        for token in tokenize(text):
+            weights[token] += weight
+    return weights
+
+
+def get_search_backend():
+    try:
+        backend_class = import_string(helpdesk_settings.HELPDESK_SEARCH_BACKEND)
+    except ImportError as e:
+        raise ImproperlyConfigured(
+            f"Invalid search backend {helpdesk_settings.HELPDESK_SEARCH_BACKEND}"
+        ) from e
+    return backend_class()
+
+
+class BaseSearchBackend:
+    """
+    Common behaviour of all search engines.
+
+    The "queue:" and "priority:" prefixes are always handled as plain
+    database filters. Any other search string is split on "OR" into
+    alternatives, and each alternative into words which must all match.
+    """
+
+    def search(self, queryset, search):
+        if not search:
+            return queryset
+        if search.startswith(("queue:", "priority:")):
+            return queryset.filter(get_search_filter_args(search))
+        alternatives = [
+            subsearch.strip() for subsearch in search.split("OR") if subsearch.strip()
+        ]
+        if not alternatives:
+            return queryset
+        return self.search_text(queryset, alternatives)
+
+    def search_text(self, queryset, alternatives):
+        raise NotImplementedError
+
+    def index_ticket(self, ticket):
+        """Called whenever the searchable content of a ticket changed."""
+
+    def index_ticket_fields(self, ticket):
+        """Called whenever a ticket itself was saved."""
+        self.index_ticket(ticket)
+
+    def index_related(self, ticket, instances):
+        """Called whenever follow-ups or custom field values were saved."""
+        self.index_ticket(ticket)
+
+    def remove_related(self, instance):
+        """Called once a follow-up or custom field value has been deleted."""
+        # Deletes may cascade from the ticket itself, so only touch the index
+        # once the whole deletion has been committed.
+        ticket_id = instance.ticket_id
+        transaction.on_commit(lambda: _reindex_ticket_id(ticket_id))
+
+    def remove_ticket(self, ticket_id):
+        """Called once a ticket has been deleted."""
+
+    def rebuild(self, tickets=None):
+        """Re-index all given tickets (all tickets by default)."""
+        if tickets is None:
+            tickets = Ticket.objects.all()
+        count = 0
+        for ticket in tickets.select_related("assigned_to").iterator():
+            self.index_ticket(ticket)
+            count += 1
+        return count
+
+
+class DatabaseSearchBackend(BaseSearchBackend):
+    """
+    Search with icontains lookups over the ticket columns. Needs no index
+    but scans the whole ticket table for every search.
+    """
+
+    def search(self, queryset, search):
+        return queryset.filter(get_search_filter_args(search))
+
+
+class InvertedIndexSearchBackend(BaseSearchBackend):
+    """
+    Search the TicketSearchToken table, which maps every word of a ticket
+    to the ticket. Words of the search string match any indexed word they
+    are a prefix of, and numbers also match the ticket id.
+    """
+
+    def search_text(self, queryset, alternatives):
+        match = Q()
+        all_terms = set()
+        for alternative in alternatives:
+            terms = tokenize(alternative)
+            if not terms:
+                continue
+            all_terms.update(terms)
+            alternative_match = Q()
+            for term in terms:
+                term_match = Q(
+                    id__in=TicketSearchToken.objects.filter(
+                        token__startswith=term
+                    ).values("ticket_id")
+                )
+                if term.isdigit():
+                    term_match |= Q(id=int(term))
+                alternative_match &= term_match
+            match |= alternative_match
+        if not all_terms:
+            return queryset.none()
+
+        matched_tokens = Q()
+        for term in all_terms:
+            matched_tokens |= Q(token__startswith=term)
+        rank = Subquery(
+            TicketSearchToken.objects.filter(matched_tokens, ticket=OuterRef("pk"))
+            .order_by()
+            .values("ticket")
+            .annotate(rank=Sum("weight"))
+            .values("rank")
+        )
+        return queryset.filter(match).annotate(search_rank=Coalesce(rank, Value(0)))
+
+    def _replace_tokens(self, ticket_id, documents):
+        """Replace the tokens of the given sources of a ticket."""
+        TicketSearchToken.objects.filter(
+            ticket_id=ticket_id, source__in=list(documents)
+        ).delete()
+        TicketSearchToken.objects.bulk_create(
+            [
+                TicketSearchToken(
+                    ticket_id=ticket_id, source=source, token=token, weight=weight
+                )
+                for source, document in documents.items()
+                for token, weight in document_weights(document).items()
+            ]
+        )
+
+    def index_ticket(self, ticket):
+        TicketSearchToken.objects.filter(ticket=ticket).delete()
+        self._replace_tokens(ticket.pk, ticket_documents(ticket))
+
+    def index_ticket_fields(self, ticket):
+        self._replace_tokens(ticket.pk, {"": ticket_fields_document(ticket)})
+
+    def index_related(self, ticket, instances):
+        self._replace_tokens(
+            ticket.pk,
+            {
+                related_source(instance): related_document(instance)
+                for instance in instances
+            },
+        )
+
+    def remove_related(self, instance):
+        TicketSearchToken.objects.filter(
+            ticket_id=instance.ticket_id, source=related_source(instance)
+        ).delete()
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    """
+    PostgreSQL full text search over the ticket columns. To avoid computing
+    the tsvector for every row, create a matching expression index, eg:
+
+        CREATE INDEX helpdesk_ticket_fts ON helpdesk_ticket USING GIN (
+            to_tsvector('simple', coalesce(title, '') || ' ' ||
+                coalesce(description, '') || ' ' || coalesce(resolution, '') ||
+                ' ' || coalesce(submitter_email, '')));
+    """
+
+    search_config = "simple"
+
+    def search_text(self, queryset, alternatives):
+        from django.contrib.postgres.search import (
+            SearchQuery,
+            SearchRank,
+            SearchVector,
+        )
+
+        raw_alternatives = []
+        for alternative in alternatives:
+            terms = tokenize(alternative)
+            if terms:
+                raw_alternatives.append(
+                    "(%s)" % " & ".join("%s:*" % term for term in terms)
+                )
+        if not raw_alternatives:
+            return queryset.none()
+
+        vector = SearchVector(
+            "title",
+            "description",
+            "resolution",
+            "submitter_email",
+            config=self.search_config,
+        )
+        query = SearchQuery(
+            " | ".join(raw_alternatives), config=self.search_config, search_type="raw"
+        )
+        return queryset.annotate(
+            search_vector=vector, search_rank=SearchRank(vector, query)
+        ).filter(search_vector=query)
+
+
+class SQLiteFTS5SearchBackend(BaseSearchBackend):
+    """
+    Search an SQLite FTS5 virtual table holding the text of each ticket,
+    using the ticket id as rowid. The table is created on first use.
+    """
+
+    table_name = "helpdesk_ticket_fts"
+
+    def _ensure_table(self, cursor):
+        cursor.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(body)" % self.table_name
+        )
+
+    def index_ticket(self, ticket):
+        body = " ".join(
+            " ".join(tokenize(text)) for text, weight in ticket_document(ticket)
+        )
+        with connection.cursor() as cursor:
+            self._ensure_table(cursor)
+            cursor.execute(
+                "DELETE FROM %s WHERE rowid = %%s" % self.table_name, [ticket.pk]
+            )
+            cursor.execute(
+                "INSERT INTO %s (rowid, body) VALUES (%%s, %%s)" % self.table_name,
+                [ticket.pk, body],
+            )
+
+    def remove_ticket(self, ticket_id):
+        with connection.cursor() as cursor:
+            self._ensure_table(cursor)
+            cursor.execute(
+                "DELETE FROM %s WHERE rowid = %%s" % self.table_name, [ticket_id]
+            )
+
+    def search_text(self, queryset, alternatives):
+        fts_alternatives = []
+        for alternative in alternatives:
+            terms = tokenize(alternative)
+            if terms:
+                fts_alternatives.append(
+                    "(%s)" % " AND ".join('"%s"*' % term for term in terms)
+                )
+        if not fts_alternatives:
+            return queryset.none()
+        fts_query = " OR ".join(fts_alternatives)
+
+        with connection.cursor() as cursor:
+            self._ensure_table(cursor)
+        ids_sql = "SELECT rowid FROM {table} WHERE {table} MATCH %s".format(
+            table=self.table_name
+        )
+        rank_sql = (
+            "SELECT -bm25({table}) FROM {table} WHERE {table} MATCH %s "
+            "AND {table}.rowid = {ticket_table}.id"
+        ).format(table=self.table_name, ticket_table=Ticket._meta.db_table)
+        return queryset.filter(id__in=RawSQL(ids_sql, [fts_query])).annotate(
+            search_rank=RawSQL(rank_sql, [fts_query])
+        )
+
+
+def _reindex_ticket_id(ticket_id):
+    ticket = Ticket.objects.filter(pk=ticket_id).select_related("assigned_to").first()
+    backend = get_search_backend()
+    if ticket is None:
+        backend.remove_ticket(ticket_id)
+    else:
+        backend.index_ticket(ticket)
+
+
+# listeners are loaded via app.py HelpdeskConfig.ready()
+@receiver(post_save, sender=Ticket)
+def index_ticket_receiver(sender, instance, raw=False, **kwargs):
+    if not raw:
+        get_search_backend().index_ticket_fields(instance)
+
+
+@receiver(post_save, sender=FollowUp)
+@receiver(post_save, sender=TicketCustomFieldValue)
+def index_related_ticket_receiver(sender, instance, raw=False, **kwargs):
+    if not raw:
+        get_search_backend().index_related(instance.ticket, [instance])
+
+
+@receiver(post_delete, sender=Ticket)
+def unindex_ticket_receiver(sender, instance, **kwargs):
+    ticket_id = instance.pk
+    transaction.on_commit(lambda: _reindex_ticket_id(ticket_id))
+
+
+@receiver(post_delete, sender=FollowUp)
+@receiver(post_delete, sender=TicketCustomFieldValue)
+def unindex_related_receiver(sender, instance, **kwargs):
+    get_search_backend().remove_related(instance)
@@ -158,7 +158,7 @@ class BaseTicketSerializer(serializers.ModelSerializer):
         super().__init__(*args, **kwargs)
 
         # Add custom fields
-        for field in CustomField.objects.all():
+        for field in CustomField.objects.get_cached():
             self.fields["custom_%s" % field.name] = field.build_api_field()
 
 
@@ -219,8 +219,9 @@ class PublicTicketListingSerializer(BaseTicketSerializer):
         # Return a human-friendly last activity time if available
         try:
             from django.contrib.humanize.templatetags import humanize
-            if getattr(obj, 'last_followup', None):
-                return humanize.naturaltime(obj.last_followup)
+            last_followup = getattr(obj, 'last_followup', None) or obj.last_followup_at
+            if last_followup:
+                return humanize.naturaltime(last_followup)
             # Fallback to created date if no last_followup available
             if getattr(obj, 'created', None):
                 return humanize.naturaltime(obj.created)
@@ -253,6 +253,40 @@ FOLLOWUP_TIME_SPENT_EXCLUDE_QUEUES = getattr(
     settings, "HELPDESK_FOLLOWUP_TIME_SPENT_EXCLUDE_QUEUES", ()
 )
 
+###################################
+# ticket list and search options  #
+###################################
+
+# dotted path to the engine used for free text ticket searches, see
+# helpdesk.search for the engines shipped with django-helpdesk
+HELPDESK_SEARCH_BACKEND = getattr(
+    settings, "HELPDESK_SEARCH_BACKEND", "helpdesk.search.InvertedIndexSearchBackend"
+)
+
+# how the staff ticket list counts matching tickets for its pagination:
+# "exact" runs COUNT queries on each page load, "cached" caches the exact
+# counts for HELPDESK_DATATABLES_COUNT_CACHE_TTL seconds and "estimate" uses
+# the PostgreSQL planner estimate for large results (cached counts otherwise)
+HELPDESK_DATATABLES_COUNT_MODE = getattr(
+    settings, "HELPDESK_DATATABLES_COUNT_MODE", "exact"
+)
+HELPDESK_DATATABLES_COUNT_CACHE_TTL = getattr(
+    settings, "HELPDESK_DATATABLES_COUNT_CACHE_TTL", 60
+)
+HELPDESK_DATATABLES_COUNT_ESTIMATE_THRESHOLD = getattr(
+    settings, "HELPDESK_DATATABLES_COUNT_ESTIMATE_THRESHOLD", 10000
+)
+
+###################
+# report options  #
+###################
+
+# number of seconds the ticket statistics refreshed by the
+# 'refresh_ticket_stats' command are used by the reports and the dashboard;
+# past that age (or if they were never refreshed) the statistics are
+# computed from the tickets. 0 (the default) always uses the tickets.
+HELPDESK_TICKET_STATS_MAX_AGE = getattr(settings, "HELPDESK_TICKET_STATS_MAX_AGE", 0)
+
 ############################
 # options for public pages #
 ############################
@@ -315,6 +349,12 @@ HELPDESK_SHOW_CUSTOM_FIELDS_FOLLOW_UP_LIST = getattr(
     settings, "HELPDESK_SHOW_CUSTOM_FIELDS_FOLLOW_UP_LIST", []
 )
 
+# number of seconds the custom field definitions are cached for; they are
+# also dropped from the cache whenever one of them is saved or deleted
+HELPDESK_CUSTOM_FIELDS_CACHE_TIMEOUT = getattr(
+    settings, "HELPDESK_CUSTOM_FIELDS_CACHE_TIMEOUT", 300
+)
+
 # show delete buttons in ticket follow ups if user is 'superuser'
 HELPDESK_SHOW_DELETE_BUTTON_SUPERUSER_FOLLOW_UP = getattr(
     settings, "HELPDESK_SHOW_DELETE_BUTTON_SUPERUSER_FOLLOW_UP", False
@@ -352,6 +392,12 @@ HELPDESK_EMAIL_FALLBACK_LOCALE = getattr(
     settings, "HELPDESK_EMAIL_FALLBACK_LOCALE", "en"
 )
 
+# number of seconds the e-mail templates are cached for; they are also
+# dropped from the cache whenever one of them is saved or deleted
+HELPDESK_EMAIL_TEMPLATE_CACHE_TIMEOUT = getattr(
+    settings, "HELPDESK_EMAIL_TEMPLATE_CACHE_TIMEOUT", 300
+)
+
 # default maximum email attachment size, in bytes
 # only attachments smaller than this size will be sent via email
 HELPDESK_MAX_EMAIL_ATTACHMENT_SIZE = getattr(
@@ -388,11 +434,57 @@ QUEUE_EMAIL_BOX_PASSWORD = getattr(settings, "QUEUE_EMAIL_BOX_PASSWORD", None)
 # only process emails with a valid tracking ID? (throws away all other mail)
 QUEUE_EMAIL_BOX_UPDATE_ONLY = getattr(settings, "QUEUE_EMAIL_BOX_UPDATE_ONLY", False)
 
+# number of seconds to wait for a mail server before giving up on a queue
+QUEUE_EMAIL_BOX_TIMEOUT = getattr(settings, "QUEUE_EMAIL_BOX_TIMEOUT", 60)
+
+# number of seconds after which a mailbox claimed by a get_email run that
+# did not finish (eg because it crashed) can be polled again
+QUEUE_EMAIL_BOX_LOCK_TIMEOUT = getattr(settings, "QUEUE_EMAIL_BOX_LOCK_TIMEOUT", 3600)
+
+# number of IMAP messages fetched (and deleted once processed) at a time
+QUEUE_EMAIL_BOX_IMAP_BATCH_SIZE = getattr(
+    settings, "QUEUE_EMAIL_BOX_IMAP_BATCH_SIZE", 200
+)
+
+# number of days e-mails turned into tickets are remembered, so that a message
+# left in a mailbox after a failed run does not create a duplicate ticket
+HELPDESK_EMAIL_INGESTION_RETENTION = getattr(
+    settings, "HELPDESK_EMAIL_INGESTION_RETENTION", 7
+)
+
+# store the notifications of Ticket.send() in an outbox, sent by the
+# 'send_outbound_emails' command (or Celery task), instead of sending them
+# while handling the request or the incoming e-mail
+HELPDESK_EMAIL_OUTBOX = getattr(settings, "HELPDESK_EMAIL_OUTBOX", False)
+
+# start the helpdesk_send_outbound_emails Celery task whenever notifications
+# were added to the outbox
+HELPDESK_EMAIL_OUTBOX_USE_CELERY = getattr(
+    settings, "HELPDESK_EMAIL_OUTBOX_USE_CELERY", False
+)
+
+# number of times sending a notification from the outbox is attempted, and
+# number of seconds before the first retry (doubled for each further retry)
+HELPDESK_EMAIL_OUTBOX_MAX_ATTEMPTS = getattr(
+    settings, "HELPDESK_EMAIL_OUTBOX_MAX_ATTEMPTS", 5
+)
+HELPDESK_EMAIL_OUTBOX_RETRY_DELAY = getattr(
+    settings, "HELPDESK_EMAIL_OUTBOX_RETRY_DELAY", 60
+)
+
 # only allow users to access queues that they are members of?
 HELPDESK_ENABLE_PER_QUEUE_STAFF_PERMISSION = getattr(
     settings, "HELPDESK_ENABLE_PER_QUEUE_STAFF_PERMISSION", False
 )
 
+# number of seconds the queues a user has the permission of are cached for;
+# they are dropped before whenever Django signals a change of the user, its
+# groups or permissions, or who can access a queue (None to only rely on
+# these signals)
+HELPDESK_QUEUE_ACCESS_CACHE_TIMEOUT = getattr(
+    settings, "HELPDESK_QUEUE_ACCESS_CACHE_TIMEOUT", 300
+)
+
 # use https in the email links
 HELPDESK_USE_HTTPS_IN_EMAIL_LINK = getattr(
     settings, "HELPDESK_USE_HTTPS_IN_EMAIL_LINK", settings.SECURE_SSL_REDIRECT
@@ -511,6 +603,34 @@ HELPDESK_GET_NEW_TICKET_WEBHOOK_URLS = getattr(
 
 HELPDESK_WEBHOOK_TIMEOUT = getattr(settings, "HELPDESK_WEBHOOK_TIMEOUT", 3)
 
+# store the webhook deliveries in a queue, sent by the 'send_webhooks'
+# command (or Celery task), instead of sending them while handling the
+# request or the incoming e-mail
+HELPDESK_WEBHOOK_QUEUE = getattr(settings, "HELPDESK_WEBHOOK_QUEUE", False)
+
+# start the helpdesk_send_webhooks Celery task whenever webhook deliveries
+# were queued
+HELPDESK_WEBHOOK_QUEUE_USE_CELERY = getattr(
+    settings, "HELPDESK_WEBHOOK_QUEUE_USE_CELERY", False
+)
+
+# number of times a webhook delivery is attempted, and number of seconds
+# before the first retry (doubled for each further retry)
+HELPDESK_WEBHOOK_MAX_ATTEMPTS = getattr(settings, "HELPDESK_WEBHOOK_MAX_ATTEMPTS", 5)
+HELPDESK_WEBHOOK_RETRY_DELAY = getattr(settings, "HELPDESK_WEBHOOK_RETRY_DELAY", 60)
+
+# number of webhook requests sent at the same time, in total and to a single
+# endpoint (scheme, host and port)
+HELPDESK_WEBHOOK_WORKERS = getattr(settings, "HELPDESK_WEBHOOK_WORKERS", 4)
+HELPDESK_WEBHOOK_ENDPOINT_CONCURRENCY = getattr(
+    settings, "HELPDESK_WEBHOOK_ENDPOINT_CONCURRENCY", 2
+)
+
+# number of seconds webhook deliveries are held back to be sent together
+# with the other events to the same URL, as one JSON array (0 to send every
+# event on its own)
+HELPDESK_WEBHOOK_BATCH_WINDOW = getattr(settings, "HELPDESK_WEBHOOK_BATCH_WINDOW", 0)
+
 
 LOG_WARN_WHEN_CC_EMAIL_NOT_LINKED_TO_A_USER = getattr(
     settings, "HELPDESK_LOG_WARN_WHEN_CC_EMAIL_NOT_LINKED_TO_A_USER", False
@@ -0,0 +1,252 @@
+"""
+django-helpdesk - A Django powered ticket tracker for small enterprise.
+
+(c) Copyright 2008 Jutda. All Rights Reserved. See LICENSE for details.
+
+stats.py - Daily rollup of the ticket statistics shown by the reports.
+
+The TicketDailyStat table holds the number of tickets, the days they were
+open and the time spent on them per creation day, queue, assignee, status
+and priority. refresh_ticket_stats() brings it up to date, recomputing only
+the days of the tickets modified (or followed up) since the last refresh;
+it is run by the 'refresh_ticket_stats' management command.
+
+Reports read the rollup instead of the tickets as long as it was refreshed
+within HELPDESK_TICKET_STATS_MAX_AGE seconds (off by default).
+
+get_queue_summaries() counts the tickets of many queues at once for the
+report index.
+"""
+
+from datetime import datetime, time, timedelta, timezone as dt_timezone
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, DurationField, ExpressionWrapper, F, Max, Q, Sum
+from django.db.models.functions import ExtractDay, TruncDate
+from django.utils import timezone
+from helpdesk import settings as helpdesk_settings
+from helpdesk.models import FollowUp, Ticket, TicketDailyStat, TicketStatsRefresh
+
+
+# The ticket columns rows are grouped by, besides the day of creation
+GROUP_FIELDS = ("queue", "assigned_to", "status", "priority")
+
+# Number of days recomputed at once
+DATE_BATCH_SIZE = 100
+
+
+def created_day(prefix=""):
+    return TruncDate(prefix + "created", tzinfo=dt_timezone.utc)
+
+
+def created_on(dates, prefix=""):
+    """Filter on the tickets created on one of the given days (UTC)."""
+    match = Q()
+    for date in dates:
+        start = datetime.combine(date, time.min)
+        if settings.USE_TZ:
+            start = start.replace(tzinfo=dt_timezone.utc)
+        match |= Q(
+            **{
+                prefix + "created__gte": start,
+                prefix + "created__lt": start + timedelta(days=1),
+            }
+        )
+    return match
+
+
+def compute_daily_stats(dates=None):
+    """
+    Return the (unsaved) TicketDailyStat rows of the tickets created on the
+    given days, or of all tickets.
+    """
+    tickets = Ticket.objects.order_by().annotate(day=created_day())
+    followups = FollowUp.objects.order_by().annotate(day=created_day("ticket__"))
+    if dates is not None:
+        tickets = tickets.filter(created_on(dates))
+        followups = followups.filter(created_on(dates, "ticket__"))
+
+    rows = {}
+
+    def get_row(key):
+        if key not in rows:
+            rows[key] = TicketDailyStat(
+                date=key[0],
+                queue_id=key[1],
+                assigned_to_id=key[2],
+                status=key[3],
+                priority=key[4],
+            )
+        return rows[key]
+
+    fields = ("day",) + GROUP_FIELDS
+    aggregates = {"count": Count("id")}
+    sum_days_in_db = connection.features.has_native_duration_field
+    if sum_days_in_db:
+        aggregates["days"] = Sum(
+            ExtractDay(
+                ExpressionWrapper(
+                    F("modified") - F("created"), output_field=DurationField()
+                )
+            )
+        )
+    for cell in tickets.values(*fields).annotate(**aggregates):
+        row = get_row(tuple(cell[field] for field in fields))
+        row.ticket_count = cell["count"]
+        if sum_days_in_db:
+            row.days_open = cell["days"] or 0
+    if not sum_days_in_db:
+        # Without interval arithmetic in the database (eg SQLite), sum up
+        # the whole days from the two dates of each ticket.
+        for *key, created, modified in tickets.values_list(
+            *fields, "created", "modified"
+        ):
+            get_row(tuple(key)).days_open += (modified - created).days
+
+    followup_fields = ("day",) + tuple("ticket__" + field for field in GROUP_FIELDS)
+    for cell in (
+        followups.filter(time_spent__isnull=False)
+        .values(*followup_fields)
+        .annotate(time_spent_sum=Sum("time_spent"))
+    ):
+        row = get_row(tuple(cell[field] for field in followup_fields))
+        row.time_spent = cell["time_spent_sum"]
+    return list(rows.values())
+
+
+def get_changed_dates(refresh):
+    """
+    Days of creation of the tickets modified or followed up since the given
+    refresh.
+    """
+    tickets = Ticket.objects.order_by()
+    if refresh.ticket_modified is not None:
+        changed = Q(modified__gt=refresh.ticket_modified)
+        if refresh.followup_date is not None:
+            changed |= Q(followup__date__gt=refresh.followup_date)
+        else:
+            changed |= Q(followup__isnull=False)
+        tickets = tickets.filter(changed)
+    return set(
+        tickets.annotate(day=created_day()).values_list("day", flat=True).distinct()
+    )
+
+
+def get_miscounted_dates():
+    """
+    Days whose number of tickets differs between the rollup and the tickets,
+    eg because tickets were deleted.
+    """
+    stored = TicketDailyStat.objects.aggregate(total=Sum("ticket_count"))["total"]
+    if (stored or 0) == Ticket.objects.count():
+        return set()
+    stored = dict(
+        TicketDailyStat.objects.values("date")
+        .annotate(count=Sum("ticket_count"))
+        .values_list("date", "count")
+    )
+    actual = dict(
+        Ticket.objects.order_by()
+        .annotate(day=created_day())
+        .values("day")
+        .annotate(count=Count("id"))
+        .values_list("day", "count")
+    )
+    return {
+        date
+        for date in stored.keys() | actual.keys()
+        if stored.get(date) != actual.get(date)
+    }
+
+
+def refresh_dates(dates):
+    dates = sorted(dates)
+    for offset in range(0, len(dates), DATE_BATCH_SIZE):
+        batch = dates[offset : offset + DATE_BATCH_SIZE]
+        TicketDailyStat.objects.filter(date__in=batch).delete()
+        TicketDailyStat.objects.bulk_create(compute_daily_stats(batch))
+
+
+def refresh_ticket_stats(full=False):
+    """
+    Bring the TicketDailyStat rollup up to date, recomputing only the days
+    that changed since the last refresh unless `full` is set. Returns the
+    number of days recomputed.
+    """
+    refresh = TicketStatsRefresh.objects.order_by("-refreshed_at").first()
+    # Taken before looking for changes, anything modified from now on is
+    # picked up again by the next refresh.
+    ticket_modified = Ticket.objects.aggregate(Max("modified"))["modified__max"]
+    followup_date = FollowUp.objects.aggregate(Max("date"))["date__max"]
+
+    with transaction.atomic():
+        if full or refresh is None:
+            TicketDailyStat.objects.all().delete()
+            rows = compute_daily_stats()
+            TicketDailyStat.objects.bulk_create(rows)
+            nbr_dates = len({row.date for row in rows})
+            refresh = refresh or TicketStatsRefresh()
+        else:
+            dates = get_changed_dates(refresh)
+            refresh_dates(dates)
+            miscounted_dates = get_miscounted_dates()
+            refresh_dates(miscounted_dates)
+            nbr_dates = len(dates | miscounted_dates)
+
+        refresh.refreshed_at = timezone.now()
+        refresh.ticket_modified = ticket_modified
+        refresh.followup_date = followup_date
+        refresh.save()
+    return nbr_dates
+
+
+def get_ticket_daily_stats(queues):
+    """
+    Return the rollup rows of the given queues if the rollup was refreshed
+    recently enough to be used instead of the tickets (see
+    HELPDESK_TICKET_STATS_MAX_AGE), None otherwise.
+    """
+    max_age = helpdesk_settings.HELPDESK_TICKET_STATS_MAX_AGE
+    if not max_age:
+        return None
+    refreshed_since = timezone.now() - timedelta(seconds=max_age)
+    if not TicketStatsRefresh.objects.filter(
+        refreshed_at__gte=refreshed_since
+    ).exists():
+        return None
+    return TicketDailyStat.objects.filter(queue__in=queues)
+
+
+def get_queue_summaries(queues):
+    """
+    Return the number of open, resolved and closed tickets and the time
+    spent on each queue of the given queryset, as a list of dicts in the
+    order of the queues. Runs two queries however many queues there are.
+    """
+    counts = {
+        row["queue"]: row
+        for row in Ticket.objects.filter(queue__in=queues)
+        .order_by()
+        .values("queue")
+        .annotate(
+            open=Count(
+                "id",
+                filter=Q(status__in=(Ticket.OPEN_STATUS, Ticket.REOPENED_STATUS)),
+            ),
+            resolved=Count("id", filter=Q(status=Ticket.RESOLVED_STATUS)),
+            closed=Count("id", filter=Q(status=Ticket.CLOSED_STATUS)),
+        )
+    }
+    summaries = []
+    for queue in queues.with_time_spent():
+        row = counts.get(queue.pk, {})
+        summaries.append(
+            {
+                "queue": queue,
+                "open": row.get("open", 0),
+                "resolved": row.get("resolved", 0),
+                "closed": row.get("closed", 0),
+                "time_spent": queue.time_spent,
+            }
+        )
+    return summaries
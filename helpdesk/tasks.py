@@ -1,7 +1,25 @@
 from .email import process_email
+from .outbox import send_outbound_emails
+from .stats import refresh_ticket_stats
+from .webhooks import send_webhooks
 from celery import shared_task
 
 
 @shared_task
 def helpdesk_process_email():
     process_email()
+
+
+@shared_task
+def helpdesk_refresh_ticket_stats():
+    refresh_ticket_stats()
+
+
+@shared_task
+def helpdesk_send_outbound_emails():
+    send_outbound_emails()
+
+
+@shared_task
+def helpdesk_send_webhooks():
+    send_webhooks()
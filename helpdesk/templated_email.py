@@ -1,12 +1,247 @@
+from contextlib import contextmanager
 from django.conf import settings
+from django.core.cache import cache
+from django.core.mail import get_connection
+from django.db import transaction
+from django.db.models import F, Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.template import engines
 from django.utils.safestring import mark_safe
+from functools import lru_cache
 import logging
 import os
 from smtplib import SMTPException
+import threading
+import uuid
 
 
 logger = logging.getLogger("helpdesk")
 
+EMAIL_TEMPLATES_VERSION_KEY = "helpdesk_email_templates_version"
+EMAIL_TEMPLATE_CACHE_KEY = "helpdesk_email_template_%s_%s_%s"
+
+# Number of messages of an email_session() waiting before they are sent
+EMAIL_SESSION_BATCH_SIZE = 50
+
+# Number of bytes of attachments an email_session() keeps in memory to share
+# them between its messages; above it they are read again if needed
+EMAIL_SESSION_ATTACHMENTS_MAX_SIZE = 10 * 1024 * 1024
+
+_sessions = threading.local()
+
+
+def get_email_template(template_name, locale):
+    """
+    Return the (subject, heading, plain_text, html) of the e-mail template
+    to use for the given name and locale, falling back to the template
+    without locale, or None if there is none. Lookups are cached under a
+    version key which is changed whenever an e-mail template is saved or
+    deleted.
+    """
+    from helpdesk.models import EmailTemplate
+    from helpdesk.settings import HELPDESK_EMAIL_TEMPLATE_CACHE_TIMEOUT
+
+    version = cache.get(EMAIL_TEMPLATES_VERSION_KEY)
+    if version is None:
+        cache.add(
+            EMAIL_TEMPLATES_VERSION_KEY,
+            uuid.uuid4().hex,
+            HELPDESK_EMAIL_TEMPLATE_CACHE_TIMEOUT,
+        )
+        version = cache.get(EMAIL_TEMPLATES_VERSION_KEY)
+    key = EMAIL_TEMPLATE_CACHE_KEY % (version, template_name.lower(), locale)
+    template = cache.get(key)
+    if template is None:
+        template = (
+            EmailTemplate.objects.filter(template_name__iexact=template_name)
+            .filter(Q(locale=locale) | Q(locale__isnull=True))
+            .order_by(F("locale").asc(nulls_last=True), "pk")
+            .values_list("subject", "heading", "plain_text", "html")
+            .first()
+        )
+        # an empty tuple caches the absence of a template
+        template = template or ()
+        cache.set(key, template, HELPDESK_EMAIL_TEMPLATE_CACHE_TIMEOUT)
+    return template or None
+
+
+@lru_cache(maxsize=128)
+def compile_email_template(template, locale):
+    """
+    Compile the subject, plain text and HTML parts of an e-mail template, as
+    returned by get_email_template(). The text of the template is the cache
+    key, so an edited template is compiled again while sending the same
+    notification to many recipients only compiles it once.
+    """
+    from helpdesk.settings import HELPDESK_EMAIL_SUBJECT_TEMPLATE
+
+    from_string = engines["django"].from_string
+    subject, heading, plain_text, html = template
+    footer_file = os.path.join("helpdesk", locale, "email_text_footer.txt")
+    email_html_base_file = os.path.join("helpdesk", locale, "email_html_base.html")
+    return (
+        from_string(HELPDESK_EMAIL_SUBJECT_TEMPLATE % {"subject": subject}),
+        from_string("%s\n\n{%% include '%s' %%}" % (plain_text, footer_file)),
+        from_string(
+            "{%% extends '%s' %%}"
+            "{%% block title %%}%s{%% endblock %%}"
+            "{%% block content %%}%s{%% endblock %%}"
+            % (email_html_base_file, heading, html)
+        ),
+    )
+
+
+@receiver(post_save, sender="helpdesk.EmailTemplate")
+@receiver(post_delete, sender="helpdesk.EmailTemplate")
+def clear_email_templates(sender=None, **kwargs):
+    """
+    Switch to a new cache version when an e-mail template changed, and once
+    more after the commit: a lookup running in between still reads, and
+    caches, the old template.
+    """
+    reset_email_templates_version()
+    transaction.on_commit(reset_email_templates_version)
+
+
+def reset_email_templates_version():
+    from helpdesk.settings import HELPDESK_EMAIL_TEMPLATE_CACHE_TIMEOUT
+
+    cache.set(
+        EMAIL_TEMPLATES_VERSION_KEY,
+        uuid.uuid4().hex,
+        HELPDESK_EMAIL_TEMPLATE_CACHE_TIMEOUT,
+    )
+
+
+def read_attachment(filefield):
+    filefield.open("rb")
+    try:
+        return filefield.read()
+    finally:
+        filefield.close()
+
+
+class EmailSession:
+    """
+    Messages built by send_templated_mail() inside an email_session(),
+    sent in batches over a connection opened once for the whole session.
+    Attachments are read from the storage once, and their content shared by
+    all the messages they are sent with. Past EMAIL_SESSION_ATTACHMENTS_MAX_SIZE
+    bytes, they are let go before reading another one and whenever the
+    waiting messages were sent.
+    """
+
+    def __init__(self):
+        self.connection = None
+        self.pending = []
+        self.attachments = {}
+        self.attachments_size = 0
+
+    def read_attachment(self, filefield):
+        content = self.attachments.get(filefield.name)
+        if content is None:
+            content = read_attachment(filefield)
+            if (
+                self.attachments_size + len(content)
+                > EMAIL_SESSION_ATTACHMENTS_MAX_SIZE
+            ):
+                # the messages built so far hold on to their own content, eg
+                # those sent over an explicit connection never reach flush()
+                self.release_attachments()
+            self.attachments[filefield.name] = content
+            self.attachments_size += len(content)
+        return content
+
+    def release_attachments(self):
+        self.attachments = {}
+        self.attachments_size = 0
+
+    def add(self, msg, fail_silently=False, ticket=None):
+        self.pending.append((msg, fail_silently, ticket))
+        if len(self.pending) >= EMAIL_SESSION_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """
+        Send the waiting messages one by one over the session's connection,
+        returns the number of messages sent. A message that could not be
+        sent does not keep the others from being sent; the error is raised
+        afterwards unless that message was to fail silently.
+        """
+        from helpdesk.models import MessageThread
+
+        batch, self.pending = self.pending, []
+        sent = []
+        error = None
+        for msg, fail_silently, ticket in batch:
+            try:
+                if self.connection is None:
+                    self.connection = get_connection()
+                    self.connection.open()
+                if self.connection.send_messages([msg]):
+                    sent.append((msg, ticket))
+            except SMTPException as e:
+                logger.exception(
+                    "SMTPException raised while sending email to {}".format(msg.to)
+                )
+                # the next message starts over with a new connection
+                self.close_connection()
+                if not fail_silently and error is None:
+                    error = e
+        MessageThread.objects.bulk_create(
+            [
+                MessageThread(message_id=message_id, ticket=ticket, outbound=True)
+                for msg, ticket in sent
+                if ticket is not None
+                for message_id in MessageThread.parse_message_ids(
+                    msg.extra_headers["Message-ID"]
+                )
+            ],
+            ignore_conflicts=True,
+        )
+        if self.attachments_size > EMAIL_SESSION_ATTACHMENTS_MAX_SIZE:
+            # the messages sent no longer hold on to the attachments
+            self.release_attachments()
+        if error is not None:
+            raise error
+        return len(sent)
+
+    def close_connection(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.close_connection()
+            self.attachments = {}
+            self.attachments_size = 0
+
+
+@contextmanager
+def email_session():
+    """
+    Send the messages of all send_templated_mail() calls made inside the
+    block in batches over a single connection, eg a notification to all
+    the people interested in a ticket, instead of one connection per
+    message. The messages are sent when the block exits (or whenever
+    EMAIL_SESSION_BATCH_SIZE are waiting); nested blocks join the session
+    of the outer one.
+    """
+    session = getattr(_sessions, "current", None)
+    if session is not None:
+        yield session
+        return
+    session = _sessions.current = EmailSession()
+    try:
+        yield session
+    finally:
+        _sessions.current = None
+        session.close()
+
 
 def send_templated_mail(
     template_name,
@@ -17,6 +252,8 @@ def send_templated_mail(
     fail_silently=False,
     files=None,
     extra_headers=None,
+    ticket=None,
+    connection=None,
 ):
     """
     send_templated_mail() is a wrapper around Django's e-mail routines that
@@ -46,59 +283,47 @@ def send_templated_mail(
     extra_headers is a dictionary of extra email headers, needed to process
         email replies and keep proper threading.
 
+    ticket is the ticket the message is about, if any. The Message-ID of the
+        message is then recorded so that replies are matched to the ticket.
+
+    connection is the e-mail backend to send the message with, eg to send
+        many messages over a single SMTP connection. Otherwise the message is
+        sent with the email_session() the call is made in, or over a new
+        connection outside of a session.
+
+    Returns the number of messages sent (or waiting in the session), or
+    None if the template does not exist.
+
     """
     from django.core.mail import EmailMultiAlternatives
-    from django.template import engines
-
-    from_string = engines["django"].from_string
+    from django.core.mail.message import make_msgid
 
-    from helpdesk.models import EmailTemplate
-    from helpdesk.settings import (
-        HELPDESK_EMAIL_FALLBACK_LOCALE,
-        HELPDESK_EMAIL_SUBJECT_TEMPLATE,
-    )
+    from helpdesk.models import MessageThread
+    from helpdesk.settings import HELPDESK_EMAIL_FALLBACK_LOCALE
 
-    headers = extra_headers or {}
+    headers = dict(extra_headers or {})
+    if ticket is not None and "Message-ID" not in headers:
+        headers["Message-ID"] = make_msgid()
 
     locale = context["queue"].get("locale") or HELPDESK_EMAIL_FALLBACK_LOCALE
 
-    try:
-        t = EmailTemplate.objects.get(
-            template_name__iexact=template_name, locale=locale
-        )
-    except EmailTemplate.DoesNotExist:
-        try:
-            t = EmailTemplate.objects.get(
-                template_name__iexact=template_name, locale__isnull=True
-            )
-        except EmailTemplate.DoesNotExist:
-            logger.warning('template "%s" does not exist, no mail sent', template_name)
-            return  # just ignore if template doesn't exist
-
-    subject_part = (
-        from_string(HELPDESK_EMAIL_SUBJECT_TEMPLATE % {"subject": t.subject})
-        .render(context)
-        .replace("\n", "")
-        .replace("\r", "")
+    template = get_email_template(template_name, locale)
+    if template is None:
+        logger.warning('template "%s" does not exist, no mail sent', template_name)
+        return  # just ignore if template doesn't exist
+    subject_template, text_template, html_template = compile_email_template(
+        template, locale
     )
 
-    footer_file = os.path.join("helpdesk", locale, "email_text_footer.txt")
+    subject_part = subject_template.render(context).replace("\n", "").replace("\r", "")
 
-    text_part = from_string(
-        "%s\n\n{%% include '%s' %%}" % (t.plain_text, footer_file)
-    ).render(context)
+    text_part = text_template.render(context)
 
-    email_html_base_file = os.path.join("helpdesk", locale, "email_html_base.html")
     # keep new lines in html emails
     if "comment" in context:
         context["comment"] = mark_safe(context["comment"].replace("\r\n", "<br>"))
 
-    html_part = from_string(
-        "{%% extends '%s' %%}"
-        "{%% block title %%}%s{%% endblock %%}"
-        "{%% block content %%}%s{%% endblock %%}"
-        % (email_html_base_file, t.heading, t.html)
-    ).render(context)
+    html_part = html_template.render(context)
 
     if isinstance(recipients, str):
         if recipients.find(","):
@@ -113,19 +338,26 @@ def send_templated_mail(
         recipients,
         bcc=bcc,
         headers=headers,
+        connection=connection,
     )
     msg.attach_alternative(html_part, "text/html")
 
+    session = getattr(_sessions, "current", None)
     if files:
         for filename, filefield in files:
-            filefield.open("rb")
-            content = filefield.read()
+            if session is not None:
+                content = session.read_attachment(filefield)
+            else:
+                content = read_attachment(filefield)
             msg.attach(filename, content)
-            filefield.close()
     logger.debug("Sending email to: {!r}".format(recipients))
 
+    if connection is None and session is not None:
+        session.add(msg, fail_silently=fail_silently, ticket=ticket)
+        return 1
+
     try:
-        return msg.send()
+        sent = msg.send()
     except SMTPException as e:
         logger.exception(
             "SMTPException raised while sending email to {}".format(recipients)
@@ -133,3 +365,7 @@ def send_templated_mail(
         if not fail_silently:
             raise e
         return 0
+    if sent and ticket is not None:
+        message_ids = MessageThread.parse_message_ids(headers["Message-ID"])
+        MessageThread.record(ticket, message_ids, outbound=True)
+    return sent
@@ -1,13 +1,24 @@
 # -*- coding: utf-8 -*-
 
 from django.contrib.auth import get_user_model
-from helpdesk.models import Queue, Ticket
+from helpdesk.models import CustomField, Queue, Ticket
 import sys
 
 
 User = get_user_model()
 
 
+class CustomFieldCacheMixin:
+    """
+    Drop the custom field definitions cached by a test: the test's database
+    changes are rolled back, but the definitions would stay in the cache.
+    """
+
+    def tearDown(self):
+        CustomField.objects.clear_cache()
+        super().tearDown()
+
+
 def get_user(
     username="helpdesk.staff", password="password", is_staff=False, is_superuser=False
 ):
@@ -2,6 +2,8 @@ import base64
 import datetime
 from django.contrib.auth.models import User
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from freezegun import freeze_time
 from helpdesk.models import CustomField, Queue, Ticket
 from rest_framework import HTTP_HEADER_ENCODING
@@ -16,12 +18,13 @@ from rest_framework.status import (
 from rest_framework.test import APITestCase
 from _datetime import timedelta
 from helpdesk.lib import convert_value
+from helpdesk.tests.helpers import CustomFieldCacheMixin
 from django.utils import timezone
 
 frozen_date_time_str = (datetime.datetime.now() - timedelta(days=100)).isoformat()
 
 
-class TicketTest(APITestCase):
+class TicketTest(CustomFieldCacheMixin, APITestCase):
     due_date = timezone.now() - timedelta(days=20)
 
     @classmethod
@@ -343,6 +346,42 @@ class TicketTest(APITestCase):
             },
         )
 
+    def test_list_api_tickets_custom_fields(self):
+        staff_user = User.objects.create_user(username="test", is_staff=True)
+        self.client.force_authenticate(staff_user)
+        CustomField.objects.create(
+            name="hostname", label="Hostname", data_type="varchar"
+        )
+        CustomField.objects.create(name="rack", label="Rack", data_type="integer")
+
+        def list_tickets():
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get("/api/tickets/", {"page_size": 3})
+            self.assertEqual(response.status_code, HTTP_200_OK)
+            return response, len(queries)
+
+        for i in range(2):
+            ticket = Ticket.objects.create(queue=self.queue, title=f"Test {i}")
+            ticket.save_custom_field_values({"custom_hostname": f"host{i}"})
+        response, nbr_queries = list_tickets()
+        self.assertEqual(
+            [
+                (t["custom_hostname"], t["custom_rack"])
+                for t in response.data["results"]
+            ],
+            [("host0", None), ("host1", None)],
+        )
+
+        for i in range(2, 8):
+            ticket = Ticket.objects.create(queue=self.queue, title=f"Test {i}")
+            ticket.save_custom_field_values({"custom_hostname": f"host{i}"})
+        response, more_tickets_nbr_queries = list_tickets()
+        self.assertEqual(len(response.data["results"]), 3)
+        self.assertEqual(response.data["results"][2]["custom_hostname"], "host2")
+        # the custom field values of a page are read at once, whatever the
+        # number of tickets
+        self.assertEqual(more_tickets_nbr_queries, nbr_queries)
+
     def test_create_api_ticket_with_attachment(self):
         staff_user = User.objects.create_user(username="test", is_staff=True)
         self.client.force_authenticate(staff_user)
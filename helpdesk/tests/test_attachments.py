@@ -1,10 +1,12 @@
 # vim: set fileencoding=utf-8 :
 
+from django.core import mail
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.test import override_settings, TestCase
 from django.urls import reverse
 from django.utils.encoding import smart_str
-from helpdesk import lib, models
+from helpdesk import lib, models, outbox, templated_email
+from helpdesk import settings as helpdesk_settings
 import os
 import shutil
 from tempfile import gettempdir
@@ -68,6 +70,117 @@ class AttachmentIntegrationTests(TestCase):
             disk_content = file_on_disk.read()
         self.assertEqual(disk_content, "attached file content")
 
+    def test_attachment_read_once_for_all_recipients(self):
+        ticket = models.Ticket.objects.create(
+            queue=self.queue_public,
+            title="Test Ticket Title",
+            submitter_email="submitter@example.com",
+        )
+        followup = ticket.followup_set.create(title="Attachment")
+        test_file = SimpleUploadedFile(
+            "test_att.txt", b"attached file content", "text/plain"
+        )
+        files = lib.process_attachments(followup, [test_file])
+        context = lib.safe_template_context(ticket)
+        with mock.patch(
+            "helpdesk.templated_email.read_attachment",
+            side_effect=templated_email.read_attachment,
+        ) as read_mock:
+            ticket.send(
+                {
+                    "submitter": ("newticket_submitter", context),
+                    "new_ticket_cc": ("newticket_cc", context),
+                    "ticket_cc": ("newticket_cc", context),
+                },
+                files=files,
+            )
+        self.assertEqual(len(mail.outbox), 3)
+        for msg in mail.outbox:
+            self.assertEqual(
+                msg.attachments,
+                [("test_att.txt", "attached file content", "text/plain")],
+            )
+        self.assertEqual(read_mock.call_count, 1)
+
+    def test_attachment_content_shared_by_messages(self):
+        ticket = models.Ticket.objects.create(
+            queue=self.queue_public, title="Test Ticket Title"
+        )
+        followup = ticket.followup_set.create(title="Attachment")
+        test_file = SimpleUploadedFile(
+            "test_att.pdf", b"%PDF attached file content", "application/pdf"
+        )
+        files = lib.process_attachments(followup, [test_file])
+        context = lib.safe_template_context(ticket)
+        with (
+            mock.patch(
+                "helpdesk.templated_email.EMAIL_SESSION_ATTACHMENTS_MAX_SIZE", 0
+            ),
+            mock.patch(
+                "helpdesk.templated_email.read_attachment",
+                side_effect=templated_email.read_attachment,
+            ) as read_mock,
+        ):
+            with templated_email.email_session() as session:
+                for recipient in ("a@example.com", "b@example.com"):
+                    templated_email.send_templated_mail(
+                        "newticket_cc", context, recipient, files=files
+                    )
+                self.assertEqual(read_mock.call_count, 1)
+                session.flush()
+                # above the maximum size, the content is let go once sent
+                self.assertEqual(session.attachments, {})
+        self.assertIs(
+            mail.outbox[0].attachments[0][1], mail.outbox[1].attachments[0][1]
+        )
+
+    def test_outbox_attachments_size_bounded(self):
+        ticket = models.Ticket.objects.create(
+            queue=self.queue_public,
+            title="Test Ticket Title",
+            submitter_email="submitter@example.com",
+        )
+        context = lib.safe_template_context(ticket)
+        for i in range(5):
+            followup = ticket.followup_set.create(title="Attachment %d" % i)
+            test_file = SimpleUploadedFile(
+                "test_att_%d.pdf" % i, b"%PDF attached file " + b"%d" % i
+            )
+            files = lib.process_attachments(followup, [test_file])
+            with mock.patch.object(helpdesk_settings, "HELPDESK_EMAIL_OUTBOX", True):
+                ticket.send(
+                    {"submitter": ("newticket_submitter", context)}, files=files
+                )
+        self.assertEqual(len(mail.outbox), 0)
+
+        sizes = []
+        read_attachment = templated_email.EmailSession.read_attachment
+
+        def record_size(session, filefield):
+            content = read_attachment(session, filefield)
+            sizes.append(session.attachments_size)
+            return content
+
+        # the outbox sends each e-mail over its own connection, so the
+        # session never flushes
+        with (
+            mock.patch(
+                "helpdesk.templated_email.EMAIL_SESSION_ATTACHMENTS_MAX_SIZE", 20
+            ),
+            mock.patch.object(
+                templated_email.EmailSession,
+                "read_attachment",
+                autospec=True,
+                side_effect=record_size,
+            ),
+        ):
+            self.assertEqual(outbox.send_outbound_emails(), 5)
+        self.assertEqual(sizes, [20] * 5)
+        self.assertEqual(
+            sorted(msg.attachments[0][1] for msg in mail.outbox),
+            [b"%%PDF attached file %d" % i for i in range(5)],
+        )
+
     def test_create_pub_ticket_with_attachment_utf8(self):
         test_file = SimpleUploadedFile("ß°äöü.txt", "โจ".encode("utf-8"), "text/utf-8")
         post_data = self.ticket_data.copy()
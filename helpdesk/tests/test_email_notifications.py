@@ -1,12 +1,25 @@
 import logging
 from django.contrib.auth import get_user_model
 from django.core import mail
+from django.core.mail import get_connection
+from django.core.mail.backends import locmem
+from django.template import engines
 from django.test import TestCase
 from helpdesk import settings as helpdesk_settings
-from helpdesk.models import Queue, Ticket
+from helpdesk.lib import safe_template_context
+from helpdesk.models import EmailTemplate, MessageThread, Queue, Ticket
 from helpdesk.forms import TicketForm
+from helpdesk.templated_email import (
+    clear_email_templates,
+    compile_email_template,
+    email_session,
+    get_email_template,
+    send_templated_mail,
+)
 from helpdesk.views.staff import get_user_queues
 from helpdesk.update_ticket import update_ticket
+from smtplib import SMTPRecipientsRefused
+from unittest import mock
 
 User = get_user_model()
 
@@ -407,3 +420,148 @@ class TicketEmailNotificationTests(TestCase):
             ticket.submitter_email in recipient_list,
             "Submitter email not found in email notifications sent.",
         )
+
+
+class EmailTemplateCacheTests(TestCase):
+    def setUp(self):
+        clear_email_templates()
+        self.addCleanup(clear_email_templates)
+        compile_email_template.cache_clear()
+        queue = Queue.objects.create(title="Queue", slug="queue")
+        ticket = Ticket.objects.create(title="Printer on fire", queue=queue)
+        self.context = safe_template_context(ticket)
+
+    def test_template_compiled_once(self):
+        from_string = engines["django"].from_string
+        with mock.patch.object(
+            engines["django"], "from_string", side_effect=from_string
+        ) as compile_mock:
+            send_templated_mail("newticket_cc", self.context, "a@example.com")
+            with self.assertNumQueries(0):
+                send_templated_mail("newticket_cc", self.context, "b@example.com")
+                send_templated_mail("newticket_cc", self.context, "c@example.com")
+        # subject, plain text and HTML
+        self.assertEqual(compile_mock.call_count, 3)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertIn("Printer on fire", mail.outbox[2].subject)
+
+    def test_edited_template_used(self):
+        send_templated_mail("newticket_cc", self.context, "a@example.com")
+        template = EmailTemplate.objects.get(template_name="newticket_cc", locale="en")
+        template.subject = "(Brand new)"
+        template.save()
+        send_templated_mail("newticket_cc", self.context, "a@example.com")
+        self.assertIn("(Brand new)", mail.outbox[1].subject)
+
+    def test_missing_template_cached(self):
+        self.assertIsNone(get_email_template("no_such_template", "en"))
+        with self.assertNumQueries(0):
+            self.assertIsNone(get_email_template("no_such_template", "en"))
+
+
+class EmailSessionTests(TestCase):
+    def setUp(self):
+        self.queue = Queue.objects.create(
+            title="Queue",
+            slug="queue",
+            new_ticket_cc="new_cc@example.com",
+            updated_ticket_cc="cc@example.com",
+        )
+        self.ticket = Ticket.objects.create(
+            title="Printer on fire",
+            queue=self.queue,
+            submitter_email="submitter@example.com",
+        )
+        self.send_messages = mock.patch.object(
+            locmem.EmailBackend,
+            "send_messages",
+            autospec=True,
+            side_effect=locmem.EmailBackend.send_messages,
+        ).start()
+        self.get_connection = mock.patch(
+            "helpdesk.templated_email.get_connection", side_effect=get_connection
+        ).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_fan_out_sent_over_one_connection(self):
+        context = safe_template_context(self.ticket)
+        self.ticket.send(
+            {
+                "submitter": ("newticket_submitter", context),
+                "new_ticket_cc": ("newticket_cc", context),
+                "ticket_cc": ("newticket_cc", context),
+            }
+        )
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(self.get_connection.call_count, 1)
+        # replies to any of the messages are matched to the ticket
+        message_ids = [msg.extra_headers["Message-ID"] for msg in mail.outbox]
+        self.assertEqual(
+            MessageThread.objects.filter(
+                message_id__in=message_ids, ticket=self.ticket, outbound=True
+            ).count(),
+            3,
+        )
+
+    def test_update_ticket_sent_over_one_connection(self):
+        update_ticket(
+            User.objects.create(username="staff", email="staff@example.com"),
+            self.ticket,
+            comment="Grab a fire extinguisher",
+            public=True,
+        )
+        self.assertEqual(
+            sorted(msg.to[0] for msg in mail.outbox),
+            ["cc@example.com", "submitter@example.com"],
+        )
+        self.assertEqual(self.get_connection.call_count, 1)
+
+    def test_batches(self):
+        context = safe_template_context(self.ticket)
+        with mock.patch("helpdesk.templated_email.EMAIL_SESSION_BATCH_SIZE", 2):
+            with email_session():
+                for i in range(5):
+                    send_templated_mail("newticket_cc", context, f"{i}@example.com")
+                self.assertEqual(len(mail.outbox), 4)
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(self.get_connection.call_count, 1)
+
+    def test_failed_message_does_not_drop_the_others(self):
+        send = self.send_messages.side_effect
+
+        def send_messages(backend, messages):
+            if messages[0].to == ["refused@example.com"]:
+                raise SMTPRecipientsRefused({"refused@example.com": (550, b"No")})
+            return send(backend, messages)
+
+        self.send_messages.side_effect = send_messages
+        context = safe_template_context(self.ticket)
+        with email_session():
+            for recipient in ("a@example.com", "refused@example.com", "b@example.com"):
+                send_templated_mail(
+                    "newticket_cc",
+                    context,
+                    recipient,
+                    fail_silently=True,
+                    ticket=self.ticket,
+                )
+        self.assertEqual(
+            [msg.to for msg in mail.outbox], [["a@example.com"], ["b@example.com"]]
+        )
+        # a new connection is opened after the error
+        self.assertEqual(self.get_connection.call_count, 2)
+        # only the messages sent are matched to the ticket
+        self.assertEqual(
+            set(
+                MessageThread.objects.filter(outbound=True).values_list(
+                    "message_id", flat=True
+                )
+            ),
+            {msg.extra_headers["Message-ID"] for msg in mail.outbox},
+        )
+
+        with self.assertRaises(SMTPRecipientsRefused):
+            with email_session():
+                send_templated_mail("newticket_cc", context, "refused@example.com")
+                send_templated_mail("newticket_cc", context, "c@example.com")
+        self.assertEqual(mail.outbox[-1].to, ["c@example.com"])
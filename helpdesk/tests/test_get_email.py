@@ -3,10 +3,15 @@
 from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import User
 from django.core import mail
-from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+from django.core.cache import cache
 from django.core.management import call_command
 from django.shortcuts import get_object_or_404
-from django.test import override_settings, TestCase
+from datetime import timedelta
+from django.db.models import Q
+from django.test import override_settings, TestCase, TransactionTestCase
+from django.utils import timezone
+from email.message import MIMEPart
 from email.mime.message import MIMEMessage
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
@@ -18,6 +23,7 @@ from helpdesk.models import (
     FollowUp,
     FollowUpAttachment,
     IgnoreEmail,
+    IngestedEmail,
     Queue,
     Ticket,
     TicketCC,
@@ -31,6 +37,7 @@ import os
 from shutil import rmtree
 import sys
 from tempfile import mkdtemp
+import threading
 import time
 import typing
 from unittest import mock
@@ -46,6 +53,51 @@ unused_port = "49151"
 fake_time = time.time()
 
 
+def mock_imap_server(messages, uidvalidity=1):
+    """
+    Mock an imaplib.IMAP4 server whose selected folder holds the given
+    {uid: message} messages, answering the UID SEARCH, FETCH and STORE
+    commands as described by RFC 3501.
+    """
+    server = mock.Mock()
+    server.response = mock.Mock(
+        return_value=("UIDVALIDITY", [str(uidvalidity).encode()])
+    )
+
+    def uid(command, *args):
+        if command == "search":
+            first = int(args[2].split(":")[0])
+            uids = [uid for uid in sorted(messages) if uid >= first]
+            return ("OK", [" ".join(str(uid) for uid in uids).encode()])
+        if command == "fetch":
+            data = []
+            for part in args[0].split(","):
+                first, _, last = part.partition(":")
+                for uid in range(int(first), int(last or first) + 1):
+                    if uid in messages:
+                        raw = messages[uid]
+                        if isinstance(raw, str):
+                            raw = raw.encode()
+                        envelope = b"%d (UID %d RFC822.SIZE %d BODY[] {%d}" % (
+                            uid,
+                            uid,
+                            len(raw),
+                            len(raw),
+                        )
+                        data += [(envelope, raw), b")"]
+            return ("OK", data)
+        if command == "store":
+            server.deleted_uids.extend(
+                int(uid) for uid in args[0].replace(":", ",").split(",")
+            )
+            return ("OK", [])
+        raise AssertionError("Unexpected UID command %s" % command)
+
+    server.uid = mock.Mock(side_effect=uid)
+    server.deleted_uids = []
+    return server
+
+
 class GetEmailCommonTests(TestCase):
     @classmethod
     def setUpClass(cls):
@@ -233,6 +285,81 @@ class GetEmailCommonTests(TestCase):
         with self.assertRaises(IgnoreTicketException):
             extract_email_metadata(message.as_string(), self.queue_public, self.logger)
 
+    def test_ignore_email_rules(self):
+        """
+        Tests the wildcard patterns of ignored addresses, per queue, and that
+        changes to the rules are picked up
+        """
+        # the cached rules outlive the rollback of the test
+        self.addCleanup(cache.delete, helpdesk.email.IGNORE_EMAIL_CACHE_KEY)
+        other_queue = Queue.objects.create(title="Other", slug="other")
+        IgnoreEmail.objects.create(
+            name="Sub-domains", email_address="*@*.example.com", keep_in_mailbox=True
+        )
+        postmaster = IgnoreEmail.objects.create(
+            name="Postmaster", email_address="postmaster@*", keep_in_mailbox=False
+        )
+        postmaster.queues.add(other_queue)
+
+        def ignore_rule(email_address, queue=self.queue_public):
+            rule = helpdesk.email.get_ignore_rule(queue, email_address)
+            return rule and IgnoreEmail.objects.get(pk=rule[0]).name
+
+        self.assertEqual(ignore_rule("jo@mail.EXAMPLE.com"), "Sub-domains")
+        self.assertEqual(ignore_rule("jo@a.b.example.com"), "Sub-domains")
+        self.assertIsNone(ignore_rule("jo@example.com"))
+        self.assertIsNone(ignore_rule("postmaster@example.org"))
+        self.assertEqual(
+            ignore_rule("postmaster@example.org", other_queue), "Postmaster"
+        )
+        # the first rule matching wins
+        self.assertEqual(
+            ignore_rule("postmaster@mail.example.com", other_queue), "Sub-domains"
+        )
+        self.assertIsNone(ignore_rule("Unknown Sender"))
+
+        postmaster.queues.clear()
+        self.assertEqual(ignore_rule("postmaster@example.org"), "Postmaster")
+        postmaster.delete()
+        self.assertIsNone(ignore_rule("postmaster@example.org"))
+        everyone = IgnoreEmail.objects.create(name="Everyone", email_address="*@*")
+        self.assertEqual(ignore_rule("Unknown Sender"), "Everyone")
+        self.assertTrue(everyone.test("jo@example.com"))
+        domain = IgnoreEmail(email_address="*@example.com")
+        self.assertTrue(domain.test("a@example.com"))
+        self.assertFalse(domain.test("a@b.com"))
+
+    def test_duplicate_delivery_ingested_once(self):
+        """
+        An e-mail polled again, eg because it could not be deleted from the
+        mailbox, does not create another ticket
+        """
+        message, _, _ = utils.generate_text_email(locale="en_US")
+        message["Message-ID"] = "<duplicate@example.com>"
+        ticket = extract_email_metadata(
+            message.as_bytes(), self.queue_public, self.logger
+        )
+        self.assertEqual(
+            extract_email_metadata(message.as_bytes(), self.queue_public, self.logger),
+            ticket,
+        )
+        self.assertEqual(Ticket.objects.count(), 1)
+        self.assertEqual(FollowUp.objects.count(), 1)
+        ingested = IngestedEmail.objects.get()
+        self.assertEqual(ingested.ticket, ticket)
+
+        # same Message-ID, different content
+        message.set_payload("Another body")
+        extract_email_metadata(message.as_bytes(), self.queue_public, self.logger)
+        self.assertEqual(Ticket.objects.count(), 2)
+
+        # the ledger is purged after the retention window
+        IngestedEmail.objects.filter(pk=ingested.pk).update(
+            ingested_at=timezone.now() - timedelta(days=8)
+        )
+        helpdesk.email.purge_ingested_emails(self.queue_public)
+        self.assertEqual(IngestedEmail.objects.count(), 1)
+
     def test_utf8_filename_attachment(self):
         """
         Tests if an attachment correctly sent with a UTF8 filename in disposition is extracted correctly
@@ -291,6 +418,68 @@ class GetEmailCommonTests(TestCase):
         followup = ticket.followup_set.get()
         self.assertEqual(2, followup.followupattachment_set.count())
 
+    def test_attachment_larger_than_max_size(self):
+        """
+        Attachments over HELPDESK_MAX_ATTACHMENT_SIZE are dropped before their
+        payload is decoded
+        """
+        message, _, _ = utils.generate_multipart_email(type_list=["plain"])
+        message.attach(
+            utils.generate_file_mime_part(filename="small.txt", content="x" * 100)
+        )
+        message.attach(
+            utils.generate_file_mime_part(filename="big.txt", content="x" * 3000)
+        )
+        with (
+            mock.patch.object(
+                helpdesk.email.helpdesk_settings, "HELPDESK_MAX_ATTACHMENT_SIZE", 1000
+            ),
+            mock.patch.object(
+                MIMEPart, "get_payload", autospec=True, side_effect=MIMEPart.get_payload
+            ) as mocked_get_payload,
+        ):
+            extract_email_metadata(message.as_bytes(), self.queue_public, self.logger)
+        decoded = [
+            call.args[0].get_filename()
+            for call in mocked_get_payload.call_args_list
+            if call.kwargs.get("decode")
+        ]
+        self.assertIn("small.txt", decoded)
+        self.assertNotIn("big.txt", decoded)
+        followup = Ticket.objects.get().followup_set.get()
+        self.assertEqual(
+            ["part-1_small.txt"],
+            [att.filename for att in followup.followupattachment_set.all()],
+        )
+
+    @override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=1000)
+    def test_large_attachment_spooled_to_file(self):
+        """
+        Attachments larger than FILE_UPLOAD_MAX_MEMORY_SIZE are not kept in
+        memory
+        """
+        small = helpdesk.email.get_email_attachment_file(
+            "small.txt", b"x" * 1000, "text/plain"
+        )
+        self.assertIsInstance(small, SimpleUploadedFile)
+        large = helpdesk.email.get_email_attachment_file(
+            "large.txt", b"x" * 1001, "text/plain"
+        )
+        self.assertIsInstance(large, TemporaryUploadedFile)
+        self.assertEqual(large.size, 1001)
+        self.assertEqual(large.read(), b"x" * 1001)
+        large.close()
+
+        message, _, _ = utils.generate_multipart_email(type_list=["plain"])
+        message.attach(
+            utils.generate_file_mime_part(filename="large.txt", content="x" * 3000)
+        )
+        extract_email_metadata(message.as_bytes(), self.queue_public, self.logger)
+        attachment = FollowUpAttachment.objects.get()
+        self.assertEqual(attachment.size, 3000)
+        with attachment.file.open("rb") as f:
+            self.assertEqual(f.read(), b"x" * 3000)
+
     def test_multiple_attachments_with_wrong_extension(self):
         """
         Tests that a wrong extension won't stop from saving other valid attachment
@@ -553,11 +742,8 @@ class GetEmailCommonTests(TestCase):
             "Email attachment file not found in ticket attachment for empty body.",
         )
 
-    @patch("helpdesk.email.get_ticket_id_from_subject_slug")
     @patch("helpdesk.email.create_object_from_email_message")
-    def test_ticket_id_lookup_across_queues(
-        self, mock_create_object, mock_get_ticket_id
-    ):
+    def test_ticket_id_lookup_across_queues(self, mock_create_object):
         """
         Tests the logic for finding a ticket ID:
         1. Not found in the current queue.
@@ -568,81 +754,43 @@ class GetEmailCommonTests(TestCase):
         queue_other1 = Queue.objects.create(
             title="Other Queue 1", slug="other1", email_box_type="local"
         )
-        queue_other2 = Queue.objects.create(
+        Queue.objects.create(
             title="Other Queue 2", slug="other2", email_box_type="local"
         )
+        Queue.objects.create(title="No mailbox", slug="nomail")
 
-        # Scenario 1: Ticket ID not found in current queue, then found in another queue
-        mock_get_ticket_id.side_effect = [
-            None,  # Not found in self.queue_public
-            123,  # Found in queue_other1
-        ]
-
-        # We need to mock Queue.objects.exclude().filter() to return our specific other queues
-        with patch("helpdesk.models.Queue.objects") as mock_queue_objects:
-            mock_queue_objects.exclude.return_value.filter.return_value = [
-                queue_other1,
-                queue_other2,
-            ]
-
-            message, _, _ = utils.generate_email_with_subject(
-                subject="[other1-123] Test Subject"
-            )
-            ticket = extract_email_metadata(
-                message.as_string(), self.queue_public, self.logger
-            )  # noqa
-
-            # Assert get_ticket_id_from_subject_slug was called for current and then other1
-            mock_get_ticket_id.assert_has_calls(
-                [
-                    mock.call(self.queue_public.slug, mock.ANY, self.logger),
-                    mock.call(queue_other1.slug, mock.ANY, self.logger),
-                ]
-            )
-
-            # Assert that create_object_from_email_message was called with the ticket ID and the other queue
+        def lookup(subject):
+            mock_create_object.reset_mock()
+            message, _, _ = utils.generate_email_with_subject(subject=subject)
+            extract_email_metadata(message.as_string(), self.queue_public, self.logger)
             mock_create_object.assert_called_once()
             args, kwargs = mock_create_object.call_args
-            self.assertEqual(args[1], 123)  # ticket_id
-            self.assertEqual(args[2]["queue"], queue_other1)  # payload
+            return args[2]["queue"], args[1]
 
-        mock_get_ticket_id.reset_mock()
-        mock_create_object.reset_mock()
-
-        # Scenario 2: Ticket ID not found in any queue, leading to a new ticket in the original queue
-        mock_get_ticket_id.side_effect = [
-            None,  # Not found in self.queue_public
-            None,  # Not found in queue_other1
-            None,  # Not found in queue_other2
-        ]
-
-        with patch("helpdesk.models.Queue.objects") as mock_queue_objects:
-            mock_queue_objects.exclude.return_value.filter.return_value = [
-                queue_other1,
-                queue_other2,
-            ]
+        # Scenario 1: Ticket ID not found in current queue, then found in another queue
+        self.assertEqual(lookup("[other1-123] Test Subject"), (queue_other1, 123))
 
-            message, _, _ = utils.generate_email_with_subject(
-                subject="[nonexistent-456] New Ticket Subject"
-            )
-            ticket = extract_email_metadata(  # noqa
-                message.as_string(), self.queue_public, self.logger
-            )
+        # Scenario 2: Ticket ID not found in any queue, leading to a new ticket
+        # in the original queue
+        self.assertEqual(
+            lookup("[nonexistent-456] New Ticket Subject"), (self.queue_public, None)
+        )
+        # queues without a mailbox are only matched as the current queue
+        self.assertEqual(lookup("[nomail-7] Subject"), (self.queue_public, None))
 
-            # Assert get_ticket_id_from_subject_slug was called for all queues
-            mock_get_ticket_id.assert_has_calls(
-                [
-                    mock.call(self.queue_public.slug, mock.ANY, self.logger),
-                    mock.call(queue_other1.slug, mock.ANY, self.logger),
-                    mock.call(queue_other2.slug, mock.ANY, self.logger),
-                ]
-            )
+        # the current queue wins, and the last of its tracking IDs
+        self.assertEqual(
+            lookup("Re: [other1-5] Re: [test-8] Fwd: [test-9] Subject"),
+            (self.queue_public, 9),
+        )
 
-            # Assert that create_object_from_email_message was called with None ticket_id and the original queue
-            mock_create_object.assert_called_once()
-            args, kwargs = mock_create_object.call_args
-            self.assertIsNone(args[1])
-            self.assertEqual(args[2]["queue"], self.queue_public)
+        # queues created afterwards are matched too
+        queue_new = Queue.objects.create(
+            title="New", slug="other1-new", email_box_type="local"
+        )
+        self.assertEqual(lookup("[other1-new-3] Subject"), (queue_new, 3))
+        queue_new.delete()
+        self.assertEqual(lookup("[other1-new-3] Subject"), (self.queue_public, None))
 
 
 class EmailTaskTests(TestCase):
@@ -699,6 +847,161 @@ class EmailTaskTests(TestCase):
             "Incorrect number of queues that did not get processed due to a forced exception.",
         )
 
+    @patch("helpdesk.email.process_queue")
+    def test_get_email_skips_locked_queue(self, mocked_process_queue):
+        """Test a queue claimed by another run is not polled again"""
+        locked_queue = Queue.objects.get(pk=self.q_ids[0])
+        self.assertTrue(helpdesk.email.lock_queue(locked_queue))
+        self.assertFalse(helpdesk.email.lock_queue(locked_queue))
+        call_command("get_email")
+        self.assertEqual(mocked_process_queue.call_count, self.num_queues - 1)
+        locked_queue.refresh_from_db()
+        self.assertIsNone(locked_queue.email_box_last_check)
+        # the other queues were released once processed
+        self.assertFalse(
+            Queue.objects.exclude(pk=locked_queue.pk)
+            .filter(email_box_locked_until__isnull=False)
+            .exists()
+        )
+
+    @patch("helpdesk.email.process_queue")
+    def test_get_email_with_expired_lock(self, mocked_process_queue):
+        """Test a claim left behind by a crashed run eventually expires"""
+        Queue.objects.update(
+            email_box_locked_until=timezone.now() - timedelta(seconds=1)
+        )
+        call_command("get_email")
+        self.assertEqual(mocked_process_queue.call_count, self.num_queues)
+
+
+class EmailWorkersTests(TransactionTestCase):
+    def setUp(self):
+        self.num_queues = 4
+        for i in range(self.num_queues):
+            Queue.objects.create(
+                title=f"Test{i + 1}",
+                slug=f"test{i + 1}",
+                email_box_type="local",
+                allow_email_submission=True,
+            )
+
+    def test_get_email_with_workers(self):
+        """Test the mailboxes are polled concurrently with --workers"""
+        # The call count of a mock is not thread safe, so calls are listed.
+        # Concurrent queries to the in-memory test database fail with
+        # "database table is locked", so the threads poll one at a time.
+        calls = []
+        lock = threading.Lock()
+        poll_queue_in_thread = helpdesk.email.poll_queue_in_thread
+
+        def poll_queue_locked(*args, **kwargs):
+            with lock:
+                poll_queue_in_thread(*args, **kwargs)
+
+        def process_queue(q, logger, timeout):
+            calls.append((q.slug, timeout))
+
+        with patch("helpdesk.email.process_queue", side_effect=process_queue):
+            with patch(
+                "helpdesk.email.poll_queue_in_thread", side_effect=poll_queue_locked
+            ):
+                call_command("get_email", "--workers", "3", "--timeout", "5")
+        self.assertEqual(
+            sorted(calls), [(f"test{i + 1}", 5) for i in range(self.num_queues)]
+        )
+        self.assertFalse(
+            Queue.objects.filter(
+                Q(email_box_last_check__isnull=True)
+                | Q(email_box_locked_until__isnull=False)
+            ).exists()
+        )
+
+
+class ImapSyncTests(TestCase):
+    def setUp(self):
+        self.queue = Queue.objects.create(
+            title="Test",
+            slug="test",
+            email_box_type="imap",
+            allow_email_submission=True,
+        )
+        self.logger = logging.getLogger("helpdesk")
+
+    def message(self, number):
+        return (
+            "From: submitter@example.com\n"
+            "Subject: Message %d\n"
+            "Message-ID: <message-%d@example.com>\n\n"
+            "Body %d\n" % (number, number, number)
+        )
+
+    def test_uid_set(self):
+        self.assertEqual(helpdesk.email.imap_uid_set([1, 2, 3, 7, 9, 10]), "1:3,7,9:10")
+        self.assertEqual(helpdesk.email.imap_uid_set([5]), "5")
+
+    def test_batched_incremental_sync(self):
+        server = mock_imap_server({uid: self.message(uid) for uid in (3, 4, 5)})
+        with mock.patch.object(
+            helpdesk.email.helpdesk_settings, "QUEUE_EMAIL_BOX_IMAP_BATCH_SIZE", 2
+        ):
+            helpdesk.email.imap_sync_messages(self.queue, self.logger, server)
+        self.assertEqual(Ticket.objects.count(), 3)
+        self.assertEqual(server.deleted_uids, [3, 4, 5])
+        # two batches, each fetched and expunged at once
+        fetches = [c.args[1] for c in server.uid.call_args_list if c.args[0] == "fetch"]
+        self.assertEqual(fetches, ["3:4", "5"])
+        self.assertEqual(server.expunge.call_count, 2)
+        self.queue.refresh_from_db()
+        self.assertEqual(self.queue.email_box_imap_uidvalidity, 1)
+        self.assertEqual(self.queue.email_box_imap_last_uid, 5)
+
+        # messages left on the server are not fetched again
+        server = mock_imap_server({uid: self.message(uid) for uid in (4, 5, 6)})
+        helpdesk.email.imap_sync_messages(self.queue, self.logger, server)
+        self.assertEqual(Ticket.objects.count(), 4)
+        self.assertEqual(server.deleted_uids, [6])
+        self.assertEqual(self.queue.email_box_imap_last_uid, 6)
+
+    def test_failed_message_searched_again(self):
+        server = mock_imap_server({uid: self.message(uid) for uid in (3, 4, 5, 6)})
+        extract_email_metadata = helpdesk.email.extract_email_metadata
+
+        def ignore_message_4(message, queue, logger):
+            if b"Message 4" in message:
+                raise IgnoreTicketException()
+            return extract_email_metadata(message=message, queue=queue, logger=logger)
+
+        with (
+            mock.patch.object(
+                helpdesk.email.helpdesk_settings, "QUEUE_EMAIL_BOX_IMAP_BATCH_SIZE", 2
+            ),
+            mock.patch.object(
+                helpdesk.email, "extract_email_metadata", side_effect=ignore_message_4
+            ),
+        ):
+            helpdesk.email.imap_sync_messages(self.queue, self.logger, server)
+        self.assertEqual(Ticket.objects.count(), 3)
+        self.assertEqual(server.deleted_uids, [3, 5, 6])
+        # the last UID stops before the message left on the server
+        self.assertEqual(self.queue.email_box_imap_last_uid, 3)
+
+        server = mock_imap_server({uid: self.message(uid) for uid in (4, 7)})
+        helpdesk.email.imap_sync_messages(self.queue, self.logger, server)
+        self.assertEqual(Ticket.objects.count(), 5)
+        self.assertEqual(server.deleted_uids, [4, 7])
+        self.assertEqual(self.queue.email_box_imap_last_uid, 7)
+
+    def test_uidvalidity_change_resyncs(self):
+        self.queue.email_box_imap_uidvalidity = 1
+        self.queue.email_box_imap_last_uid = 10
+        self.queue.save()
+        server = mock_imap_server({1: self.message(1)}, uidvalidity=2)
+        helpdesk.email.imap_sync_messages(self.queue, self.logger, server)
+        self.assertEqual(Ticket.objects.count(), 1)
+        self.queue.refresh_from_db()
+        self.assertEqual(self.queue.email_box_imap_uidvalidity, 2)
+        self.assertEqual(self.queue.email_box_imap_last_uid, 1)
+
 
 class GetEmailParametricTemplate(object):
     """TestCase that checks basic email functionality across methods and socks configs."""
@@ -809,20 +1112,9 @@ class GetEmailParametricTemplate(object):
                     call_command("get_email")
 
             elif self.method == "imap":
-                # mock imaplib.IMAP4's search and fetch methods with responses
+                # mock imaplib.IMAP4's UID commands with responses
                 # from RFC 3501
-                imap_emails = {
-                    "1": ("OK", (("1", test_email),)),
-                    "2": ("OK", (("2", test_email),)),
-                }
-                imap_mail_list = ("OK", ("1 2",))
-                mocked_imaplib_server = mock.Mock()
-                mocked_imaplib_server.search = mock.Mock(return_value=imap_mail_list)
-                # we ignore the second arg as the data item/mime-part is
-                # constant (RFC822)
-                mocked_imaplib_server.fetch = mock.Mock(
-                    side_effect=lambda x, _: imap_emails[x]
-                )
+                mocked_imaplib_server = mock_imap_server({1: test_email, 2: test_email})
                 with mock.patch(
                     "helpdesk.email.imaplib", autospec=True
                 ) as mocked_imaplib:
@@ -831,20 +1123,9 @@ class GetEmailParametricTemplate(object):
 
             elif self.method == "oauth":
                 # mock the oauthlib session and requests oauth backendclient
-                # then mock imaplib.IMAP4's search and fetch methods with responses
+                # then mock imaplib.IMAP4's UID commands with responses
                 # from RFC 3501
-                imap_emails = {
-                    "1": ("OK", (("1", test_email),)),
-                    "2": ("OK", (("2", test_email),)),
-                }
-                imap_mail_list = ("OK", ("1 2",))
-                mocked_imaplib_server = mock.Mock()
-                mocked_imaplib_server.search = mock.Mock(return_value=imap_mail_list)
-                # we ignore the second arg as the data item/mime-part is
-                # constant (RFC822)
-                mocked_imaplib_server.fetch = mock.Mock(
-                    side_effect=lambda x, _: imap_emails[x]
-                )
+                mocked_imaplib_server = mock_imap_server({1: test_email, 2: test_email})
 
                 mocked_oauth_backend_client = mock.Mock()
                 with mock.patch(
@@ -952,20 +1233,9 @@ class GetEmailParametricTemplate(object):
                     call_command("get_email")
 
             elif self.method == "imap":
-                # mock imaplib.IMAP4's search and fetch methods with responses
+                # mock imaplib.IMAP4's UID commands with responses
                 # from RFC 3501
-                imap_emails = {
-                    "1": ("OK", (("1", test_email),)),
-                    "2": ("OK", (("2", test_email),)),
-                }
-                imap_mail_list = ("OK", ("1 2",))
-                mocked_imaplib_server = mock.Mock()
-                mocked_imaplib_server.search = mock.Mock(return_value=imap_mail_list)
-                # we ignore the second arg as the data item/mime-part is
-                # constant (RFC822)
-                mocked_imaplib_server.fetch = mock.Mock(
-                    side_effect=lambda x, _: imap_emails[x]
-                )
+                mocked_imaplib_server = mock_imap_server({1: test_email, 2: test_email})
                 with mock.patch(
                     "helpdesk.email.imaplib", autospec=True
                 ) as mocked_imaplib:
@@ -974,20 +1244,9 @@ class GetEmailParametricTemplate(object):
 
             elif self.method == "oauth":
                 # mock the oauthlib session and requests oauth backendclient
-                # then mock imaplib.IMAP4's search and fetch methods with responses
+                # then mock imaplib.IMAP4's UID commands with responses
                 # from RFC 3501
-                imap_emails = {
-                    "1": ("OK", (("1", test_email),)),
-                    "2": ("OK", (("2", test_email),)),
-                }
-                imap_mail_list = ("OK", ("1 2",))
-                mocked_imaplib_server = mock.Mock()
-                mocked_imaplib_server.search = mock.Mock(return_value=imap_mail_list)
-                # we ignore the second arg as the data item/mime-part is
-                # constant (RFC822)
-                mocked_imaplib_server.fetch = mock.Mock(
-                    side_effect=lambda x, _: imap_emails[x]
-                )
+                mocked_imaplib_server = mock_imap_server({1: test_email, 2: test_email})
 
                 mocked_oauth_backend_client = mock.Mock()
                 with mock.patch(
@@ -1099,20 +1358,9 @@ class GetEmailParametricTemplate(object):
                     call_command("get_email")
 
             elif self.method == "imap":
-                # mock imaplib.IMAP4's search and fetch methods with responses
+                # mock imaplib.IMAP4's UID commands with responses
                 # from RFC 3501
-                imap_emails = {
-                    "1": ("OK", (("1", test_email),)),
-                    "2": ("OK", (("2", test_email),)),
-                }
-                imap_mail_list = ("OK", ("1 2",))
-                mocked_imaplib_server = mock.Mock()
-                mocked_imaplib_server.search = mock.Mock(return_value=imap_mail_list)
-                # we ignore the second arg as the data item/mime-part is
-                # constant (RFC822)
-                mocked_imaplib_server.fetch = mock.Mock(
-                    side_effect=lambda x, _: imap_emails[x]
-                )
+                mocked_imaplib_server = mock_imap_server({1: test_email, 2: test_email})
                 with mock.patch(
                     "helpdesk.email.imaplib", autospec=True
                 ) as mocked_imaplib:
@@ -1121,20 +1369,9 @@ class GetEmailParametricTemplate(object):
 
             elif self.method == "oauth":
                 # mock the oauthlib session and requests oauth backendclient
-                # then mock imaplib.IMAP4's search and fetch methods with responses
+                # then mock imaplib.IMAP4's UID commands with responses
                 # from RFC 3501
-                imap_emails = {
-                    "1": ("OK", (("1", test_email),)),
-                    "2": ("OK", (("2", test_email),)),
-                }
-                imap_mail_list = ("OK", ("1 2",))
-                mocked_imaplib_server = mock.Mock()
-                mocked_imaplib_server.search = mock.Mock(return_value=imap_mail_list)
-                # we ignore the second arg as the data item/mime-part is
-                # constant (RFC822)
-                mocked_imaplib_server.fetch = mock.Mock(
-                    side_effect=lambda x, _: imap_emails[x]
-                )
+                mocked_imaplib_server = mock_imap_server({1: test_email, 2: test_email})
 
                 mocked_oauth_backend_client = mock.Mock()
                 with mock.patch(
@@ -1271,19 +1508,10 @@ class GetEmailParametricTemplate(object):
                     call_command("get_email")
 
             elif self.method == "imap":
-                # mock imaplib.IMAP4's search and fetch methods with responses
+                # mock imaplib.IMAP4's UID commands with responses
                 # from RFC 3501
-                imap_emails = {
-                    "1": ("OK", (("1", msg.as_string()),)),
-                    "2": ("OK", (("2", msg.as_string()),)),
-                }
-                imap_mail_list = ("OK", ("1 2",))
-                mocked_imaplib_server = mock.Mock()
-                mocked_imaplib_server.search = mock.Mock(return_value=imap_mail_list)
-                # we ignore the second arg as the data item/mime-part is
-                # constant (RFC822)
-                mocked_imaplib_server.fetch = mock.Mock(
-                    side_effect=lambda x, _: imap_emails[x]
+                mocked_imaplib_server = mock_imap_server(
+                    {1: msg.as_string(), 2: msg.as_string()}
                 )
                 with mock.patch(
                     "helpdesk.email.imaplib", autospec=True
@@ -1293,19 +1521,10 @@ class GetEmailParametricTemplate(object):
 
             elif self.method == "oauth":
                 # mock the oauthlib session and requests oauth backendclient
-                # then mock imaplib.IMAP4's search and fetch methods with responses
+                # then mock imaplib.IMAP4's UID commands with responses
                 # from RFC 3501
-                imap_emails = {
-                    "1": ("OK", (("1", msg.as_string()),)),
-                    "2": ("OK", (("2", msg.as_string()),)),
-                }
-                imap_mail_list = ("OK", ("1 2",))
-                mocked_imaplib_server = mock.Mock()
-                mocked_imaplib_server.search = mock.Mock(return_value=imap_mail_list)
-                # we ignore the second arg as the data item/mime-part is
-                # constant (RFC822)
-                mocked_imaplib_server.fetch = mock.Mock(
-                    side_effect=lambda x, _: imap_emails[x]
+                mocked_imaplib_server = mock_imap_server(
+                    {1: msg.as_string(), 2: msg.as_string()}
                 )
 
                 mocked_oauth_backend_client = mock.Mock()
@@ -1418,19 +1637,9 @@ class GetEmailParametricTemplate(object):
                     call_command("get_email")
 
             elif self.method == "imap":
-                # mock imaplib.IMAP4's search and fetch methods with responses
+                # mock imaplib.IMAP4's UID commands with responses
                 # from RFC 3501
-                imap_emails = {
-                    "1": ("OK", (("1", test_email),)),
-                }
-                imap_mail_list = ("OK", ("1",))
-                mocked_imaplib_server = mock.Mock()
-                mocked_imaplib_server.search = mock.Mock(return_value=imap_mail_list)
-                # we ignore the second arg as the data item/mime-part is
-                # constant (RFC822)
-                mocked_imaplib_server.fetch = mock.Mock(
-                    side_effect=lambda x, _: imap_emails[x]
-                )
+                mocked_imaplib_server = mock_imap_server({1: test_email})
                 with mock.patch(
                     "helpdesk.email.imaplib", autospec=True
                 ) as mocked_imaplib:
@@ -1439,19 +1648,9 @@ class GetEmailParametricTemplate(object):
 
             elif self.method == "oauth":
                 # mock the oauthlib session and requests oauth backendclient
-                # then mock imaplib.IMAP4's search and fetch methods with responses
+                # then mock imaplib.IMAP4's UID commands with responses
                 # from RFC 3501
-                imap_emails = {
-                    "1": ("OK", (("1", test_email),)),
-                }
-                imap_mail_list = ("OK", ("1",))
-                mocked_imaplib_server = mock.Mock()
-                mocked_imaplib_server.search = mock.Mock(return_value=imap_mail_list)
-                # we ignore the second arg as the data item/mime-part is
-                # constant (RFC822)
-                mocked_imaplib_server.fetch = mock.Mock(
-                    side_effect=lambda x, _: imap_emails[x]
-                )
+                mocked_imaplib_server = mock_imap_server({1: test_email})
 
                 mocked_oauth_backend_client = mock.Mock()
                 with mock.patch(
@@ -1675,6 +1874,32 @@ class GetEmailCCHandling(TestCase):
         self.assertEqual(cc9.user, User.objects.get(username="observer"))
         self.assertEqual(cc9.email, "observer@example.com")
 
+    def test_create_ticket_cc_in_bulk(self):
+        """CC'd addresses are resolved and subscribed in a fixed number of queries"""
+        logger = logging.getLogger("helpdesk")
+        cc_list = [("", "cc%d@example.com" % i) for i in range(50)]
+        cc_list += [
+            ("", "observer@example.com"),
+            ("", "queue@example.com"),
+            ("", "cc1@example.com"),
+            ("", "x@y"),
+        ]
+        with self.assertNumQueries(3):
+            ticket_ccs = helpdesk.email.create_ticket_cc(
+                self.original_ticket, cc_list, logger
+            )
+        self.assertEqual(len(ticket_ccs), 51)
+        self.assertEqual(ticket_ccs[-1].user, self.observer_user)
+        self.assertEqual(
+            TicketCC.objects.filter(ticket=self.original_ticket).count(), 1 + 51
+        )
+        # subscribing again finds the existing subscriptions
+        with self.assertNumQueries(2):
+            helpdesk.email.create_ticket_cc(self.original_ticket, cc_list, logger)
+        self.assertEqual(
+            TicketCC.objects.filter(ticket=self.original_ticket).count(), 1 + 51
+        )
+
 
 # build matrix of test cases
 case_methods = [c[0] for c in Queue._meta.get_field("email_box_type").choices]
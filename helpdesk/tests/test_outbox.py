@@ -0,0 +1,102 @@
+from datetime import timedelta
+from django.core import mail
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+from helpdesk import settings as helpdesk_settings
+from helpdesk.lib import safe_template_context
+from helpdesk.models import MessageThread, OutboundEmail, Queue, Ticket
+from helpdesk.outbox import send_outbound_emails
+from helpdesk.update_ticket import update_ticket
+from helpdesk.tests.helpers import get_staff_user
+from io import StringIO
+from smtplib import SMTPException
+from unittest import mock
+
+
+@mock.patch.object(helpdesk_settings, "HELPDESK_EMAIL_OUTBOX", True)
+class OutboxTests(TestCase):
+    def setUp(self):
+        self.queue = Queue.objects.create(
+            title="Queue",
+            slug="queue",
+            updated_ticket_cc="cc@example.com",
+        )
+        self.ticket = Ticket.objects.create(
+            title="Printer on fire",
+            queue=self.queue,
+            submitter_email="submitter@example.com",
+            description="Smoke everywhere",
+        )
+
+    def test_update_ticket_only_enqueues(self):
+        update_ticket(
+            get_staff_user(),
+            self.ticket,
+            comment="Grab a fire extinguisher",
+            public=True,
+        )
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(
+            sorted(OutboundEmail.objects.values_list("recipients", flat=True)),
+            ["cc@example.com", "submitter@example.com"],
+        )
+
+        out = StringIO()
+        call_command("send_outbound_emails", stdout=out)
+        self.assertIn("Sent 2 e-mails", out.getvalue())
+        self.assertEqual(
+            sorted(email.to[0] for email in mail.outbox),
+            ["cc@example.com", "submitter@example.com"],
+        )
+        self.assertIn("Grab a fire extinguisher", mail.outbox[0].body)
+        self.assertFalse(OutboundEmail.objects.exists())
+        # replies to the notifications are still matched to the ticket
+        message_id = mail.outbox[0].extra_headers["Message-ID"]
+        self.assertEqual(MessageThread.find_ticket([message_id]), self.ticket)
+
+    def test_context_dates_restored(self):
+        context = safe_template_context(self.ticket)
+        self.ticket.send({"submitter": ("newticket_submitter", context)})
+        email = OutboundEmail.objects.get()
+        self.assertEqual(email.context["ticket"]["created"], self.ticket.created)
+        self.assertEqual(email.context["ticket"]["title"], "Printer on fire")
+
+    def test_retry_with_backoff(self):
+        self.ticket.send(
+            {"submitter": ("newticket_submitter", safe_template_context(self.ticket))}
+        )
+        with mock.patch(
+            "helpdesk.outbox.send_templated_mail", side_effect=SMTPException("busy")
+        ):
+            self.assertEqual(send_outbound_emails(), 0)
+            email = OutboundEmail.objects.get()
+            self.assertEqual(email.attempts, 1)
+            self.assertEqual(email.last_error, "busy")
+            self.assertFalse(email.failed)
+            self.assertGreater(email.next_attempt, timezone.now())
+
+            # not due yet
+            self.assertEqual(send_outbound_emails(), 0)
+            self.assertEqual(OutboundEmail.objects.get().attempts, 1)
+
+            for attempt in range(
+                2, helpdesk_settings.HELPDESK_EMAIL_OUTBOX_MAX_ATTEMPTS
+            ):
+                OutboundEmail.objects.update(next_attempt=timezone.now())
+                send_outbound_emails()
+            email = OutboundEmail.objects.get()
+            self.assertFalse(email.failed)
+            next_attempt = email.next_attempt
+            self.assertGreater(
+                next_attempt - timezone.now(),
+                timedelta(seconds=helpdesk_settings.HELPDESK_EMAIL_OUTBOX_RETRY_DELAY),
+            )
+
+            OutboundEmail.objects.update(next_attempt=timezone.now())
+            send_outbound_emails()
+            self.assertTrue(OutboundEmail.objects.get().failed)
+
+        # failed e-mails are not sent again
+        self.assertEqual(send_outbound_emails(), 0)
+        self.assertEqual(len(mail.outbox), 0)
@@ -3,6 +3,7 @@ from django.contrib.auth.models import Permission
 from django.test import TestCase
 from django.test.client import Client
 from django.urls import reverse
+from django.utils import timezone
 from helpdesk import settings
 from helpdesk.models import Queue, Ticket
 from helpdesk.query import __Query__
@@ -267,3 +268,52 @@ class PerQueueStaffMembershipTestCase(TestCase):
             3,
             "Queue choices were improperly limited by queue membership for a superuser",
         )
+
+    def test_queue_access_cached(self):
+        """
+        Check that the queues a user can access are looked up once, also
+        across requests, until the permissions of the user change.
+        """
+        HelpdeskUser(self.user_1).get_queues()
+        # a later request, with a new user object
+        user_1 = get_user_model().objects.get(pk=self.user_1.pk)
+        huser = HelpdeskUser(user_1)
+        with self.assertNumQueries(0):
+            self.assertEqual(huser.get_queue_ids(), {self.queue_1.pk})
+            tickets = huser.get_tickets_in_queues()
+        self.assertEqual({t.queue for t in tickets}, {self.queue_1})
+
+        p = Permission.objects.get(codename=self.queue_2.permission_name[9:])
+        user_1.user_permissions.add(p)
+        user_1 = get_user_model().objects.get(pk=self.user_1.pk)
+        self.assertEqual(
+            set(HelpdeskUser(user_1).get_queues()), {self.queue_1, self.queue_2}
+        )
+
+        public_queue = Queue.objects.create(
+            title="Public", slug="public", allow_public_submission=True
+        )
+        self.assertEqual(
+            HelpdeskUser(user_1).get_queue_ids(),
+            {self.queue_1.pk, self.queue_2.pk, public_queue.pk},
+        )
+
+    def test_queue_access_kept_on_unrelated_changes(self):
+        """
+        Check that logging in, or a queue change not affecting who can
+        access it, keeps the cached queues.
+        """
+        HelpdeskUser(self.user_1).get_queues()
+        self.user_1.last_login = timezone.now()
+        self.user_1.save(update_fields=["last_login"])
+        self.queue_2.email_box_interval = 10
+        self.queue_2.save()
+        user_1 = get_user_model().objects.get(pk=self.user_1.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(HelpdeskUser(user_1).get_queue_ids(), {self.queue_1.pk})
+
+        self.queue_2.allow_public_submission = True
+        self.queue_2.save()
+        self.assertEqual(
+            HelpdeskUser(user_1).get_queue_ids(), {self.queue_1.pk, self.queue_2.pk}
+        )
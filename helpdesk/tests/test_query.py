@@ -1,9 +1,15 @@
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
 from django.test import TestCase
 from django.urls import reverse
+from django.utils import timezone
+from helpdesk import settings as helpdesk_settings
 from helpdesk.models import KBCategory, KBItem, Queue, Ticket
 from helpdesk.query import query_to_base64
 from helpdesk.tests.helpers import get_staff_user
+from io import StringIO
+from unittest import mock
 
 
 class QueryTests(TestCase):
@@ -171,3 +177,155 @@ class QueryTests(TestCase):
                 "draw": 0,
             },
         )
+
+    def test_query_keyset_pagination(self):
+        self.loginUser()
+        ticket3 = Ticket.objects.create(
+            title="third ticket", queue=self.queue, description="lol"
+        )
+        query = query_to_base64({"sorting": "id"})
+        url = reverse("helpdesk:datatables_ticket_list", args=[query])
+
+        seen = []
+        cursor = ""
+        for start in range(0, 4, 2):
+            resp_json = self.client.get(
+                url, {"length": 2, "start": start, "cursor": cursor}
+            ).json()
+            seen += [row["id"] for row in resp_json["data"]]
+            self.assertEqual(resp_json["recordsTotal"], 3)
+            cursor = resp_json["next_cursor"]
+        self.assertEqual(seen, [self.ticket1.id, self.ticket2.id, ticket3.id])
+        # the last page was not full, nothing left to fetch
+        self.assertEqual(cursor, "")
+
+        # a cursor is followed even when the offset does not match it
+        resp_json = self.client.get(url, {"length": 1, "start": 0, "cursor": ""}).json()
+        resp_json = self.client.get(
+            url, {"length": 1, "start": 0, "cursor": resp_json["next_cursor"]}
+        ).json()
+        self.assertEqual([row["id"] for row in resp_json["data"]], [self.ticket2.id])
+
+    def test_query_keyset_pagination_descending_and_invalid_cursor(self):
+        self.loginUser()
+        query = query_to_base64({"sorting": "created", "sortreverse": True})
+        url = reverse("helpdesk:datatables_ticket_list", args=[query])
+        resp_json = self.client.get(url, {"length": 1, "cursor": ""}).json()
+        self.assertEqual([row["id"] for row in resp_json["data"]], [self.ticket2.id])
+        resp_json = self.client.get(
+            url, {"length": 1, "cursor": resp_json["next_cursor"]}
+        ).json()
+        self.assertEqual([row["id"] for row in resp_json["data"]], [self.ticket1.id])
+
+        # invalid cursors fall back to the offset
+        resp_json = self.client.get(
+            url, {"length": 1, "start": 1, "cursor": "not-a-cursor"}
+        ).json()
+        self.assertEqual([row["id"] for row in resp_json["data"]], [self.ticket1.id])
+
+    def test_query_keyset_pagination_microseconds(self):
+        self.loginUser()
+        for i in range(4):
+            Ticket.objects.create(title="ticket %d" % i, queue=self.queue)
+        # timestamps that only differ below the millisecond
+        created = timezone.now().replace(microsecond=500)
+        tickets = list(Ticket.objects.order_by("id"))
+        for i, ticket in enumerate(tickets):
+            Ticket.objects.filter(pk=ticket.pk).update(
+                created=created + timezone.timedelta(microseconds=i)
+            )
+        query = query_to_base64({"sorting": "created"})
+        url = reverse("helpdesk:datatables_ticket_list", args=[query])
+
+        seen = []
+        cursor = ""
+        for start in range(0, 6, 3):
+            resp_json = self.client.get(
+                url, {"length": 3, "start": start, "cursor": cursor}
+            ).json()
+            seen += [row["id"] for row in resp_json["data"]]
+            cursor = resp_json["next_cursor"]
+        self.assertEqual(seen, [ticket.id for ticket in tickets])
+
+    def test_query_cached_count(self):
+        self.loginUser()
+        query = query_to_base64({})
+        url = reverse("helpdesk:datatables_ticket_list", args=[query])
+        with mock.patch.object(
+            helpdesk_settings, "HELPDESK_DATATABLES_COUNT_MODE", "cached"
+        ):
+            self.assertEqual(self.client.get(url).json()["recordsTotal"], 2)
+            Ticket.objects.create(title="new", queue=self.queue)
+            # served from the cache until it expires
+            self.assertEqual(self.client.get(url).json()["recordsTotal"], 2)
+            cache.clear()
+            self.assertEqual(self.client.get(url).json()["recordsTotal"], 3)
+
+    def test_last_followup_at(self):
+        earlier = timezone.now() - timezone.timedelta(days=1)
+        latest = self.ticket1.followup_set.create(title="latest")
+        self.ticket1.refresh_from_db()
+        self.assertEqual(self.ticket1.last_followup_at, latest.date)
+
+        # an older follow-up does not move the date back
+        older = self.ticket1.followup_set.create(title="older", date=earlier)
+        self.ticket1.refresh_from_db()
+        self.assertEqual(self.ticket1.last_followup_at, latest.date)
+
+        latest.delete()
+        self.ticket1.refresh_from_db()
+        self.assertEqual(self.ticket1.last_followup_at, older.date)
+        older.delete()
+        self.ticket1.refresh_from_db()
+        self.assertIsNone(self.ticket1.last_followup_at)
+
+    def test_last_followup_at_not_overwritten_by_stale_ticket(self):
+        stale_ticket = Ticket.objects.get(pk=self.ticket1.pk)
+        followup = self.ticket1.followup_set.create(title="update")
+        stale_ticket.title = "Renamed"
+        stale_ticket.save()
+        self.ticket1.refresh_from_db()
+        self.assertEqual(self.ticket1.title, "Renamed")
+        self.assertEqual(self.ticket1.last_followup_at, followup.date)
+
+    def test_ticket_saved_again_with_last_followup_at(self):
+        followup = self.ticket1.followup_set.create(title="update")
+        self.ticket1.refresh_from_db()
+        # a ticket whose row was deleted meanwhile is inserted again
+        Ticket.objects.filter(pk=self.ticket1.pk).delete()
+        self.ticket1.save()
+        self.assertEqual(
+            Ticket.objects.get(pk=self.ticket1.pk).last_followup_at, followup.date
+        )
+        # as is a copy of a loaded ticket
+        self.ticket1.pk = None
+        self.ticket1.save()
+        self.assertEqual(
+            Ticket.objects.get(pk=self.ticket1.pk).last_followup_at, followup.date
+        )
+
+    def test_query_sort_by_last_followup(self):
+        self.loginUser()
+        self.ticket1.followup_set.create(title="update")
+        self.ticket2.followup_set.create(
+            title="update", date=timezone.now() - timezone.timedelta(days=1)
+        )
+        query = query_to_base64({"sorting": "last_followup", "sortreverse": True})
+        response = self.client.get(
+            reverse("helpdesk:datatables_ticket_list", args=[query])
+        )
+        self.assertEqual(
+            [row["id"] for row in response.json()["data"]],
+            [self.ticket1.id, self.ticket2.id],
+        )
+
+    def test_update_last_followup_command(self):
+        followup = self.ticket1.followup_set.create(title="update")
+        Ticket.objects.update(last_followup_at=None)
+        out = StringIO()
+        call_command("update_last_followup", batch_size=1, stdout=out)
+        self.assertIn("Updated 2 tickets", out.getvalue())
+        self.ticket1.refresh_from_db()
+        self.ticket2.refresh_from_db()
+        self.assertEqual(self.ticket1.last_followup_at, followup.date)
+        self.assertIsNone(self.ticket2.last_followup_at)
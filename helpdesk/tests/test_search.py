@@ -0,0 +1,148 @@
+from django.core.management import call_command
+from django.test import TestCase
+from helpdesk.models import (
+    CustomField,
+    Queue,
+    Ticket,
+    TicketCustomFieldValue,
+    TicketSearchToken,
+)
+from helpdesk.query import __Query__, query_to_base64
+from helpdesk.search import (
+    DatabaseSearchBackend,
+    InvertedIndexSearchBackend,
+    tokenize,
+)
+from helpdesk.tests.helpers import CustomFieldCacheMixin, get_staff_user
+from helpdesk.user import HelpdeskUser
+from io import StringIO
+
+
+class SearchBackendTests(CustomFieldCacheMixin, TestCase):
+    def setUp(self):
+        self.queue = Queue.objects.create(title="Test queue", slug="test_queue")
+        self.other_queue = Queue.objects.create(title="Other queue", slug="other")
+        self.printer = Ticket.objects.create(
+            title="Printer on fire",
+            queue=self.queue,
+            description="The printer in room 3 emits smoke",
+            submitter_email="alice@example.com",
+        )
+        self.network = Ticket.objects.create(
+            title="Network down",
+            queue=self.other_queue,
+            description="Nobody can reach the file server",
+        )
+        self.network.followup_set.create(
+            title="Comment", comment="Rebooted the printer switch"
+        )
+
+    def search(self, search, backend_class=InvertedIndexSearchBackend):
+        return list(backend_class().search(Ticket.objects.all(), search))
+
+    def test_tokenize(self):
+        self.assertEqual(
+            tokenize("Re: Printer-Jam at alice@example.com!"),
+            ["re", "printer", "jam", "at", "alice", "example", "com"],
+        )
+        self.assertEqual(tokenize(None), [])
+
+    def test_index_updated_on_save(self):
+        tokens = set(
+            TicketSearchToken.objects.filter(ticket=self.printer).values_list(
+                "token", flat=True
+            )
+        )
+        self.assertTrue({"printer", "fire", "smoke", "alice"} <= tokens)
+
+        self.printer.title = "Scanner jammed"
+        self.printer.save()
+        tokens = set(
+            TicketSearchToken.objects.filter(ticket=self.printer).values_list(
+                "token", flat=True
+            )
+        )
+        self.assertIn("scanner", tokens)
+        self.assertNotIn("fire", tokens)
+
+    def test_followups_indexed_on_their_own(self):
+        first = self.network.followup_set.get()
+        first_tokens = list(
+            TicketSearchToken.objects.filter(source="followup:%s" % first.pk)
+        )
+        second = self.network.followup_set.create(title="Update", comment="Fixed")
+        # the tokens of the other follow-up are left alone
+        self.assertEqual(
+            list(TicketSearchToken.objects.filter(source="followup:%s" % first.pk)),
+            first_tokens,
+        )
+        self.assertEqual(self.search("fixed"), [self.network])
+
+        second.delete()
+        self.assertEqual(self.search("fixed"), [])
+        self.assertEqual(self.search("rebooted"), [self.network])
+
+    def test_search_words_and_prefixes(self):
+        self.assertEqual(self.search("fire"), [self.printer])
+        self.assertEqual(self.search("FIR"), [self.printer])
+        self.assertEqual(self.search("printer smoke"), [self.printer])
+        self.assertEqual(self.search("alice@example.com"), [self.printer])
+        self.assertEqual(self.search("unknownword"), [])
+        self.assertEqual(self.search("!!!"), [])
+
+    def test_search_alternatives(self):
+        self.assertEqual(
+            set(self.search("fire OR server")), {self.printer, self.network}
+        )
+
+    def test_search_followups_and_custom_fields(self):
+        self.assertEqual(self.search("rebooted"), [self.network])
+        field = CustomField.objects.create(
+            name="serial", label="Serial", data_type="varchar"
+        )
+        TicketCustomFieldValue.objects.create(
+            ticket=self.printer, field=field, value="SN-4711"
+        )
+        self.assertEqual(self.search("sn 4711"), [self.printer])
+
+    def test_search_saved_custom_field_values(self):
+        CustomField.objects.create(name="serial", label="Serial", data_type="varchar")
+        self.printer.save_custom_field_values({"custom_serial": "SN-4711"})
+        self.assertEqual(self.search("sn 4711"), [self.printer])
+
+    def test_search_ticket_id(self):
+        self.assertEqual(self.search(str(self.network.id)), [self.network])
+
+    def test_search_ranking(self):
+        # "printer" is in the title of one ticket, only in a follow-up of the other
+        tickets = InvertedIndexSearchBackend().search(Ticket.objects.all(), "printer")
+        ranked = list(tickets.order_by("-search_rank"))
+        self.assertEqual(ranked, [self.printer, self.network])
+
+    def test_search_prefixed_filters(self):
+        self.assertEqual(self.search("queue:Other"), [self.network])
+        self.assertEqual(
+            self.search("queue:Other", backend_class=DatabaseSearchBackend),
+            [self.network],
+        )
+
+    def test_database_backend(self):
+        self.assertEqual(
+            self.search("on fire", backend_class=DatabaseSearchBackend),
+            [self.printer],
+        )
+
+    def test_query_uses_search_backend(self):
+        huser = HelpdeskUser(get_staff_user())
+        query = __Query__(
+            huser, base64query=query_to_base64({"search_string": "printer"})
+        )
+        self.assertEqual(list(query.get()), [self.printer, self.network])
+
+    def test_rebuild_search_index(self):
+        TicketSearchToken.objects.all().delete()
+        self.assertEqual(self.search("fire"), [])
+        out = StringIO()
+        call_command("rebuild_search_index", stdout=out)
+        self.assertIn("Re-indexed 2 tickets", out.getvalue())
+        self.assertEqual(self.search("fire"), [self.printer])
@@ -1,13 +1,17 @@
 from django.contrib.auth import get_user_model
+from django.db import connection
 from django.test import TestCase
 from django.test.client import Client
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
 from helpdesk import settings as helpdesk_settings
 from helpdesk.models import CustomField, Queue, Ticket
 from helpdesk.templatetags.ticket_to_link import num_to_link
+from helpdesk.tests.helpers import CustomFieldCacheMixin
 from helpdesk.user import HelpdeskUser
 from django.utils.translation import gettext_lazy as _
+from unittest import mock
 
 
 try:  # python 3
@@ -16,7 +20,7 @@ except ImportError:  # python 2
     from urlparse import urlparse
 
 
-class TicketActionsTestCase(TestCase):
+class TicketActionsTestCase(CustomFieldCacheMixin, TestCase):
     fixtures = ["emailtemplate.json"]
 
     def setUp(self):
@@ -328,9 +332,13 @@ class TicketActionsTestCase(TestCase):
         ticket_2.refresh_from_db()
         self.assertEqual(ticket_2.merged_to, ticket_1)
         self.assertEqual(ticket_2.followup_set.count(), 0)
+        self.assertIsNone(ticket_2.last_followup_at)
         self.assertEqual(ticket_2.ticketcc_set.count(), 0)
         ticket_1.refresh_from_db()
         self.assertEqual(ticket_1.created, ticket_1_created)
+        self.assertEqual(
+            ticket_1.last_followup_at, ticket_1.followup_set.latest("date").date
+        )
         self.assertEqual(ticket_1.due_date, due_date)
         self.assertEqual(ticket_1.status, Ticket.RESOLVED_STATUS)
         self.assertEqual(ticket_1.submitter_email, ticket_2.submitter_email)
@@ -443,3 +451,45 @@ class TicketActionsTestCase(TestCase):
             ticket.ticketcustomfieldvalue_set.get(field=custom_field_1).value,
             custom_field_1_value,
         )
+
+    def test_save_custom_field_values(self):
+        for i in range(15):
+            CustomField.objects.create(
+                name="field%s" % i, label="Field %s" % i, data_type="varchar"
+            )
+        ticket = Ticket.objects.create(**self.ticket_data)
+        CustomField.objects.get_cached()
+
+        def save_values(data):
+            with CaptureQueriesContext(connection) as queries:
+                ticket.save_custom_field_values(data)
+            return [
+                query["sql"].split()[0]
+                for query in queries.captured_queries
+                if "helpdesk_ticketcustomfieldvalue" in query["sql"]
+                and not query["sql"].startswith("SELECT")
+            ]
+
+        writes = save_values({"custom_field%s" % i: "value %s" % i for i in range(15)})
+        self.assertEqual(writes, ["INSERT"])
+        # unchanged values are not written again
+        data = {"custom_field%s" % i: "value %s" % i for i in range(15)}
+        data.update({"custom_field0": "changed", "custom_field1": "changed"})
+        self.assertEqual(save_values(data), ["UPDATE"])
+        self.assertEqual(
+            dict(ticket.ticketcustomfieldvalue_set.values_list("field__name", "value")),
+            {"field%s" % i: "changed" if i < 2 else "value %s" % i for i in range(15)},
+        )
+
+    def test_save_custom_field_values_without_conflict_target(self):
+        """MySQL and MariaDB cannot name the fields of an upsert conflict"""
+        CustomField.objects.create(name="field", label="Field", data_type="varchar")
+        ticket = Ticket.objects.create(**self.ticket_data)
+        with mock.patch.object(
+            connection.features, "supports_update_conflicts_with_target", False
+        ):
+            ticket.save_custom_field_values({"custom_field": "value"})
+        self.assertEqual(
+            list(ticket.ticketcustomfieldvalue_set.values_list("value", flat=True)),
+            ["value"],
+        )
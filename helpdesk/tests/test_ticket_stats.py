@@ -0,0 +1,272 @@
+from collections import defaultdict
+from datetime import timedelta
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+from io import StringIO
+from unittest import mock
+from helpdesk import settings as helpdesk_settings
+from helpdesk.models import Queue, Ticket, TicketDailyStat
+from helpdesk.stats import (
+    get_queue_summaries,
+    get_ticket_daily_stats,
+    refresh_ticket_stats,
+)
+from helpdesk.tests.helpers import get_user
+from helpdesk.views.staff import (
+    calc_average_nbr_days_until_ticket_resolved,
+    calc_basic_ticket_stats,
+    REPORT_DIMENSIONS,
+    update_summary_tables,
+)
+
+
+class BasicTicketStatsTestCase(TestCase):
+    def setUp(self):
+        self.queue = Queue.objects.create(title="Queue", slug="queue")
+        now = timezone.now()
+        # (status, days since created, days until modified)
+        for status, age, days_open in [
+            (Ticket.OPEN_STATUS, 1, 0),
+            (Ticket.REOPENED_STATUS, 10, 2),
+            (Ticket.RESOLVED_STATUS, 45, 5),
+            (Ticket.OPEN_STATUS, 90, 1),
+            (Ticket.CLOSED_STATUS, 20, 3),
+            (Ticket.CLOSED_STATUS, 30, 6),
+            (Ticket.CLOSED_STATUS, 100, 40),
+        ]:
+            ticket = Ticket.objects.create(
+                title="Ticket", queue=self.queue, status=status
+            )
+            created = now - timedelta(days=age)
+            # save() always bumps modified, so set the dates directly
+            Ticket.objects.filter(pk=ticket.pk).update(
+                created=created,
+                modified=created + timedelta(days=days_open, hours=12),
+            )
+
+    def test_calc_basic_ticket_stats(self):
+        with self.assertNumQueries(2):
+            stats = calc_basic_ticket_stats(Ticket.objects.all())
+        self.assertEqual([row[1] for row in stats["open_ticket_stats"]], [2, 1, 1])
+        self.assertEqual(
+            [row[2] for row in stats["open_ticket_stats"]],
+            ["success", "warning", "danger"],
+        )
+        self.assertAlmostEqual(stats["average_nbr_days_until_ticket_closed"], 49 / 3)
+        self.assertAlmostEqual(
+            stats["average_nbr_days_until_ticket_closed_last_60_days"], 9 / 2
+        )
+        self.assertAlmostEqual(
+            stats["average_nbr_days_until_ticket_closed"],
+            calc_average_nbr_days_until_ticket_resolved(
+                Ticket.objects.filter(status=Ticket.CLOSED_STATUS)
+            ),
+        )
+
+    def test_calc_basic_ticket_stats_no_tickets(self):
+        stats = calc_basic_ticket_stats(Ticket.objects.none())
+        self.assertEqual([row[1] for row in stats["open_ticket_stats"]], [0, 0, 0])
+        self.assertEqual(stats["average_nbr_days_until_ticket_closed"], 0)
+        self.assertEqual(stats["average_nbr_days_until_ticket_closed_last_60_days"], 0)
+
+
+def legacy_summary_tables(report_queryset, report):
+    """The report tables as they were computed ticket by ticket in Python."""
+    summarytable = defaultdict(int)
+    summarytable2 = defaultdict(int)
+    for ticket in report_queryset:
+        user = "%s" % ticket.get_assigned_to
+        queue = "%s" % ticket.queue.title
+        month = "%s-%s" % (ticket.created.year, ticket.created.month)
+        metric1, metric2 = {
+            "userpriority": (user, "%s" % ticket.get_priority_display()),
+            "userqueue": (user, queue),
+            "userstatus": (user, "%s" % ticket.get_status_display()),
+            "usermonth": (user, month),
+            "queuepriority": (queue, "%s" % ticket.get_priority_display()),
+            "queuestatus": (queue, "%s" % ticket.get_status_display()),
+            "queuemonth": (queue, month),
+            "daysuntilticketclosedbymonth": (queue, month),
+        }[report]
+        summarytable[metric1, metric2] += 1
+        days = (ticket.modified - ticket.created).days
+        if report == "daysuntilticketclosedbymonth" and days:
+            summarytable2[metric1, metric2] += days
+    return summarytable, summarytable2
+
+
+class SummaryTablesTestCase(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        alice = User.objects.create(
+            username="alice", first_name="Alice", last_name="Smith"
+        )
+        bob = User.objects.create(username="bob")
+        queue_1 = Queue.objects.create(title="Queue 1", slug="q1")
+        queue_2 = Queue.objects.create(title="Queue 2", slug="q2")
+        now = timezone.now()
+        for n, (queue, user, status, priority, age, days_open) in enumerate(
+            [
+                (queue_1, alice, Ticket.OPEN_STATUS, 1, 3, 0),
+                (queue_1, alice, Ticket.CLOSED_STATUS, 3, 40, 4),
+                (queue_1, None, Ticket.CLOSED_STATUS, 3, 45, 11),
+                (queue_2, bob, Ticket.RESOLVED_STATUS, 5, 80, 2),
+                (queue_2, bob, Ticket.OPEN_STATUS, 2, 400, 0),
+                (queue_2, None, Ticket.REOPENED_STATUS, 4, 3, 1),
+            ]
+        ):
+            ticket = Ticket.objects.create(
+                title="Ticket %s" % n,
+                queue=queue,
+                assigned_to=user,
+                status=status,
+                priority=priority,
+            )
+            created = now - timedelta(days=age)
+            Ticket.objects.filter(pk=ticket.pk).update(
+                created=created,
+                modified=created + timedelta(days=days_open, hours=6),
+            )
+
+    def test_update_summary_tables_matches_per_ticket_counts(self):
+        for report in REPORT_DIMENSIONS:
+            summarytable = defaultdict(int)
+            summarytable2 = defaultdict(int)
+            update_summary_tables(
+                Ticket.objects.all(), report, summarytable, summarytable2
+            )
+            expected, expected2 = legacy_summary_tables(
+                Ticket.objects.select_related(), report
+            )
+            self.assertEqual(dict(summarytable), dict(expected), report)
+            self.assertEqual(dict(summarytable2), dict(expected2), report)
+
+    def test_update_summary_tables_unknown_report(self):
+        with self.assertRaises(ValueError):
+            update_summary_tables(
+                Ticket.objects.all(), "unknown", defaultdict(int), defaultdict(int)
+            )
+
+    def test_run_report(self):
+        self.client.force_login(get_user(is_staff=True, is_superuser=True))
+        for report in REPORT_DIMENSIONS:
+            response = self.client.get(
+                reverse("helpdesk:run_report", kwargs={"report": report})
+            )
+            self.assertEqual(response.status_code, 200, report)
+        response = self.client.get(
+            reverse("helpdesk:run_report", kwargs={"report": "queuestatus"})
+        )
+        self.assertEqual(response.context["total_data"][1:], ["2", "1", "1", "2", "0"])
+
+
+class TicketDailyStatTestCase(SummaryTablesTestCase):
+    def assertRollupMatchesTickets(self):
+        for report in REPORT_DIMENSIONS:
+            expected, expected2 = defaultdict(int), defaultdict(int)
+            update_summary_tables(Ticket.objects.all(), report, expected, expected2)
+            summarytable, summarytable2 = defaultdict(int), defaultdict(int)
+            update_summary_tables(
+                TicketDailyStat.objects.all(), report, summarytable, summarytable2
+            )
+            self.assertEqual(dict(summarytable), dict(expected), report)
+            self.assertEqual(dict(summarytable2), dict(expected2), report)
+        stats = calc_basic_ticket_stats(
+            Ticket.objects.none(), TicketDailyStat.objects.all()
+        )
+        self.assertEqual(stats, calc_basic_ticket_stats(Ticket.objects.all()))
+
+    def test_refresh_ticket_stats(self):
+        self.assertEqual(refresh_ticket_stats(), 5)
+        self.assertRollupMatchesTickets()
+        # nothing changed since
+        self.assertEqual(refresh_ticket_stats(), 0)
+
+    def test_refresh_ticket_stats_incremental(self):
+        refresh_ticket_stats()
+        ticket = Ticket.objects.get(title="Ticket 0")
+        ticket.status = Ticket.CLOSED_STATUS
+        ticket.save()
+        ticket.followup_set.create(
+            title="Worked on it", time_spent=timedelta(minutes=30)
+        )
+        Ticket.objects.get(title="Ticket 3").delete()
+        self.assertEqual(refresh_ticket_stats(), 2)
+        self.assertRollupMatchesTickets()
+        self.assertEqual(
+            TicketDailyStat.objects.get(
+                status=Ticket.CLOSED_STATUS, priority=1
+            ).time_spent,
+            timedelta(minutes=30),
+        )
+
+    @mock.patch.object(helpdesk_settings, "HELPDESK_TICKET_STATS_MAX_AGE", 3600)
+    def test_get_ticket_daily_stats(self):
+        queues = Queue.objects.all()
+        self.assertIsNone(get_ticket_daily_stats(queues))
+        out = StringIO()
+        call_command("refresh_ticket_stats", "--full", stdout=out)
+        self.assertIn("Refreshed the statistics of 5 days", out.getvalue())
+        self.assertEqual(
+            sum(get_ticket_daily_stats(queues).values_list("ticket_count", flat=True)),
+            6,
+        )
+        with mock.patch.object(helpdesk_settings, "HELPDESK_TICKET_STATS_MAX_AGE", 0):
+            self.assertIsNone(get_ticket_daily_stats(queues))
+
+
+class QueueSummaryTestCase(TestCase):
+    def setUp(self):
+        self.queue_1 = Queue.objects.create(title="Queue 1", slug="q1")
+        self.queue_2 = Queue.objects.create(title="Queue 2", slug="q2")
+        self.queue_3 = Queue.objects.create(title="Queue 3", slug="q3")
+        for queue, status in [
+            (self.queue_1, Ticket.OPEN_STATUS),
+            (self.queue_1, Ticket.REOPENED_STATUS),
+            (self.queue_1, Ticket.CLOSED_STATUS),
+            (self.queue_2, Ticket.RESOLVED_STATUS),
+        ]:
+            ticket = Ticket.objects.create(title="Ticket", queue=queue, status=status)
+            ticket.followup_set.create(title="Work", time_spent=timedelta(minutes=20))
+
+    def test_get_queue_summaries(self):
+        with self.assertNumQueries(2):
+            summaries = get_queue_summaries(Queue.objects.all())
+        self.assertEqual(
+            [
+                (s["queue"], s["open"], s["resolved"], s["closed"], s["time_spent"])
+                for s in summaries
+            ],
+            [
+                (self.queue_1, 2, 0, 1, timedelta(hours=1)),
+                (self.queue_2, 0, 1, 0, timedelta(minutes=20)),
+                (self.queue_3, 0, 0, 0, None),
+            ],
+        )
+        for summary in summaries:
+            queue = Queue.objects.get(pk=summary["queue"].pk)
+            self.assertEqual(summary["time_spent"], queue.time_spent)
+
+    def test_report_index(self):
+        self.client.force_login(get_user(is_staff=True, is_superuser=True))
+        response = self.client.get(reverse("helpdesk:report_index"))
+        self.assertEqual(
+            [
+                (row["name"], row["open"], row["time_spent"])
+                for row in response.context["dash_tickets"]
+            ],
+            [("Queue 1", 2, "01h:00m"), ("Queue 2", 0, "00h:20m"), ("Queue 3", 0, "")],
+        )
+
+    def test_queue_admin_time_spent(self):
+        self.client.force_login(get_user(is_staff=True, is_superuser=True))
+        response = self.client.get(
+            reverse("admin:helpdesk_queue_changelist"), {"o": "-5"}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.context["cl"].result_list[0].time_spent, timedelta(hours=1)
+        )
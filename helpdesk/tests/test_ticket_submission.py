@@ -3,7 +3,10 @@ from django.core import mail
 from django.test import TestCase
 from django.test.client import Client
 from django.urls import reverse
+from django.utils import timezone
+from datetime import timedelta
 import email
+from freezegun import freeze_time
 from helpdesk.email import extract_email_metadata, MULTIPLE_USERS_SAME_EMAIL_MSG
 from helpdesk.models import (
     CustomField,
@@ -14,6 +17,7 @@ from helpdesk.models import (
     Ticket,
     TicketCC,
 )
+from helpdesk.tests.helpers import CustomFieldCacheMixin
 from . import utils
 import logging
 from urllib.parse import urlparse
@@ -24,7 +28,7 @@ User = get_user_model()
 logger = logging.getLogger("helpdesk")
 
 
-class TicketBasicsTestCase(TestCase):
+class TicketBasicsTestCase(CustomFieldCacheMixin, TestCase):
     fixtures = ["emailtemplate.json"]
 
     def setUp(self):
@@ -207,6 +211,46 @@ class TicketBasicsTestCase(TestCase):
         # Ensure only two e-mails were sent - submitter & updated.
         self.assertEqual(email_count + 2, len(mail.outbox))
 
+    def test_custom_field_definitions_cached(self):
+        field = CustomField.objects.create(
+            name="colour",
+            label="Colour",
+            data_type="list",
+            list_values="Red\nBlue\n",
+            empty_selection_list=True,
+        )
+        CustomField.objects.get_cached()
+        with self.assertNumQueries(0):
+            fields = CustomField.objects.get_cached()
+            self.assertEqual(
+                fields[0].get_choices(),
+                [("", "---------"), ["Red", "Red"], ["Blue", "Blue"]],
+            )
+            self.assertEqual(
+                CustomField.objects.get_cached_by_name("colour").label, "Colour"
+            )
+            with self.assertRaises(CustomField.DoesNotExist):
+                CustomField.objects.get_cached_by_name("size")
+
+        field.list_values = "Green"
+        field.save()
+        self.assertEqual(
+            CustomField.objects.get_cached()[0].get_choices(),
+            [("", "---------"), ["Green", "Green"]],
+        )
+        field.delete()
+        self.assertEqual(CustomField.objects.get_cached(), [])
+
+    def test_custom_field_definitions_cache_expires(self):
+        CustomField.objects.create(name="colour", label="Colour")
+        CustomField.objects.get_cached()
+        # changes made without the signals, eg by another process with a
+        # cache of its own, are picked up once the cache expired
+        CustomField.objects.update(label="Color")
+        self.assertEqual(CustomField.objects.get_cached()[0].label, "Colour")
+        with freeze_time(timezone.now() + timedelta(seconds=301)):
+            self.assertEqual(CustomField.objects.get_cached()[0].label, "Color")
+
     def test_create_ticket_public_no_loopback(self):
         """
         Don't send emails to the queue's own inbox. It'll create a loop.
@@ -799,6 +843,65 @@ class EmailInteractionsTestCase(TestCase):
         # the new and update queues (+2)
         self.assertEqual(email_count + 1 + 2 + 2, len(mail.outbox))
 
+    def test_reply_matched_by_message_thread(self):
+        """
+        Ensure that replies without the tracking ID in their subject are
+        matched to their ticket through the Message-IDs of the thread: the
+        ones received, sent, and answered by a reply.
+        """
+        msg = email.message.Message()
+        msg["Message-ID"] = "<first@example.com>"
+        msg["References"] = "<earlier@example.com>"
+        msg["Subject"] = self.ticket_data["title"]
+        msg["From"] = "foo@bar.py"
+        msg["To"] = self.queue_public.email_address
+        msg.set_payload(self.ticket_data["description"])
+        ticket = extract_email_metadata(str(msg), self.queue_public, logger=logger)
+        self.assertEqual(
+            set(ticket.message_threads.values_list("message_id", "outbound")),
+            {("<first@example.com>", False)}
+            | {(sent.extra_headers["Message-ID"], True) for sent in mail.outbox},
+        )
+
+        def reply(subject="Re: something else", **headers):
+            reply = email.message.Message()
+            for header, value in headers.items():
+                reply[header.replace("_", "-")] = value
+            reply["Subject"] = subject
+            reply["From"] = "foo@bar.py"
+            reply.set_payload("Thanks")
+            return extract_email_metadata(str(reply), self.queue_public, logger=logger)
+
+        # a reply to the notification sent by the helpdesk
+        notification_id = mail.outbox[0].extra_headers["Message-ID"]
+        self.assertEqual(reply(In_Reply_To=notification_id), ticket)
+        # the message ids a new ticket's e-mail referred to are not its own
+        self.assertNotEqual(reply(References="<earlier@example.com>"), ticket)
+        # a message answered by a reply to the ticket
+        self.assertEqual(
+            reply(
+                subject="Re: [%s]" % ticket.ticket, In_Reply_To="<agent@example.com>"
+            ),
+            ticket,
+        )
+        self.assertEqual(reply(References="<agent@example.com>"), ticket)
+        # the thread comes before the tracking ID of the subject
+        other = Ticket.objects.create(title="Other", queue=self.queue_public)
+        self.assertEqual(
+            reply(subject="Re: [%s]" % other.ticket, In_Reply_To=notification_id),
+            ticket,
+        )
+        self.assertEqual(
+            reply(subject="Re: [%s]" % other.ticket, In_Reply_To="<new@example.com>"),
+            other,
+        )
+
+        # replies to a merged ticket go to the ticket it was merged to
+        ticket.merged_to = other
+        ticket.save()
+        self.assertEqual(reply(References="<first@example.com>"), other)
+        self.assertNotEqual(reply(In_Reply_To="<unknown@example.com>"), ticket)
+
     def test_create_ticket_from_email_to_a_notification_enabled_queue(self):
         """
         Ensure that when an email is sent to a Queue with
@@ -1,12 +1,28 @@
 from django.contrib.auth.models import User
-from helpdesk.models import Queue, CustomField, TicketCustomFieldValue, Ticket
+from django.core.management import call_command
+from django.core.serializers.json import DjangoJSONEncoder
+from django.test import TestCase
+from django.utils import timezone
+from helpdesk import settings as helpdesk_settings
+from helpdesk.models import (
+    Queue,
+    CustomField,
+    TicketCustomFieldValue,
+    Ticket,
+    WebhookDelivery,
+)
 from helpdesk.serializers import TicketSerializer
+from helpdesk.signals import new_ticket_done
+from helpdesk.tests.helpers import CustomFieldCacheMixin
+from helpdesk.webhooks import get_endpoint, post_webhooks, send_webhooks
+from io import StringIO
 from rest_framework.status import HTTP_201_CREATED
 from rest_framework.test import APITestCase
 import json
 import os
 import requests
 import logging
+from unittest import mock
 
 # Set up a test weberver listeining on localhost:8123 for webhooks
 import http.server
@@ -84,7 +100,7 @@ class WebhookServer(http.server.HTTPServer):
         self.thread.join()
 
 
-class WebhookTest(APITestCase):
+class WebhookTest(CustomFieldCacheMixin, APITestCase):
     @classmethod
     def setUpTestData(cls):
         cls.queue = Queue.objects.create(
@@ -311,3 +327,153 @@ class WebhookTest(APITestCase):
         )
 
         server.stop()
+
+
+@mock.patch.dict(
+    os.environ, {"HELPDESK_NEW_TICKET_WEBHOOK_URLS": "http://hooks.example.com/new"}
+)
+class WebhookDeliveryTests(TestCase):
+    def setUp(self):
+        self.queue = Queue.objects.create(title="Queue", slug="queue")
+        self.post = mock.patch.object(requests.Session, "post").start()
+        self.addCleanup(mock.patch.stopall)
+
+    def create_ticket(self):
+        ticket = Ticket.objects.create(title="Printer on fire", queue=self.queue)
+        new_ticket_done.send(sender="test", ticket=ticket)
+        return ticket
+
+    @mock.patch.object(helpdesk_settings, "HELPDESK_WEBHOOK_QUEUE", True)
+    def test_queued_delivery(self):
+        ticket = self.create_ticket()
+        self.post.assert_not_called()
+        delivery = WebhookDelivery.objects.get()
+        self.assertEqual(delivery.ticket, ticket)
+        self.assertEqual(delivery.payload["ticket"]["title"], "Printer on fire")
+
+        out = StringIO()
+        call_command("send_webhooks", stdout=out)
+        self.assertIn("Sent 1 webhook deliveries", out.getvalue())
+        self.post.assert_called_once()
+        self.assertEqual(self.post.call_args.args, ("http://hooks.example.com/new",))
+        body = json.loads(self.post.call_args.kwargs["data"])
+        self.assertEqual(body["ticket"]["id"], ticket.id)
+        self.assertFalse(WebhookDelivery.objects.exists())
+
+    def test_failed_delivery_retried(self):
+        self.post.side_effect = requests.exceptions.ConnectionError("refused")
+        self.create_ticket()
+        delivery = WebhookDelivery.objects.get()
+        self.assertEqual(delivery.attempts, 1)
+        self.assertEqual(delivery.last_error, "refused")
+        self.assertGreater(delivery.next_attempt, timezone.now())
+
+        # not due yet
+        self.assertEqual(send_webhooks(), 0)
+        self.assertEqual(self.post.call_count, 1)
+
+        self.post.side_effect = None
+        WebhookDelivery.objects.update(next_attempt=timezone.now())
+        self.assertEqual(send_webhooks(), 1)
+        self.assertFalse(WebhookDelivery.objects.exists())
+
+    def test_dead_letter_replay(self):
+        self.post.return_value.raise_for_status.side_effect = (
+            requests.exceptions.HTTPError("500 Server Error")
+        )
+        self.create_ticket()
+        for attempt in range(1, helpdesk_settings.HELPDESK_WEBHOOK_MAX_ATTEMPTS):
+            WebhookDelivery.objects.update(next_attempt=timezone.now())
+            send_webhooks()
+        delivery = WebhookDelivery.objects.get()
+        self.assertTrue(delivery.failed)
+        self.assertEqual(
+            delivery.attempts, helpdesk_settings.HELPDESK_WEBHOOK_MAX_ATTEMPTS
+        )
+        # dead letters are not retried on their own
+        self.assertEqual(send_webhooks(), 0)
+
+        self.post.return_value.raise_for_status.side_effect = None
+        out = StringIO()
+        call_command("send_webhooks", "--replay", stdout=out)
+        self.assertIn("Replaying 1 failed deliveries", out.getvalue())
+        self.assertFalse(WebhookDelivery.objects.exists())
+
+    @mock.patch.object(helpdesk_settings, "HELPDESK_WEBHOOK_ENDPOINT_CONCURRENCY", 1)
+    def test_endpoint_concurrency(self):
+        deliveries = [
+            WebhookDelivery(url=f"http://{host}.example.com/hook/{i}", payload={})
+            for host in ("a", "b")
+            for i in range(3)
+        ]
+        lanes = []
+        with mock.patch(
+            "helpdesk.webhooks.post_lane",
+            side_effect=lambda lane: (
+                lanes.append(lane) or [(d, None) for group, body in lane for d in group]
+            ),
+        ):
+            results = post_webhooks(deliveries)
+        self.assertEqual(len(results), 6)
+        # one lane per endpoint
+        self.assertEqual(
+            sorted({get_endpoint(g[0].url) for g, body in lane} for lane in lanes),
+            [{("http", "a.example.com")}, {("http", "b.example.com")}],
+        )
+
+    @mock.patch.object(helpdesk_settings, "HELPDESK_WEBHOOK_ENDPOINT_CONCURRENCY", 2)
+    def test_ticket_events_kept_in_order(self):
+        deliveries = [
+            WebhookDelivery(
+                ticket_id=ticket_id, url="http://a.example.com/hook", payload={"n": i}
+            )
+            for i, ticket_id in enumerate([1, 2, 1, 2, 1])
+        ]
+        lanes = []
+        with mock.patch(
+            "helpdesk.webhooks.post_lane",
+            side_effect=lambda lane: (
+                lanes.append(lane) or [(d, None) for group, body in lane for d in group]
+            ),
+        ):
+            post_webhooks(deliveries)
+        # each ticket's events are sent one after the other, in their order
+        self.assertEqual(
+            sorted(
+                [(g[0].ticket_id, g[0].payload["n"]) for g, body in lane]
+                for lane in lanes
+            ),
+            [[(1, 0), (1, 2), (1, 4)], [(2, 1), (2, 3)]],
+        )
+
+    def test_payload_encoded_once(self):
+        payload = {"ticket": {"id": 1, "created": timezone.now()}}
+        deliveries = [
+            WebhookDelivery(url=f"http://{host}.example.com/hook", payload=payload)
+            for host in ("a", "b", "c")
+        ]
+        with mock.patch("helpdesk.webhooks.json.dumps", wraps=json.dumps) as dumps:
+            post_webhooks(deliveries)
+        dumps.assert_called_once()
+        self.assertEqual(self.post.call_count, 3)
+        self.assertEqual(
+            {call.kwargs["data"] for call in self.post.call_args_list},
+            {json.dumps(payload, cls=DjangoJSONEncoder).encode("utf-8")},
+        )
+
+    @mock.patch.object(helpdesk_settings, "HELPDESK_WEBHOOK_BATCH_WINDOW", 5)
+    def test_batched_delivery(self):
+        tickets = [self.create_ticket() for i in range(3)]
+        self.post.assert_not_called()
+        # held back for the batch window
+        self.assertEqual(send_webhooks(), 0)
+
+        WebhookDelivery.objects.update(next_attempt=timezone.now())
+        self.assertEqual(send_webhooks(), 3)
+        self.post.assert_called_once()
+        self.assertEqual(self.post.call_args.args, ("http://hooks.example.com/new",))
+        body = json.loads(self.post.call_args.kwargs["data"])
+        self.assertEqual(
+            [event["ticket"]["id"] for event in body], [t.id for t in tickets]
+        )
+        self.assertFalse(WebhookDelivery.objects.exists())
@@ -17,6 +17,7 @@ from helpdesk.models import (
     TicketCC,
 )
 from helpdesk.signals import update_ticket_done
+from helpdesk.templated_email import email_session
 
 User = get_user_model()
 
@@ -373,9 +374,10 @@ def update_ticket(
         messages_sent_to.add(user.email)
     except AttributeError:
         pass
-    process_email_notifications_for_ticket_update(
-        public, ticket, f, context, messages_sent_to, files, reassigned=reassigned
-    )
+    with email_session():
+        process_email_notifications_for_ticket_update(
+            public, ticket, f, context, messages_sent_to, files, reassigned=reassigned
+        )
     ticket.save()
 
     # emit signal with followup when the ticket update is done
@@ -1,11 +1,42 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group, Permission
+from django.core.cache import cache
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.dispatch import receiver
 from helpdesk import settings as helpdesk_settings
 from helpdesk.models import Queue, Ticket
+import uuid
 
 
 if helpdesk_settings.HELPDESK_KB_ENABLED:
     from helpdesk.models import KBCategory, KBItem
 
 
+QUEUE_ACCESS_VERSION_KEY = "helpdesk_queue_access_version"
+QUEUE_ACCESS_CACHE_KEY = "helpdesk_queue_access_%s_%s"
+
+# Fields deciding which queues a user can access
+QUEUE_ACCESS_FIELDS = ("permission_name", "allow_public_submission")
+USER_ACCESS_FIELDS = ("is_active", "is_superuser")
+
+# Changed with the queue access of any user in this process, to drop the
+# snapshots kept on the user objects
+_queue_access_generation = 0
+
+
+def get_queue_access_version():
+    version = cache.get(QUEUE_ACCESS_VERSION_KEY)
+    if version is None:
+        cache.add(
+            QUEUE_ACCESS_VERSION_KEY,
+            uuid.uuid4().hex,
+            helpdesk_settings.HELPDESK_QUEUE_ACCESS_CACHE_TIMEOUT,
+        )
+        version = cache.get(QUEUE_ACCESS_VERSION_KEY)
+    return version
+
+
 def huser_from_request(req):
     return HelpdeskUser(req.user)
 
@@ -14,25 +45,67 @@ class HelpdeskUser:
     def __init__(self, user):
         self.user = user
 
+    def limit_queues_by_user(self):
+        return (
+            helpdesk_settings.HELPDESK_ENABLE_PER_QUEUE_STAFF_PERMISSION
+            and not self.user.is_superuser
+        )
+
+    def get_queue_access(self):
+        """Return the ids of the queues the user has the permission of and
+        the ids of the public queues, as two frozensets.
+
+        The snapshot is kept on the user object for the request, and in
+        Django's cache until the user, its groups or permissions, or who can
+        access a queue change.
+        """
+        user = self.user
+        access = getattr(user, "_helpdesk_queue_access", None)
+        if access is not None and access[0] == _queue_access_generation:
+            return access[1]
+        generation = _queue_access_generation
+        key = None
+        snapshot = None
+        if user.is_authenticated:
+            key = QUEUE_ACCESS_CACHE_KEY % (get_queue_access_version(), user.pk)
+            snapshot = cache.get(key)
+        if snapshot is None:
+            permitted = set()
+            public = set()
+            queues = Queue.objects.values_list(
+                "pk", "permission_name", "allow_public_submission"
+            )
+            for pk, permission_name, is_public in queues:
+                if is_public:
+                    public.add(pk)
+                if permission_name and user.has_perm(permission_name):
+                    permitted.add(pk)
+            snapshot = (frozenset(permitted), frozenset(public))
+            if key is not None:
+                cache.set(
+                    key, snapshot, helpdesk_settings.HELPDESK_QUEUE_ACCESS_CACHE_TIMEOUT
+                )
+        user._helpdesk_queue_access = (generation, snapshot)
+        return snapshot
+
+    def get_queue_ids(self):
+        """Return the ids of the queues listed by get_queues(), or None if
+        the user can access all of them."""
+        if not self.limit_queues_by_user():
+            return None
+        permitted, public = self.get_queue_access()
+        return permitted | public
+
     def get_queues(self):
         """Return the list of Queues the user can access.
 
         :param user: The User (the class should have the has_perm method)
         :return: A Python list of Queues
         """
-        user = self.user
-        all_queues = Queue.objects.all()
-        public_ids = [q.pk for q in Queue.objects.filter(allow_public_submission=True)]
-        limit_queues_by_user = (
-            helpdesk_settings.HELPDESK_ENABLE_PER_QUEUE_STAFF_PERMISSION
-            and not user.is_superuser
-        )
-        if limit_queues_by_user:
-            id_list = [q.pk for q in all_queues if user.has_perm(q.permission_name)]
-            id_list += public_ids
-            return all_queues.filter(pk__in=id_list)
-        else:
-            return all_queues
+        queue_ids = self.get_queue_ids()
+        if queue_ids is None:
+            return Queue.objects.all()
+        return Queue.objects.filter(pk__in=queue_ids)
 
     def get_allowed_kb_categories(self):
         categories = []
@@ -51,7 +124,10 @@ class HelpdeskUser:
         return kbitems
 
     def get_tickets_in_queues(self):
-        return Ticket.objects.filter(queue__in=self.get_queues())
+        queue_ids = self.get_queue_ids()
+        if queue_ids is None:
+            return Ticket.objects.all()
+        return Ticket.objects.filter(queue_id__in=queue_ids)
 
     def has_full_access(self):
         return (
@@ -67,22 +143,25 @@ class HelpdeskUser:
         :param queue: The django-helpdesk Queue instance
         :return: True if the user has permission (either by default or explicitly), false otherwise
         """
+        return self.can_access_queue_id(queue.pk)
+
+    def can_access_queue_id(self, queue_id):
         if self.has_full_access():
             return True
         else:
             return (
                 helpdesk_settings.HELPDESK_ENABLE_PER_QUEUE_STAFF_PERMISSION
-                and self.user.has_perm(queue.permission_name)
+                and queue_id in self.get_queue_access()[0]
             )
 
     def can_access_ticket(self, ticket):
         """Check to see if the user has permission to access
         a ticket. If not then deny access."""
         user = self.user
-        if self.can_access_queue(ticket.queue):
+        if self.can_access_queue_id(ticket.queue_id):
             return True
         elif self.has_full_access() or (
-            ticket.assigned_to and user.id == ticket.assigned_to.id
+            ticket.assigned_to_id and user.id == ticket.assigned_to_id
         ):
             return True
         else:
@@ -94,3 +173,59 @@ class HelpdeskUser:
         return self.has_full_access() or (
             category.queue and self.can_access_queue(category.queue)
         )
+
+
+# listeners are loaded via app.py HelpdeskConfig.ready()
+@receiver(pre_save, sender=Queue)
+def check_queue_access_change(sender, instance, update_fields=None, **kwargs):
+    """Note whether saving the queue changes who can access it."""
+    if update_fields is not None and set(update_fields).isdisjoint(QUEUE_ACCESS_FIELDS):
+        changed = False
+    elif instance.pk is None:
+        changed = True
+    else:
+        stored = (
+            Queue.objects.filter(pk=instance.pk)
+            .values_list(*QUEUE_ACCESS_FIELDS)
+            .first()
+        )
+        changed = stored != tuple(
+            getattr(instance, field) for field in QUEUE_ACCESS_FIELDS
+        )
+    instance._helpdesk_queue_access_changed = changed
+
+
+@receiver(post_save, sender=Queue)
+def clear_queue_access_on_queue_save(sender, instance, **kwargs):
+    if getattr(instance, "_helpdesk_queue_access_changed", True):
+        clear_queue_access(sender)
+
+
+@receiver(post_delete, sender=Queue)
+@receiver(post_delete, sender=Group)
+@receiver(post_delete, sender=Permission)
+@receiver(m2m_changed, sender=Group.permissions.through)
+@receiver(m2m_changed, sender=get_user_model().groups.through)
+@receiver(m2m_changed, sender=get_user_model().user_permissions.through)
+def clear_queue_access(sender, action=None, **kwargs):
+    """Drop the queue access snapshots of all users."""
+    global _queue_access_generation
+    if action in (None, "post_add", "post_remove", "post_clear"):
+        _queue_access_generation += 1
+        cache.set(
+            QUEUE_ACCESS_VERSION_KEY,
+            uuid.uuid4().hex,
+            helpdesk_settings.HELPDESK_QUEUE_ACCESS_CACHE_TIMEOUT,
+        )
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def clear_user_queue_access(sender, instance, update_fields=None, **kwargs):
+    """Drop the queue access snapshot of a user, eg made a superuser."""
+    global _queue_access_generation
+    if update_fields is not None and set(update_fields).isdisjoint(USER_ACCESS_FIELDS):
+        # eg the last_login written on every login
+        return
+    _queue_access_generation += 1
+    cache.delete(QUEUE_ACCESS_CACHE_KEY % (get_queue_access_version(), instance.pk))
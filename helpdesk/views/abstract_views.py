@@ -21,7 +21,9 @@ class AbstractCreateTicketMixin:
 
         query_param_fields = ["submitter_email", "title", "body", "queue", "kbitem"]
         custom_fields = [
-            "custom_%s" % f.name for f in CustomField.objects.filter(staff_only=False)
+            "custom_%s" % f.name
+            for f in CustomField.objects.get_cached()
+            if not f.staff_only
         ]
         query_param_fields += custom_fields
         for qpf in query_param_fields:
@@ -30,7 +30,25 @@ class SmallPagination(PageNumberPagination):
     page_size_query_param = "page_size"
 
 
-class UserTicketViewSet(viewsets.ReadOnlyModelViewSet):
+class CustomFieldValuesMixin:
+    """
+    Set the custom field values of the tickets being serialized: those of
+    the current page only, read in a single query.
+    """
+
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        if page is not None:
+            Ticket.load_custom_field_values(page)
+        return page
+
+    def get_object(self):
+        ticket = super().get_object()
+        ticket.set_custom_field_values()
+        return ticket
+
+
+class UserTicketViewSet(CustomFieldValuesMixin, viewsets.ReadOnlyModelViewSet):
     """
     A list of all the tickets submitted by the current user
 
@@ -66,12 +84,10 @@ class UserTicketViewSet(viewsets.ReadOnlyModelViewSet):
             tickets = tickets.order_by("created")
         else:
             tickets = tickets.order_by("-created")
-        for ticket in tickets:
-            ticket.set_custom_field_values()
         return tickets
 
 
-class AssignedTicketViewSet(viewsets.ReadOnlyModelViewSet):
+class AssignedTicketViewSet(CustomFieldValuesMixin, viewsets.ReadOnlyModelViewSet):
     """
     A list of all the tickets assigned to or worked on by the current staff user.
 
@@ -119,12 +135,10 @@ class AssignedTicketViewSet(viewsets.ReadOnlyModelViewSet):
         else:
             tickets = tickets.order_by("-created")
 
-        for ticket in tickets:
-            ticket.set_custom_field_values()
         return tickets
 
 
-class TicketViewSet(viewsets.ModelViewSet):
+class TicketViewSet(CustomFieldValuesMixin, viewsets.ModelViewSet):
     """
     A viewset that provides the standard actions to handle Ticket
 
@@ -154,14 +168,7 @@ class TicketViewSet(viewsets.ModelViewSet):
             if number_statuses:
                 tickets = tickets.filter(status__in=number_statuses)
 
-        for ticket in tickets:
-            ticket.set_custom_field_values()
-        return tickets
-
-    def get_object(self):
-        ticket = super().get_object()
-        ticket.set_custom_field_values()
-        return ticket
+        return tickets.prefetch_related("followup_set__followupattachment_set")
 
 
 class QueueViewSet(viewsets.ReadOnlyModelViewSet):
@@ -8,10 +8,10 @@ views/staff.py - The bulk of the application - provides most business logic and
 """
 
 from ..lib import format_time_spent
-from ..templated_email import send_templated_mail
+from ..templated_email import email_session, send_templated_mail
 from collections import defaultdict
 from copy import deepcopy
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone as dt_timezone
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.decorators import user_passes_test
@@ -20,7 +20,18 @@ from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import PermissionDenied
 from django.core.handlers.wsgi import WSGIRequest
 from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
-from django.db.models import Q, Case, When
+from django.db.models import (
+    BooleanField,
+    Case,
+    Count,
+    DurationField,
+    ExpressionWrapper,
+    F,
+    Q,
+    Sum,
+    When,
+)
+from django.db.models.functions import Coalesce, ExtractDay, TruncMonth
 from django.forms import HiddenInput, inlineformset_factory, TextInput
 from django.http import Http404, HttpResponse, HttpResponseRedirect, JsonResponse, HttpResponseBadRequest
 from django.template.loader import render_to_string
@@ -31,7 +42,7 @@ from django.utils.html import escape
 from django.utils.translation import gettext as _
 from django.views.decorators.csrf import requires_csrf_token
 from django.views.generic.edit import FormView, UpdateView
-from django.db import IntegrityError, transaction
+from django.db import IntegrityError, connection, transaction
 from helpdesk import settings as helpdesk_settings
 from helpdesk.decorators import (
     helpdesk_staff_member_required,
@@ -79,10 +90,13 @@ from helpdesk.models import (
     TicketCC,
     TicketChange,
     TicketCustomFieldValue,
+    TicketDailyStat,
     TicketDependency,
     UserSettings,
 )
 from helpdesk.query import get_query_class, query_from_base64, query_to_base64
+from helpdesk.search import DatabaseSearchBackend, get_search_backend
+from helpdesk.stats import get_queue_summaries, get_ticket_daily_stats
 from helpdesk.user import HelpdeskUser
 from helpdesk.update_ticket import (
     update_ticket,
@@ -411,7 +425,9 @@ def dashboard(request):
     tickets_in_queues = Ticket.objects.filter(
         queue__in=user_queues,
     )
-    basic_ticket_stats = calc_basic_ticket_stats(tickets_in_queues)
+    basic_ticket_stats = calc_basic_ticket_stats(
+        tickets_in_queues, get_ticket_daily_stats(user_queues)
+    )
 
     # compute escalated tickets: tickets in user's queues that have been escalated
     try:
@@ -1382,92 +1398,93 @@ def mass_update(request):
         )
 
     huser = HelpdeskUser(request.user)
-    for t in Ticket.objects.filter(id__in=tickets):
-        if not huser.can_access_queue(t.queue):
-            continue
-
-        if action == "assign" and t.assigned_to != user:
-            t.assigned_to = user
-            t.save()
-            t.followup_set.create(
-                date=timezone.now(),
-                title=_(
-                    "Assigned to %(username)s in bulk update"
-                    % {"username": user.get_username()}
-                ),
-                public=True,
-                user=request.user,
-            )
-        elif action == "unassign" and t.assigned_to is not None:
-            t.assigned_to = None
-            t.save()
-            t.followup_set.create(
-                date=timezone.now(),
-                title=_("Unassigned in bulk update"),
-                public=True,
-                user=request.user,
-            )
-        elif action == "set_kbitem":
-            t.kbitem = kbitem
-            t.save()
-            t.followup_set.create(
-                date=timezone.now(),
-                title=_("KBItem set in bulk update"),
-                public=False,
-                user=request.user,
-            )
-        elif action == "close" and t.status != Ticket.CLOSED_STATUS:
-            t.status = Ticket.CLOSED_STATUS
-            t.save()
-            t.followup_set.create(
-                date=timezone.now(),
-                title=_("Closed in bulk update"),
-                public=False,
-                user=request.user,
-                new_status=Ticket.CLOSED_STATUS,
-            )
-        elif action == "close_public" and t.status != Ticket.CLOSED_STATUS:
-            t.status = Ticket.CLOSED_STATUS
-            t.save()
-            t.followup_set.create(
-                date=timezone.now(),
-                title=_("Closed in bulk update"),
-                public=True,
-                user=request.user,
-                new_status=Ticket.CLOSED_STATUS,
-            )
-            # Send email to Submitter, Owner, Queue CC
-            context = safe_template_context(t)
-            context.update(
-                resolution=t.resolution, queue=queue_template_context(t.queue)
-            )
+    with email_session():
+        for t in Ticket.objects.filter(id__in=tickets):
+            if not huser.can_access_queue(t.queue):
+                continue
 
-            messages_sent_to = set()
-            try:
-                messages_sent_to.add(request.user.email)
-            except AttributeError:
-                pass
+            if action == "assign" and t.assigned_to != user:
+                t.assigned_to = user
+                t.save()
+                t.followup_set.create(
+                    date=timezone.now(),
+                    title=_(
+                        "Assigned to %(username)s in bulk update"
+                        % {"username": user.get_username()}
+                    ),
+                    public=True,
+                    user=request.user,
+                )
+            elif action == "unassign" and t.assigned_to is not None:
+                t.assigned_to = None
+                t.save()
+                t.followup_set.create(
+                    date=timezone.now(),
+                    title=_("Unassigned in bulk update"),
+                    public=True,
+                    user=request.user,
+                )
+            elif action == "set_kbitem":
+                t.kbitem = kbitem
+                t.save()
+                t.followup_set.create(
+                    date=timezone.now(),
+                    title=_("KBItem set in bulk update"),
+                    public=False,
+                    user=request.user,
+                )
+            elif action == "close" and t.status != Ticket.CLOSED_STATUS:
+                t.status = Ticket.CLOSED_STATUS
+                t.save()
+                t.followup_set.create(
+                    date=timezone.now(),
+                    title=_("Closed in bulk update"),
+                    public=False,
+                    user=request.user,
+                    new_status=Ticket.CLOSED_STATUS,
+                )
+            elif action == "close_public" and t.status != Ticket.CLOSED_STATUS:
+                t.status = Ticket.CLOSED_STATUS
+                t.save()
+                t.followup_set.create(
+                    date=timezone.now(),
+                    title=_("Closed in bulk update"),
+                    public=True,
+                    user=request.user,
+                    new_status=Ticket.CLOSED_STATUS,
+                )
+                # Send email to Submitter, Owner, Queue CC
+                context = safe_template_context(t)
+                context.update(
+                    resolution=t.resolution, queue=queue_template_context(t.queue)
+                )
 
-            roles = {
-                "submitter": ("closed_submitter", context),
-                "ticket_cc": ("closed_cc", context),
-            }
-            if (
-                t.assigned_to
-                and t.assigned_to.usersettings_helpdesk.email_on_ticket_change
-            ):
-                roles["assigned_to"] = ("closed_owner", context)
-
-            messages_sent_to.update(
-                t.send(
-                    roles,
-                    dont_send_to=messages_sent_to,
-                    fail_silently=True,
+                messages_sent_to = set()
+                try:
+                    messages_sent_to.add(request.user.email)
+                except AttributeError:
+                    pass
+
+                roles = {
+                    "submitter": ("closed_submitter", context),
+                    "ticket_cc": ("closed_cc", context),
+                }
+                if (
+                    t.assigned_to
+                    and t.assigned_to.usersettings_helpdesk.email_on_ticket_change
+                ):
+                    roles["assigned_to"] = ("closed_owner", context)
+
+                messages_sent_to.update(
+                    t.send(
+                        roles,
+                        dont_send_to=messages_sent_to,
+                        fail_silently=True,
+                    )
                 )
-            )
 
-        elif action == "delete":
-            t.delete()
+            elif action == "delete":
+                t.delete()
 
     return HttpResponseRedirect(reverse("helpdesk:list"))
 
@@ -1590,6 +1607,7 @@ def redirect_from_chosen_ticket(
                 ],
                 sender=ticket.queue.from_address,
                 fail_silently=True,
+                ticket=chosen_ticket,
             )
 
         # Move all followups and update their title to know they
@@ -1610,6 +1628,12 @@ def redirect_from_chosen_ticket(
             )
         for ticketcc in ticket.ticketcc_set.all():
             chosen_ticket.add_email_to_ticketcc_if_not_in(ticketcc=ticketcc)
+        ticket.update_last_followup_at()
+        get_search_backend().index_ticket(ticket)
+
+    # Follow-ups were moved with a bulk update, refresh what depends on them
+    chosen_ticket.update_last_followup_at()
+    get_search_backend().index_ticket(chosen_ticket)
     return redirect(chosen_ticket)
 
 
@@ -1626,7 +1650,7 @@ def merge_tickets(request):
     if ticket_select_form.is_valid():
         tickets = ticket_select_form.cleaned_data.get("tickets")
 
-        custom_fields = CustomField.objects.all()
+        custom_fields = CustomField.objects.get_cached()
 
         merge_ticket_values(request, tickets, custom_fields)
 
@@ -1822,9 +1846,11 @@ def ticket_list(request):
     )
 
     search_message = ""
-    if query_params["search_string"] and settings.DATABASES["default"][
-        "ENGINE"
-    ].endswith("sqlite"):
+    if (
+        query_params["search_string"]
+        and isinstance(get_search_backend(), DatabaseSearchBackend)
+        and settings.DATABASES["default"]["ENGINE"].endswith("sqlite")
+    ):
         search_message = _(
             "<p><strong>Note:</strong> Your keyword search is case sensitive "
             "because of your database. This means the search will <strong>not</strong> "
@@ -2099,7 +2125,9 @@ def report_index(request):
 
     user_queues = HelpdeskUser(request.user).get_queues()
     Tickets = Ticket.objects.filter(queue__in=user_queues)
-    basic_ticket_stats = calc_basic_ticket_stats(Tickets)
+    basic_ticket_stats = calc_basic_ticket_stats(
+        Tickets, get_ticket_daily_stats(user_queues)
+    )
 
     # The following query builds a grid of queues & ticket statuses,
     # to be displayed to the user. EG:
@@ -2109,14 +2137,15 @@ def report_index(request):
     Queues = user_queues if user_queues else Queue.objects.all()
 
     dash_tickets = []
-    for queue in Queues:
+    for summary in get_queue_summaries(Queues):
+        queue = summary["queue"]
         dash_ticket = {
             "queue": queue.id,
             "name": queue.title,
-            "open": queue.ticket_set.filter(status__in=[1, 2]).count(),
-            "resolved": queue.ticket_set.filter(status=3).count(),
-            "closed": queue.ticket_set.filter(status=4).count(),
-            "time_spent": format_time_spent(queue.time_spent),
+            "open": summary["open"],
+            "resolved": summary["resolved"],
+            "closed": summary["closed"],
+            "time_spent": format_time_spent(summary["time_spent"]),
             "dedicated_time": format_time_spent(queue.dedicated_time),
         }
         dash_tickets.append(dash_ticket)
@@ -2177,50 +2206,116 @@ def get_report_table_and_totals(header1, summarytable, possible_options):
     return table, totals
 
 
+# The row and column dimension of each report
+REPORT_DIMENSIONS = {
+    "userpriority": ("user", "priority"),
+    "userqueue": ("user", "queue"),
+    "userstatus": ("user", "status"),
+    "usermonth": ("user", "month"),
+    "queuepriority": ("queue", "priority"),
+    "queuestatus": ("queue", "status"),
+    "queuemonth": ("queue", "month"),
+    "daysuntilticketclosedbymonth": ("queue", "month"),
+}
+
+
+def get_report_dimension_expression(dimension, date_field="created"):
+    if dimension == "user":
+        return F("assigned_to")
+    if dimension == "queue":
+        return F("queue__title")
+    if dimension == "priority":
+        return F("priority")
+    if dimension == "status":
+        return F("status")
+    if date_field != "created":
+        return TruncMonth(date_field)
+    # Periods are the month of the creation date as stored, ie in UTC
+    return TruncMonth("created", tzinfo=dt_timezone.utc)
+
+
+def get_report_dimension_labels(dimension, values):
+    """
+    Map the values grouped on by the database to the labels shown in the
+    report, eg user ids to user names.
+    """
+    if dimension == "user":
+        users = User.objects.in_bulk([value for value in values if value is not None])
+        labels = {}
+        for value in values:
+            user = users.get(value)
+            if user is None:
+                labels[value] = "%s" % _("Unassigned")
+            else:
+                labels[value] = user.get_full_name() or user.get_username()
+        return labels
+    if dimension in ("priority", "status"):
+        choices = dict(
+            Ticket.PRIORITY_CHOICES
+            if dimension == "priority"
+            else Ticket.STATUS_CHOICES
+        )
+        return {value: "%s" % choices.get(value, value) for value in values}
+    if dimension == "month":
+        return {value: "%s-%s" % (value.year, value.month) for value in values}
+    return {value: "%s" % value for value in values}
+
+
 def update_summary_tables(report_queryset, report, summarytable, summarytable2):
-    metric3 = False
-    for ticket in report_queryset:
-        if report == "userpriority":
-            metric1 = "%s" % ticket.get_assigned_to
-            metric2 = "%s" % ticket.get_priority_display()
-
-        elif report == "userqueue":
-            metric1 = "%s" % ticket.get_assigned_to
-            metric2 = "%s" % ticket.queue.title
-
-        elif report == "userstatus":
-            metric1 = "%s" % ticket.get_assigned_to
-            metric2 = "%s" % ticket.get_status_display()
-
-        elif report == "usermonth":
-            metric1 = "%s" % ticket.get_assigned_to
-            metric2 = "%s-%s" % (ticket.created.year, ticket.created.month)
-
-        elif report == "queuepriority":
-            metric1 = "%s" % ticket.queue.title
-            metric2 = "%s" % ticket.get_priority_display()
-
-        elif report == "queuestatus":
-            metric1 = "%s" % ticket.queue.title
-            metric2 = "%s" % ticket.get_status_display()
-
-        elif report == "queuemonth":
-            metric1 = "%s" % ticket.queue.title
-            metric2 = "%s-%s" % (ticket.created.year, ticket.created.month)
-
-        elif report == "daysuntilticketclosedbymonth":
-            metric1 = "%s" % ticket.queue.title
-            metric2 = "%s-%s" % (ticket.created.year, ticket.created.month)
-            metric3 = ticket.modified - ticket.created
-            metric3 = metric3.days
+    """
+    Count the tickets of each cell of a report, and for the
+    "daysuntilticketclosedbymonth" report sum up the days they were open.
+    The tickets (or TicketDailyStat rows) are grouped by the database, only
+    the cells are loaded.
+    """
+    if report not in REPORT_DIMENSIONS:
+        raise ValueError(f'report "{report}" is unrecognized.')
+    dimension1, dimension2 = REPORT_DIMENSIONS[report]
+    from_daily_stats = report_queryset.model is TicketDailyStat
+    date_field = "date" if from_daily_stats else "created"
+    report_queryset = report_queryset.order_by().annotate(
+        metric1=get_report_dimension_expression(dimension1, date_field),
+        metric2=get_report_dimension_expression(dimension2, date_field),
+    )
 
-        else:
-            raise ValueError(f'report "{report}" is unrecognized.')
+    count_days = report == "daysuntilticketclosedbymonth"
+    if from_daily_stats:
+        sum_days_in_db = count_days
+        aggregates = {"count": Sum("ticket_count"), "days": Sum("days_open")}
+    else:
+        sum_days_in_db = count_days and connection.features.has_native_duration_field
+        aggregates = {"count": Count("id")}
+        if sum_days_in_db:
+            aggregates["days"] = Sum(
+                ExtractDay(
+                    ExpressionWrapper(
+                        F("modified") - F("created"), output_field=DurationField()
+                    )
+                )
+            )
+    cells = list(report_queryset.values("metric1", "metric2").annotate(**aggregates))
 
-        summarytable[metric1, metric2] += 1
-        if metric3:
-            if report == "daysuntilticketclosedbymonth":
-                summarytable2[metric1, metric2] += metric3
+    labels1 = get_report_dimension_labels(
+        dimension1, {cell["metric1"] for cell in cells}
+    )
+    labels2 = get_report_dimension_labels(
+        dimension2, {cell["metric2"] for cell in cells}
+    )
+    for cell in cells:
+        key = labels1[cell["metric1"]], labels2[cell["metric2"]]
+        summarytable[key] += cell["count"]
+        if sum_days_in_db and cell["days"]:
+            summarytable2[key] += cell["days"]
+
+    if count_days and not sum_days_in_db:
+        # Without interval arithmetic in the database (eg SQLite), sum up
+        # the whole days from the two dates of each ticket.
+        for metric1, metric2, created, modified in report_queryset.values_list(
+            "metric1", "metric2", "created", "modified"
+        ):
+            days = (modified - created).days
+            if days:
+                summarytable2[labels1[metric1], labels2[metric2]] += days
 
 
 @helpdesk_staff_member_required
@@ -2307,7 +2402,13 @@ def run_report(request, report):
         col1heading = _("Queue")
         possible_options = periods
         charttype = "date"
-    update_summary_tables(report_queryset, report, summarytable, summarytable2)
+    daily_stats = get_ticket_daily_stats(HelpdeskUser(request.user).get_queues())
+    update_summary_tables(
+        report_queryset if daily_stats is None else daily_stats,
+        report,
+        summarytable,
+        summarytable2,
+    )
     if report == "daysuntilticketclosedbymonth":
         for key in summarytable2.keys():
             summarytable[key] = summarytable2[key] / summarytable[key]
@@ -2815,27 +2916,73 @@ def attachment_del(request, ticket_id, attachment_id):
 
 
 def calc_average_nbr_days_until_ticket_resolved(Tickets):
-    nbr_closed_tickets = len(Tickets)
-    days_per_ticket = 0
-    days_each_ticket = list()
-
-    for ticket in Tickets:
-        time_ticket_open = ticket.modified - ticket.created
-        days_this_ticket = time_ticket_open.days
-        days_per_ticket += days_this_ticket
-        days_each_ticket.append(days_this_ticket)
-
-    if nbr_closed_tickets > 0:
-        mean_per_ticket = days_per_ticket / nbr_closed_tickets
-    else:
-        mean_per_ticket = 0
+    days_each_ticket = [
+        (modified - created).days
+        for created, modified in Tickets.values_list("created", "modified")
+    ]
+    if days_each_ticket:
+        return sum(days_each_ticket) / len(days_each_ticket)
+    return 0
 
-    return mean_per_ticket
 
-
-def calc_basic_ticket_stats(Tickets):
+def aggregate_basic_ticket_stats(Tickets, date_30_str, date_60_str):
     # all not closed tickets (open, reopened, resolved,) - independent of user
-    all_open_tickets = Tickets.exclude(status=Ticket.CLOSED_STATUS)
+    is_open = ~Q(status=Ticket.CLOSED_STATUS)
+    # all closed tickets - independent of user.
+    is_closed = Q(status=Ticket.CLOSED_STATUS)
+    # all closed tickets that were opened in the last 60 days.
+    is_closed_last_60_days = is_closed & Q(created__gte=date_60_str)
+
+    # Everything is counted in a single aggregate query over the tickets.
+    aggregates = {
+        # > 0 & <= 30
+        "N_ota_le_30": Count("id", filter=is_open & Q(created__gte=date_30_str)),
+        # >= 30 & <= 60
+        "N_ota_le_60_ge_30": Count(
+            "id",
+            filter=is_open & Q(created__gte=date_60_str, created__lte=date_30_str),
+        ),
+        # >= 60
+        "N_ota_ge_60": Count("id", filter=is_open & Q(created__lte=date_60_str)),
+        "N_closed": Count("id", filter=is_closed),
+        "N_closed_last_60_days": Count("id", filter=is_closed_last_60_days),
+    }
+    if connection.features.has_native_duration_field:
+        # Whole days each ticket was open, as timedelta.days would count them
+        days_open = ExtractDay(
+            ExpressionWrapper(F("modified") - F("created"), output_field=DurationField())
+        )
+        aggregates["days_closed"] = Sum(days_open, filter=is_closed)
+        aggregates["days_closed_last_60_days"] = Sum(
+            days_open, filter=is_closed_last_60_days
+        )
+    stats = Tickets.order_by().aggregate(**aggregates)
+
+    if not connection.features.has_native_duration_field:
+        # Without interval arithmetic in the database (eg SQLite), sum up
+        # the days in Python from the two dates of the closed tickets only.
+        stats["days_closed"] = stats["days_closed_last_60_days"] = 0
+        closed_tickets = Tickets.filter(is_closed).annotate(
+            last_60_days=ExpressionWrapper(
+                Q(created__gte=date_60_str), output_field=BooleanField()
+            )
+        )
+        for created, modified, last_60_days in closed_tickets.values_list(
+            "created", "modified", "last_60_days"
+        ):
+            days_this_ticket = (modified - created).days
+            stats["days_closed"] += days_this_ticket
+            if last_60_days:
+                stats["days_closed_last_60_days"] += days_this_ticket
+    return stats
+
+
+def calc_basic_ticket_stats(Tickets, daily_stats=None):
+    """
+    Count the open tickets by age and average the days until tickets were
+    closed, from the given tickets or from the matching rows of the daily
+    statistics rollup (see helpdesk.stats), if given.
+    """
     today = datetime.today()
 
     date_30 = date_rel_to_today(today, 30)
@@ -2843,19 +2990,34 @@ def calc_basic_ticket_stats(Tickets):
     date_30_str = date_30.strftime(CUSTOMFIELD_DATE_FORMAT)
     date_60_str = date_60.strftime(CUSTOMFIELD_DATE_FORMAT)
 
-    # > 0 & <= 30
-    ota_le_30 = all_open_tickets.filter(created__gte=date_30_str)
-    N_ota_le_30 = len(ota_le_30)
-
-    # >= 30 & <= 60
-    ota_le_60_ge_30 = all_open_tickets.filter(
-        created__gte=date_60_str, created__lte=date_30_str
-    )
-    N_ota_le_60_ge_30 = len(ota_le_60_ge_30)
+    # all not closed tickets (open, reopened, resolved,) - independent of user
+    is_open = ~Q(status=Ticket.CLOSED_STATUS)
+    # all closed tickets - independent of user.
+    is_closed = Q(status=Ticket.CLOSED_STATUS)
+
+    if daily_stats is not None:
+        # The rollup counts tickets per day of creation
+        def count(match):
+            return Coalesce(Sum("ticket_count", filter=match), 0)
+
+        is_closed_last_60_days = is_closed & Q(date__gte=date_60.date())
+        stats = daily_stats.aggregate(
+            N_ota_le_30=count(is_open & Q(date__gte=date_30.date())),
+            N_ota_le_60_ge_30=count(
+                is_open & Q(date__gte=date_60.date(), date__lt=date_30.date())
+            ),
+            N_ota_ge_60=count(is_open & Q(date__lt=date_60.date())),
+            N_closed=count(is_closed),
+            N_closed_last_60_days=count(is_closed_last_60_days),
+            days_closed=Sum("days_open", filter=is_closed),
+            days_closed_last_60_days=Sum("days_open", filter=is_closed_last_60_days),
+        )
+    else:
+        stats = aggregate_basic_ticket_stats(Tickets, date_30_str, date_60_str)
 
-    # >= 60
-    ota_ge_60 = all_open_tickets.filter(created__lte=date_60_str)
-    N_ota_ge_60 = len(ota_ge_60)
+    N_ota_le_30 = stats["N_ota_le_30"]
+    N_ota_le_60_ge_30 = stats["N_ota_le_60_ge_30"]
+    N_ota_ge_60 = stats["N_ota_ge_60"]
 
     # (O)pen (T)icket (S)tats
     ots = list()
@@ -2885,15 +3047,13 @@ def calc_basic_ticket_stats(Tickets):
         ]
     )
 
-    # all closed tickets - independent of user.
-    all_closed_tickets = Tickets.filter(status=Ticket.CLOSED_STATUS)
-    average_nbr_days_until_ticket_closed = calc_average_nbr_days_until_ticket_resolved(
-        all_closed_tickets
+    average_nbr_days_until_ticket_closed = (
+        stats["days_closed"] / stats["N_closed"] if stats["N_closed"] else 0
     )
-    # all closed tickets that were opened in the last 60 days.
-    all_closed_last_60_days = all_closed_tickets.filter(created__gte=date_60_str)
     average_nbr_days_until_ticket_closed_last_60_days = (
-        calc_average_nbr_days_until_ticket_resolved(all_closed_last_60_days)
+        stats["days_closed_last_60_days"] / stats["N_closed_last_60_days"]
+        if stats["N_closed_last_60_days"]
+        else 0
     )
 
     # put together basic stats
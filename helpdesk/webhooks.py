@@ -1,13 +1,231 @@
+import json
 import requests
 import requests.exceptions
 import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
 from django.dispatch import receiver
+from django.utils import timezone
+from urllib.parse import urlsplit
 
 from . import settings
+from .models import WebhookDelivery
 from .signals import new_ticket_done, update_ticket_done
 
 logger = logging.getLogger(__name__)
 
+# Number of queued deliveries claimed and sent at a time
+BATCH_SIZE = 100
+
+# Number of seconds after which the deliveries claimed by a run that did not
+# finish (eg because it crashed) are due again
+CLAIM_TIMEOUT = 600
+
+
+def get_endpoint(url):
+    parts = urlsplit(url)
+    return (parts.scheme, parts.netloc)
+
+
+def post_webhooks(deliveries, batch=False):
+    """
+    POST the payload of each delivery to its URL, in parallel over
+    HELPDESK_WEBHOOK_WORKERS threads. The requests to one endpoint are
+    split by ticket in at most HELPDESK_WEBHOOK_ENDPOINT_CONCURRENCY lanes,
+    each sent one after the other over a pooled requests.Session. With
+    `batch`, the payloads of all deliveries to the same URL are sent as a
+    JSON array in a single request.
+
+    Returns a list of (delivery, error) pairs, error being None for the
+    deliveries that succeeded. The database is not touched.
+    """
+    if batch:
+        by_url = defaultdict(list)
+        for delivery in deliveries:
+            by_url[delivery.url].append(delivery)
+        requests_to_send = list(by_url.values())
+    else:
+        requests_to_send = [[delivery] for delivery in deliveries]
+
+    # Deliveries of the same event share their payload, which is only
+    # encoded once.
+    bodies = {}
+
+    def encode(payload):
+        if id(payload) not in bodies:
+            bodies[id(payload)] = (payload, json.dumps(payload, cls=DjangoJSONEncoder))
+        return bodies[id(payload)][1]
+
+    by_endpoint = defaultdict(list)
+    for group in requests_to_send:
+        if batch:
+            body = "[%s]" % ",".join(encode(delivery.payload) for delivery in group)
+        else:
+            body = encode(group[0].payload)
+        by_endpoint[get_endpoint(group[0].url)].append((group, body))
+    concurrency = max(settings.HELPDESK_WEBHOOK_ENDPOINT_CONCURRENCY, 1)
+    lanes = []
+    for endpoint_requests in by_endpoint.values():
+        # the events of a ticket stay on one lane, so they arrive in order
+        endpoint_lanes = defaultdict(list)
+        for group, body in endpoint_requests:
+            lane = hash(group[0].ticket_id) % concurrency
+            endpoint_lanes[lane].append((group, body))
+        lanes.extend(endpoint_lanes.values())
+    if len(lanes) <= 1:
+        return [result for lane in lanes for result in post_lane(lane)]
+    workers = min(max(settings.HELPDESK_WEBHOOK_WORKERS, 1), len(lanes))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return [
+            result for results in executor.map(post_lane, lanes) for result in results
+        ]
+
+
+def post_lane(lane):
+    """POST the (deliveries, body) requests of a lane one after the other."""
+    results = []
+    with requests.Session() as session:
+        for deliveries, body in lane:
+            error = None
+            try:
+                response = session.post(
+                    deliveries[0].url,
+                    data=body.encode("utf-8"),
+                    headers={"Content-Type": "application/json"},
+                    timeout=settings.HELPDESK_WEBHOOK_TIMEOUT,
+                )
+                response.raise_for_status()
+            except requests.exceptions.RequestException as e:
+                error = e
+            results.extend((delivery, error) for delivery in deliveries)
+    return results
+
+
+def schedule_retry(delivery, error):
+    """Set the next attempt of a failed delivery, or give up on it."""
+    delivery.attempts += 1
+    delivery.last_error = str(error) or error.__class__.__name__
+    if delivery.attempts >= settings.HELPDESK_WEBHOOK_MAX_ATTEMPTS:
+        delivery.failed = True
+        logger.error(
+            "Giving up sending webhook to %s after %s attempts: %s",
+            delivery.url,
+            delivery.attempts,
+            delivery.last_error,
+        )
+    else:
+        delay = settings.HELPDESK_WEBHOOK_RETRY_DELAY * 2 ** (delivery.attempts - 1)
+        delivery.next_attempt = timezone.now() + timedelta(seconds=delay)
+        logger.warning(
+            "Could not send webhook to %s, retrying in %s seconds: %s",
+            delivery.url,
+            delay,
+            delivery.last_error,
+        )
+
+
+def enqueue_webhooks(urls, data, ticket=None):
+    """
+    Send the given data to each URL. With HELPDESK_WEBHOOK_QUEUE or
+    HELPDESK_WEBHOOK_BATCH_WINDOW the deliveries are only queued, for the
+    'send_webhooks' command or the helpdesk_send_webhooks Celery task.
+    Otherwise they are sent right away and only the failed ones are kept to
+    be retried.
+    """
+    deliveries = [
+        WebhookDelivery(url=url.strip(), payload=data, ticket=ticket)
+        for url in urls
+        if url.strip()
+    ]
+    window = settings.HELPDESK_WEBHOOK_BATCH_WINDOW
+    if settings.HELPDESK_WEBHOOK_QUEUE or window:
+        # With batching, the deliveries wait for the other events of the
+        # window, to be sent together.
+        next_attempt = timezone.now() + timedelta(seconds=window)
+        for delivery in deliveries:
+            delivery.next_attempt = next_attempt
+        WebhookDelivery.objects.bulk_create(deliveries)
+        if settings.HELPDESK_WEBHOOK_QUEUE_USE_CELERY:
+            from .tasks import helpdesk_send_webhooks
+
+            transaction.on_commit(
+                lambda: helpdesk_send_webhooks.apply_async(countdown=window)
+            )
+        return
+    failed = []
+    for delivery, error in post_webhooks(deliveries):
+        if error is not None:
+            schedule_retry(delivery, error)
+            failed.append(delivery)
+    WebhookDelivery.objects.bulk_create(failed)
+
+
+def claim_due_deliveries(limit):
+    """
+    Claim up to `limit` due deliveries for this run. Their next attempt is
+    moved CLAIM_TIMEOUT seconds ahead by a single UPDATE, so that two
+    overlapping runs never send the same delivery.
+    """
+    now = timezone.now()
+    ids = list(
+        WebhookDelivery.objects.filter(failed=False, next_attempt__lte=now)
+        .order_by("next_attempt", "pk")
+        .values_list("pk", flat=True)[:limit]
+    )
+    if not ids:
+        return []
+    claimed_until = now + timedelta(seconds=CLAIM_TIMEOUT)
+    WebhookDelivery.objects.filter(pk__in=ids, next_attempt__lte=now).update(
+        next_attempt=claimed_until
+    )
+    claimed = WebhookDelivery.objects.filter(pk__in=ids, next_attempt=claimed_until)
+    # in the order of the events, which the lanes keep
+    return list(claimed.order_by("pk"))
+
+
+def send_webhooks(limit=None):
+    """
+    Send the due webhook deliveries, at most `limit` of them. With
+    HELPDESK_WEBHOOK_BATCH_WINDOW, the due deliveries to the same URL are
+    sent together. Returns the number of deliveries sent.
+    """
+    nbr_claimed = 0
+    nbr_sent = 0
+    while limit is None or nbr_claimed < limit:
+        batch_size = BATCH_SIZE
+        if limit is not None:
+            batch_size = min(batch_size, limit - nbr_claimed)
+        deliveries = claim_due_deliveries(batch_size)
+        if not deliveries:
+            break
+        nbr_claimed += len(deliveries)
+        sent = []
+        batch = bool(settings.HELPDESK_WEBHOOK_BATCH_WINDOW)
+        for delivery, error in post_webhooks(deliveries, batch=batch):
+            if error is None:
+                sent.append(delivery.pk)
+            else:
+                schedule_retry(delivery, error)
+                delivery.save(
+                    update_fields=["attempts", "last_error", "failed", "next_attempt"]
+                )
+        WebhookDelivery.objects.filter(pk__in=sent).delete()
+        nbr_sent += len(sent)
+    return nbr_sent
+
+
+def replay_failed_webhooks():
+    """
+    Queue the dead letters, the deliveries that failed every attempt, to
+    be sent again. Returns the number of deliveries replayed.
+    """
+    return WebhookDelivery.objects.filter(failed=True).update(
+        failed=False, attempts=0, next_attempt=timezone.now()
+    )
+
 
 def notify_followup_webhooks(followup):
     urls = settings.HELPDESK_GET_FOLLOWUP_WEBHOOK_URLS()
@@ -28,11 +246,7 @@ def notify_followup_webhooks(followup):
         "followup_id": followup.id,
     }
 
-    for url in urls:
-        try:
-            requests.post(url, json=data, timeout=settings.HELPDESK_WEBHOOK_TIMEOUT)
-        except requests.exceptions.Timeout:
-            logger.error("Timeout while sending followup webhook to %s", url)
+    enqueue_webhooks(urls, data, ticket=ticket)
 
 
 # listener is loaded via app.py HelpdeskConfig.ready()
@@ -54,11 +268,7 @@ def send_new_ticket_webhook(ticket):
     # Prepare the data to send
     data = {"ticket": serialized_ticket, "queue_slug": ticket.queue.slug}
 
-    for url in urls:
-        try:
-            requests.post(url, json=data, timeout=settings.HELPDESK_WEBHOOK_TIMEOUT)
-        except requests.exceptions.Timeout:
-            logger.error("Timeout while sending new ticket webhook to %s", url)
+    enqueue_webhooks(urls, data, ticket=ticket)
 
 
 # listener is loaded via app.py HelpdeskConfig.ready()